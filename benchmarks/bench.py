@@ -0,0 +1,298 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from services import cleanup
+from services.topology import provisioning_plan, teardown_plan
+from services.waiters import is_polling
+from utils import utils as config
+from utils.clients import get_client, get_resource, register_client_event
+from utils.plan import Plan
+from utils.topology import Topology, compile_topology
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_SPOKES = (4, 16)
+DEFAULT_LATENCY = 0.02
+# a phase is slower than its baseline only if it is both this much slower relatively and absolutely,
+# so scheduler noise on short phases is not reported
+DEFAULT_TOLERANCE = 0.25
+MIN_WALL_DELTA = 0.05
+BENCH_IMAGE = 'ami-065bb5126e4504910'
+
+
+class CallRecorder:
+    # botocore before-call hook on every client: counts calls per operation, and the waiters' polls among them,
+    # and sleeps the injected latency, so parallelism in the flows shows up in wall time the way it does against AWS.
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.polls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, model, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+            if is_polling():
+                self.polls[model.name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def take(self) -> Tuple[Counter, Counter]:
+        with self._lock:
+            calls, polls, self.calls, self.polls = self.calls, self.polls, Counter(), Counter()
+        return calls, polls
+
+
+@dataclass
+class Phase:
+    name: str
+    run: Callable[[], object]
+    # the phase's plan, built right before it runs so teardowns see what was recorded
+    plan: Optional[Callable[[], Plan]] = None
+
+
+@dataclass
+class Scenario:
+    name: str
+    phases: List[Phase] = field(default_factory=list)
+
+
+def _load_script(name: str):
+    # the run scripts are named like their scenarios, which are not valid module names
+    path = os.path.join(config.get_project_root(), 'run', f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _fixed_scenario(name: str, script: str, section: str, teardown: Callable[[object, str], object]) -> Scenario:
+    module = _load_script(script)
+    constants = config.fetch_constants(section=section)
+    phases = [
+        Phase('create_vpcs', lambda: module.create_vpcs(section, constants),
+              lambda: module.vpc_steps(section, constants).plan()),
+        Phase('create_tgw', lambda: module.create_tgw(section, constants),
+              lambda: module.tgw_steps(section, constants).plan()),
+        Phase('create_vms', lambda: module.create_vms(section, constants),
+              lambda: module.vm_steps(section, constants).plan()),
+        Phase('cleanup', lambda: teardown(constants, section).run(), lambda: teardown(constants, section).plan()),
+    ]
+    return Scenario(name, phases)
+
+
+def intra_region_scenario() -> Scenario:
+    return _fixed_scenario('intra_region', 'intra-region', 'intra_region', lambda constants, section: (
+        cleanup.intra_region_teardown(section, get_client('ec2', constants.region1))))
+
+
+def inter_region_scenario() -> Scenario:
+    return _fixed_scenario('inter_region', 'inter-region', 'inter_region', lambda constants, section: (
+        cleanup.inter_region_teardown(section, get_client('ec2', constants.region1),
+                                      get_client('ec2', constants.region2))))
+
+
+def spoke_topology(spokes: int, region: str = 'us-east-1') -> Topology:
+    # a hub with internet access and `spokes` private spokes, all on one transit gateway
+    raw = {
+        'images': {region: BENCH_IMAGE},
+        'supernet': '10.0.0.0/8',
+        'transit_gateways': [{'name': 'hub_tgw', 'region': region}],
+        'vpcs': [
+            {'name': 'hub', 'region': region, 'prefix': 16, 'internet_gateway': True, 'transit_gateway': 'hub_tgw',
+             'subnets': [{'name': 'hub_public', 'prefix': 24, 'az': f'{region}a', 'public': True, 'instances': 1},
+                         {'name': 'hub_private', 'prefix': 24, 'az': f'{region}a'}]},
+            {'name': 'spoke_{i}', 'count': spokes, 'region': region, 'prefix': 16, 'transit_gateway': 'hub_tgw',
+             'subnets': [{'name': 'spoke_{i}_private', 'prefix': 24, 'az': f'{region}a', 'instances': 1}]},
+        ],
+    }
+    return compile_topology(f'spokes_{spokes}', raw)
+
+
+def spoke_scenario(spokes: int) -> Scenario:
+    topology = spoke_topology(spokes)
+    return Scenario(topology.name, [
+        Phase('provision', lambda: provisioning_plan(topology).run(), lambda: provisioning_plan(topology).plan()),
+        Phase('teardown', lambda: teardown_plan(topology).run(), lambda: teardown_plan(topology).plan()),
+    ])
+
+
+def _run_phase(phase: Phase, recorder: CallRecorder) -> Dict[str, object]:
+    plan = phase.plan() if phase.plan else None
+    recorder.take()
+    status = 'ok'
+    started = time.perf_counter()
+    try:
+        phase.run()
+    except Exception as e:
+        logger.exception(f'Benchmark phase {phase.name} failed')
+        status = f'failed: {type(e).__name__}'
+    wall = time.perf_counter() - started
+    calls, polls = recorder.take()
+    return {
+        'status': status,
+        'wall_s': round(wall, 3),
+        'api_calls': sum(calls.values()),
+        'poll_calls': sum(polls.values()),
+        'calls_by_operation': dict(sorted(calls.items())),
+        'planned_api_calls': plan.api_calls if plan else None,
+        'critical_path': plan.depth if plan else None,
+    }
+
+
+@contextmanager
+def _one_request_at_a_time():
+    # moto's backends are not thread-safe: a describe walking a region's routes while another thread adds one fails
+    # with "dictionary changed size during iteration". Requests are handled one at a time; the injected latency is
+    # slept before, in parallel, so the flows' concurrency still shows in wall time.
+    from moto.core.botocore_stubber import BotocoreStubber
+    process_request = BotocoreStubber.process_request
+    lock = threading.RLock()
+
+    def serialized(self, request):
+        with lock:
+            return process_request(self, request)
+
+    BotocoreStubber.process_request = serialized
+    try:
+        yield
+    finally:
+        BotocoreStubber.process_request = process_request
+
+
+def run_scenarios(scenarios: List[Callable[[], Scenario]], latency: float) -> Dict[str, Dict[str, dict]]:
+    # every scenario gets a fresh in-process EC2 and its own config directory, so the repo's state files
+    # and AWS are never touched
+    from moto import mock_aws
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    recorder = CallRecorder(latency)
+    register_client_event('before-call', recorder)
+    # service models and moto's EC2 data are loaded once per process; that is startup, not part of any flow
+    with mock_aws():
+        get_client('ec2', 'us-east-1').describe_vpcs()
+        get_resource('ec2', 'us-east-1').meta
+    results = {}
+    config_path = config.CONFIG_PATH
+    for make_scenario in scenarios:
+        workdir = tempfile.mkdtemp(prefix='nsp-bench-')
+        shutil.copy(os.path.join(config_path, 'constants.yaml'), workdir)
+        config.CONFIG_PATH = os.path.join(workdir, '')
+        try:
+            with mock_aws(), _one_request_at_a_time():
+                scenario = make_scenario()
+                started = time.perf_counter()
+                results[scenario.name] = {phase.name: _run_phase(phase, recorder) for phase in scenario.phases}
+                logger.info(f'Benchmark {scenario.name} done in {time.perf_counter() - started:.2f}s')
+        finally:
+            config.flush_config()
+            config.CONFIG_PATH = config_path
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _flow_calls(result: dict) -> int:
+    return result['api_calls'] - result.get('poll_calls', 0)
+
+
+def compare(results: Dict[str, Dict[str, dict]], baseline: Dict[str, Dict[str, dict]],
+            tolerance: float = DEFAULT_TOLERANCE) -> Tuple[List[str], List[str]]:
+    # API calls other than the waiters' polls are deterministic, so any increase is a regression; how many polls
+    # a wait takes is down to timing, so they are only reported. Wall time is a regression beyond the tolerance.
+    lines, regressions = [], []
+    for scenario, phases in results.items():
+        for name, result in phases.items():
+            before = baseline.get(scenario, {}).get(name)
+            if before is None:
+                lines.append(f'{scenario}/{name}: no baseline')
+                continue
+            made, made_before = _flow_calls(result), _flow_calls(before)
+            calls = made - made_before
+            wall = result['wall_s'] - before['wall_s']
+            ratio = result['wall_s'] / before['wall_s'] if before['wall_s'] else 1.0
+            line = (f'{scenario}/{name}: {result["wall_s"]:.3f}s vs {before["wall_s"]:.3f}s ({ratio - 1:+.0%}), '
+                    f'{made} vs {made_before} calls ({calls:+d}), '
+                    f'{result.get("poll_calls", 0)} vs {before.get("poll_calls", 0)} polls')
+            lines.append(line)
+            if calls > 0 or (ratio > 1 + tolerance and wall > MIN_WALL_DELTA) or \
+                    (result['status'] != 'ok' and before['status'] == 'ok'):
+                regressions.append(line if result['status'] == 'ok' else f'{line}, {result["status"]}')
+    return lines, regressions
+
+
+def report(results: Dict[str, Dict[str, dict]]) -> str:
+    lines = [f'{"scenario/phase":<28} {"status":<10} {"wall s":>8} {"calls":>6} {"polls":>6} {"planned":>8} '
+             f'{"depth":>6}']
+    for scenario, phases in results.items():
+        for name, result in phases.items():
+            lines.append(f'{scenario + "/" + name:<28} {result["status"]:<10.10} {result["wall_s"]:>8.3f} '
+                         f'{result["api_calls"]:>6} {result["poll_calls"]:>6} {result["planned_api_calls"] or "-":>8} '
+                         f'{result["critical_path"] or "-":>6}')
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the provisioning and teardown flows against an '
+                                                 'in-process EC2 (moto), without AWS credentials or network')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help=f'seconds added to every API call (default {DEFAULT_LATENCY})')
+    parser.add_argument('--spokes', type=int, nargs='*', default=list(DEFAULT_SPOKES),
+                        help='sizes of the synthetic hub-and-spoke topologies to run')
+    parser.add_argument('--scenarios', nargs='*', default=['intra_region', 'inter_region', 'spokes'],
+                        choices=['intra_region', 'inter_region', 'spokes'])
+    parser.add_argument('--describe-cache', action='store_true',
+                        help='answer repeated describe calls from memory, as the run scripts do by default')
+    parser.add_argument('--output', metavar='FILE', help='write the results as JSON to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against results stored in FILE')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'allowed relative wall time increase over the baseline (default {DEFAULT_TOLERANCE})')
+    args = parser.parse_args(argv)
+
+    scenarios: List[Callable[[], Scenario]] = []
+    if 'intra_region' in args.scenarios:
+        scenarios.append(intra_region_scenario)
+    if 'inter_region' in args.scenarios:
+        scenarios.append(inter_region_scenario)
+    if 'spokes' in args.scenarios:
+        scenarios.extend((lambda n=n: spoke_scenario(n)) for n in args.spokes)
+
+    if args.describe_cache:
+        from utils.describe_cache import enable_describe_cache
+        enable_describe_cache()
+    results = run_scenarios(scenarios, args.latency)
+    print(report(results))
+    settings = {'latency': args.latency}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings:
+        logger.warning(f'Baseline was recorded with {baseline.get("settings")}, this run used {settings}')
+    lines, regressions = compare(results, baseline['results'], args.tolerance)
+    print('\n'.join(['', 'Against the baseline:'] + lines))
+    if regressions:
+        print('\n'.join(['', 'Regressions:'] + regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
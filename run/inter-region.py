@@ -1,206 +1,197 @@
 import logging
-import time
-
-import boto3
+import sys
+from typing import Optional, TextIO
 
 from services.ec2 import create_security_group, create_ec2
-from services.transit_gateways import create_transit_gateway, create_transit_gateway_attachments, create_route_with_tgw, \
-    create_transit_gateway_peering_connection, accept_tgw_peering_connection, describe_transit_gateway_attachment, \
-    create_tgw_route_with_peering_attachment
+from services.inventory import step_journal
+from services.routes import TGW_ROUTE_TARGET, Route, reconcile_tgw_routes, reconcile_vpc_routes, route_state_keys
+from services.transit_gateways import create_transit_gateway, create_transit_gateway_attachments, \
+    create_transit_gateway_peering_connection, accept_tgw_peering_connection, wait_for_tgw, wait_for_tgw_attachment, \
+    AttachmentWatch
 from services.vpc import create_vpc, create_subnet, create_internet_gateways, attach_vpc_with_ig, \
-    find_existing_route_tables, create_route_with_igw, create_routing_table_associate
+    find_existing_route_tables, create_routing_table_associate
+from utils.clients import get_client, get_resource, offline_clients
+from utils.constants import InterRegionConstants
+from utils.engine import ProvisioningEngine
+from utils.plan import Plan, plan_phases, add_plan_arguments, print_plans
+from utils.startup import apply_startup_args, startup_parser
 from utils.utils import fetch_constants
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s: %(levelname)s: %(message)s')
 
-us_east_1_resource = boto3.resource('ec2', region_name='us-east-1')
-us_west_1_resource = boto3.resource('ec2', region_name='us-west-1')
-
-us_east_1_client = boto3.client('ec2', region_name='us-east-1')
-us_west_1_client = boto3.client('ec2', region_name='us-west-1')
-
-
-def create_vpcs(section, constants):
-    IP_CIDR1 = constants['IP_CIDR1']
-    IP_CIDR2 = constants['IP_CIDR2']
-    VPC1 = constants['VPC1']
-    VPC2 = constants['VPC2']
-
-    SUBNET_CIDR11 = constants['SUBNET_CIDR11']
-    SUBNET_CIDR12 = constants['SUBNET_CIDR12']
-    SUBNET_CIDR21 = constants['SUBNET_CIDR21']
-    SUBNET1_VPC1 = constants['SUBNET1_VPC1']
-    SUBNET2_VPC1 = constants['SUBNET2_VPC1']
-    SUBNET1_VPC2 = constants['SUBNET1_VPC2']
-
-    REGION1_AZ = constants['REGION1_AZ']
-    REGION2_AZ = constants['REGION2_AZ']
-
-    IGW = constants['IGW']
-
-    VPC1_PUB_ROUTE_TABLE = constants['VPC1_PUB_ROUTE_TABLE']
-    VPC2_PRI_ROUTE_TABLE = constants['VPC2_PRI_ROUTE_TABLE']
-    VPC1_PRI_ROUTE_TABLE = constants['VPC1_PRI_ROUTE_TABLE']
-    vpc_1 = create_vpc(resource=us_east_1_resource, name=VPC1, ip_cidr=IP_CIDR1, filename=section, persist=True)
-    vpc_2 = create_vpc(resource=us_west_1_resource, name=VPC2, ip_cidr=IP_CIDR2, filename=section, persist=True)
 
-    logger.info('Creating Subnets:')
-    subnet1_vpc_1 = create_subnet(resource=us_east_1_resource, subnet_name=SUBNET1_VPC1, subnet_ip_cidr=SUBNET_CIDR11,
-                                  vpc_name=VPC1,
-                                  az=REGION1_AZ,
+def vpc_steps(section, constants: InterRegionConstants) -> ProvisioningEngine:
+    region1_resource = get_resource('ec2', constants.region1)
+    region2_resource = get_resource('ec2', constants.region2)
+    engine = ProvisioningEngine(filename=section, journal=step_journal(section))
+    engine.add(create_vpc, constants.region1, resource=region1_resource, name=constants.vpc1,
+               ip_cidr=constants.ip_cidr1, filename=section, persist=True)
+    engine.add(create_vpc, constants.region2, resource=region2_resource, name=constants.vpc2,
+               ip_cidr=constants.ip_cidr2, filename=section, persist=True)
+
+    engine.add(create_subnet, constants.region1, resource=region1_resource, subnet_name=constants.subnet1_vpc1,
+               subnet_ip_cidr=constants.subnet_cidr11, vpc_name=constants.vpc1, az=constants.region1_az,
+               filename=section, persist=True)
+    engine.add(create_subnet, constants.region1, resource=region1_resource, subnet_name=constants.subnet2_vpc1,
+               subnet_ip_cidr=constants.subnet_cidr12, vpc_name=constants.vpc1, az=constants.region1_az,
+               filename=section, persist=True)
+    engine.add(create_subnet, constants.region2, resource=region2_resource, subnet_name=constants.subnet1_vpc2,
+               subnet_ip_cidr=constants.subnet_cidr21, vpc_name=constants.vpc2, az=constants.region2_az,
+               filename=section, persist=True)
+
+    engine.add(create_internet_gateways, constants.region1, resource=region1_resource, ig_name=constants.igw,
+               filename=section, persist=True)
+    attach_igw = engine.add(attach_vpc_with_ig, constants.region1, resource=region1_resource, vpc=constants.vpc1,
+                            igw=constants.igw, filename=section)
+
+    # the main route table has to be picked up before a second route table exists in VPC1
+    vpc1_main_route_table = engine.add(find_existing_route_tables, constants.region1, resource=region1_resource,
+                                       route_table_name=constants.vpc1_pub_route_table, vpc=constants.vpc1,
+                                       filename=section, persist=True)
+    engine.add(find_existing_route_tables, constants.region2, resource=region2_resource,
+               route_table_name=constants.vpc2_pri_route_table, vpc=constants.vpc2, filename=section, persist=True)
+
+    igw_routes = {constants.vpc1_pub_route_table: (Route('0.0.0.0/0', constants.igw, 'GatewayId'),)}
+    engine.add(reconcile_vpc_routes, constants.region1, label=f'reconcile internet routes in {constants.region1}',
+               inputs=route_state_keys(igw_routes), after=[attach_igw],
+               client=get_client('ec2', constants.region1), routes=igw_routes, filename=section)
+
+    engine.add(create_routing_table_associate, constants.region1, after=[vpc1_main_route_table],
+               resource=region1_resource, route_table_name=constants.vpc1_pri_route_table, vpc=constants.vpc1,
+               subnet=constants.subnet2_vpc1, filename=section, persist=True)
+    return engine
+
+
+def create_vpcs(section, constants: InterRegionConstants):
+    vpc_steps(section, constants).run()
+
+
+def tgw_steps(section, constants: InterRegionConstants) -> ProvisioningEngine:
+    region1_client = get_client('ec2', constants.region1)
+    region2_client = get_client('ec2', constants.region2)
+    engine = ProvisioningEngine(filename=section, journal=step_journal(section))
+    engine.add(create_transit_gateway, constants.region1, client=region1_client, tgw_name=constants.tgw_1,
+               tgw_route_table=constants.tgw_1_route_table, filename=section, persist=True)
+    engine.add(create_transit_gateway, constants.region2, client=region2_client, tgw_name=constants.tgw_2,
+               tgw_route_table=constants.tgw_2_route_table, filename=section, persist=True)
+    tgw_1_ready = engine.add(wait_for_tgw, constants.region1, client=region1_client, tgw=constants.tgw_1,
+                             filename=section)
+    tgw_2_ready = engine.add(wait_for_tgw, constants.region2, client=region2_client, tgw=constants.tgw_2,
+                             filename=section)
+
+    engine.add(create_transit_gateway_peering_connection, constants.region1, after=[tgw_1_ready, tgw_2_ready],
+               client=region1_client, tgw_peer_name=constants.tgw_peer_connect, tgw_1=constants.tgw_1,
+               tgw_2=constants.tgw_2, tgw_2_region=constants.region2, filename=section, persist=True)
+    peering_pending = engine.add(AttachmentWatch(('pendingAcceptance', 'available')), constants.region1,
+                                 label=f'wait for {constants.tgw_peer_connect} acceptance', client=region1_client,
+                                 tgw_attachment=constants.tgw_peer_connect, filename=section)
+    peering_accepted = engine.add(accept_tgw_peering_connection, constants.region2, after=[peering_pending],
+                                  client=region2_client, tgw_peer_connect=constants.tgw_peer_connect,
                                   filename=section, persist=True)
-    subnet2_vpc_1 = create_subnet(resource=us_east_1_resource, subnet_name=SUBNET2_VPC1, subnet_ip_cidr=SUBNET_CIDR12,
-                                  vpc_name=VPC1,
-                                  az=REGION1_AZ,
-                                  filename=section, persist=True)
-    subnet1_vpc_2 = create_subnet(resource=us_west_1_resource, subnet_name=SUBNET1_VPC2, subnet_ip_cidr=SUBNET_CIDR21,
-                                  vpc_name=VPC2,
-                                  az=REGION2_AZ,
-                                  filename=section, persist=True)
-
-    logger.info('Creating Internet Gateway')
-    ig = create_internet_gateways(resource=us_east_1_resource, ig_name=IGW, filename=section, persist=True)
-    attach_vpc_with_ig(resource=us_east_1_resource, vpc=VPC1, igw=IGW, filename=section)
-
-    find_existing_route_tables(resource=us_east_1_resource, route_table_name=VPC1_PUB_ROUTE_TABLE, vpc=VPC1,
-                               filename=section,
-                               persist=True)
-    find_existing_route_tables(resource=us_west_1_resource, route_table_name=VPC2_PRI_ROUTE_TABLE, vpc=VPC2,
-                               filename=section,
-                               persist=True)
-
-    create_route_with_igw(resource=us_east_1_resource, igw=IGW, route_table=VPC1_PUB_ROUTE_TABLE,
-                          destination_ip_cidr='0.0.0.0/0',
-                          filename=section)
-
-    logger.info('Creating private routing table')
-    private_route_table_vpc_1 = create_routing_table_associate(resource=us_east_1_resource,
-                                                               route_table_name=VPC1_PRI_ROUTE_TABLE,
-                                                               vpc=VPC1,
-                                                               subnet=SUBNET2_VPC1,
-                                                               filename=section,
-                                                               persist=True)
-
-
-def create_tgw(section, constants):
-    TGW_1 = constants['TGW_1']
-    TGW_2 = constants['TGW_2']
-    REGION1 = constants['REGION1']
-    REGION2 = constants['REGION2']
-    TGW_PEER_CONNECT = constants['TGW_PEER_CONNECT']
-    TGW_ATTACH_VPC1 = constants['TGW_ATTACH_VPC1']
-    TGW_ATTACH_VPC2 = constants['TGW_ATTACH_VPC2']
-
-    IP_CIDR1 = constants['IP_CIDR1']
-    IP_CIDR2 = constants['IP_CIDR2']
-    VPC1 = constants['VPC1']
-    VPC2 = constants['VPC2']
-
-    SUBNET1_VPC1 = constants['SUBNET1_VPC1']
-    SUBNET2_VPC1 = constants['SUBNET2_VPC1']
-    SUBNET1_VPC2 = constants['SUBNET1_VPC2']
-
-    TGW_1_ROUTE_TABLE = constants['TGW_1_ROUTE_TABLE']
-    TGW_2_ROUTE_TABLE = constants['TGW_2_ROUTE_TABLE']
-
-    VPC2_PRI_ROUTE_TABLE = constants['VPC2_PRI_ROUTE_TABLE']
-    VPC1_PRI_ROUTE_TABLE = constants['VPC1_PRI_ROUTE_TABLE']
-
-    create_transit_gateway(client=us_east_1_client, tgw_name=TGW_1, tgw_route_table=TGW_1_ROUTE_TABLE, filename=section,
-                           persist=True)
-    create_transit_gateway(client=us_west_1_client, tgw_name=TGW_2, tgw_route_table=TGW_2_ROUTE_TABLE, filename=section,
-                           persist=True)
-    time.sleep(20)
-
-    tga = create_transit_gateway_peering_connection(client=us_east_1_client,
-                                                    tgw_peer_name=TGW_PEER_CONNECT,
-                                                    tgw_1=TGW_1, tgw_2=TGW_2,
-                                                    tgw_2_region=REGION2, filename=section, persist=True)
-
-    while True:
-        desc = describe_transit_gateway_attachment(client=us_east_1_client,
-                                                   tgw_peer_name=TGW_PEER_CONNECT,
-                                                   filename=section, persist=True)
-        if desc['TransitGatewayAttachments'][0]['State'] == 'pendingAcceptance':
-            break
-        time.sleep(10)
-
-    accept_tgw_peering_connection(client=us_west_1_client, tgw_peer_connect=TGW_PEER_CONNECT, filename=section,
-                                  persist=True)
-    while True:
-        desc = describe_transit_gateway_attachment(client=us_west_1_client,
-                                                   tgw_peer_name=TGW_PEER_CONNECT,
-                                                   filename=section, persist=True)
-        if desc['TransitGatewayAttachments'][0]['State'] == 'available':
-            break
-        time.sleep(10)
-
-    create_transit_gateway_attachments(client=us_east_1_client, tgw_attachment_name=TGW_ATTACH_VPC1,
-                                       tgw=TGW_1, vpc=VPC1, subnet=SUBNET2_VPC1, filename=section, persist=True)
-    create_transit_gateway_attachments(client=us_west_1_client, tgw_attachment_name=TGW_ATTACH_VPC2,
-                                       tgw=TGW_2, vpc=VPC2, subnet=SUBNET1_VPC2, filename=section, persist=True)
-
-    create_route_with_tgw(client=us_east_1_resource, tgw=TGW_1, vpc_network=IP_CIDR2, route_table=VPC1_PRI_ROUTE_TABLE,
-                          filename=section)
-    create_route_with_tgw(client=us_west_1_resource, tgw=TGW_2, vpc_network=IP_CIDR1, route_table=VPC2_PRI_ROUTE_TABLE,
-                          filename=section)
-
-    create_tgw_route_with_peering_attachment(client=us_east_1_client, tgw_route_table=TGW_1_ROUTE_TABLE, vpc_network=IP_CIDR2,
-                                             tgw_peer_connect=TGW_PEER_CONNECT, filename=section)
-
-    create_tgw_route_with_peering_attachment(client=us_west_1_client, tgw_route_table=TGW_2_ROUTE_TABLE, vpc_network=IP_CIDR1,
-                                             tgw_peer_connect=TGW_PEER_CONNECT, filename=section)
-
-
-def create_vms(section, constants):
-    VPC1 = constants['VPC1']
-    VPC2 = constants['VPC2']
-
-    SUBNET1_VPC1 = constants['SUBNET1_VPC1']
-    SUBNET2_VPC1 = constants['SUBNET2_VPC1']
-    SUBNET1_VPC2 = constants['SUBNET1_VPC2']
-
-    EC2_PUB_1_VPC1 = constants['EC2_PUB_1_VPC1']
-    EC2_PRI_2_VPC1 = constants['EC2_PRI_2_VPC1']
-    EC2_PRI_1_VPC2 = constants['EC2_PRI_1_VPC2']
-
-    US_EAST_1_IMAGE = constants['US_EAST_1_IMAGE']
-    US_WEST_1_IMAGE = constants['US_WEST_1_IMAGE']
-
-    SG_PUB_1_VPC1 = constants['SG_PUB_1_VPC1']
-    SG_PRI_2_VPC1 = constants['SG_PRI_2_VPC1']
-    SG_PRI_1_VPC2 = constants['SG_PRI_1_VPC2']
-
-    create_security_group(client=us_east_1_client, group_name=SG_PUB_1_VPC1, ec2_name=EC2_PUB_1_VPC1, vpc=VPC1,
-                          filename=section,
-                          persist=True)
-    create_security_group(client=us_east_1_client, group_name=SG_PRI_2_VPC1, ec2_name=EC2_PRI_2_VPC1, vpc=VPC1,
-                          filename=section,
-                          persist=True)
-    create_security_group(client=us_west_1_client, group_name=SG_PRI_1_VPC2, ec2_name=EC2_PRI_1_VPC2, vpc=VPC2,
-                          filename=section,
-                          persist=True)
-
-    create_ec2(client=us_east_1_resource,
-               ec2_name=EC2_PUB_1_VPC1, subnet=SUBNET1_VPC1, security_group=SG_PUB_1_VPC1, keypair='defaultvpc_instance1',enable_public_ip=True,
-               image=US_EAST_1_IMAGE,
+    peering_ready = engine.add(AttachmentWatch(), constants.region2,
+                               label=f'wait for {constants.tgw_peer_connect}', after=[peering_accepted],
+                               client=region2_client, tgw_attachment=constants.tgw_peer_connect, filename=section)
+
+    engine.add(create_transit_gateway_attachments, constants.region1, after=[tgw_1_ready], client=region1_client,
+               tgw_attachment_name=constants.tgw_attach_vpc1, tgw=constants.tgw_1, vpc=constants.vpc1,
+               subnet=constants.subnet2_vpc1, filename=section, persist=True)
+    engine.add(create_transit_gateway_attachments, constants.region2, after=[tgw_2_ready], client=region2_client,
+               tgw_attachment_name=constants.tgw_attach_vpc2, tgw=constants.tgw_2, vpc=constants.vpc2,
+               subnet=constants.subnet1_vpc2, filename=section, persist=True)
+    attach_vpc1_ready = engine.add(wait_for_tgw_attachment, constants.region1, client=region1_client,
+                                   tgw_attachment=constants.tgw_attach_vpc1, filename=section)
+    attach_vpc2_ready = engine.add(wait_for_tgw_attachment, constants.region2, client=region2_client,
+                                   tgw_attachment=constants.tgw_attach_vpc2, filename=section)
+
+    # one reconcile step per region and kind of route table, each reading its tables once
+    for region, client, attach_ready, routes in (
+            (constants.region1, region1_client, attach_vpc1_ready,
+             {constants.vpc1_pri_route_table: (Route(constants.ip_cidr2, constants.tgw_1),)}),
+            (constants.region2, region2_client, attach_vpc2_ready,
+             {constants.vpc2_pri_route_table: (Route(constants.ip_cidr1, constants.tgw_2),)})):
+        engine.add(reconcile_vpc_routes, region, label=f'reconcile routes to transit gateways in {region}',
+                   inputs=route_state_keys(routes), after=[attach_ready], client=client, routes=routes,
+                   filename=section)
+
+    for region, client, routes in (
+            (constants.region1, region1_client, {constants.tgw_1_route_table: (
+                Route(constants.ip_cidr2, constants.tgw_peer_connect, TGW_ROUTE_TARGET),)}),
+            (constants.region2, region2_client, {constants.tgw_2_route_table: (
+                Route(constants.ip_cidr1, constants.tgw_peer_connect, TGW_ROUTE_TARGET),)})):
+        engine.add(reconcile_tgw_routes, region, label=f'reconcile transit gateway routes in {region}',
+                   inputs=route_state_keys(routes), after=[peering_ready], client=client, routes=routes,
+                   filename=section)
+    return engine
+
+
+def create_tgw(section, constants: InterRegionConstants):
+    tgw_steps(section, constants).run()
+
+
+def vm_steps(section, constants: InterRegionConstants, instance_stream: Optional[TextIO] = None) -> ProvisioningEngine:
+    region1_resource = get_resource('ec2', constants.region1)
+    region2_resource = get_resource('ec2', constants.region2)
+    region1_client = get_client('ec2', constants.region1)
+    region2_client = get_client('ec2', constants.region2)
+    engine = ProvisioningEngine(filename=section, journal=step_journal(section))
+    engine.add(create_security_group, constants.region1, client=region1_client,
+               group_name=constants.sg_pub_1_vpc1, ec2_name=constants.ec2_pub_1_vpc1, vpc=constants.vpc1,
+               filename=section, persist=True)
+    engine.add(create_security_group, constants.region1, client=region1_client,
+               group_name=constants.sg_pri_2_vpc1, ec2_name=constants.ec2_pri_2_vpc1, vpc=constants.vpc1,
+               filename=section, persist=True)
+    engine.add(create_security_group, constants.region2, client=region2_client,
+               group_name=constants.sg_pri_1_vpc2, ec2_name=constants.ec2_pri_1_vpc2, vpc=constants.vpc2,
+               filename=section, persist=True)
+
+    engine.add(create_ec2, constants.region1, client=region1_resource,
+               ec2_name=constants.ec2_pub_1_vpc1, subnet=constants.subnet1_vpc1,
+               security_group=constants.sg_pub_1_vpc1,
+               keypair='defaultvpc_instance1', enable_public_ip=True,
+               image=constants.us_east_1_image,
                filename=section,
-               persist=True)
-    create_ec2(client=us_east_1_resource,
-               ec2_name=EC2_PRI_2_VPC1, subnet=SUBNET2_VPC1, security_group=SG_PRI_2_VPC1, keypair='defaultvpc_instance1', enable_public_ip=False,
-               image=US_EAST_1_IMAGE,
+               persist=True,
+               count=constants.instance_count,
+               instance_type=constants.instance_type,
+               stream=instance_stream)
+    engine.add(create_ec2, constants.region1, client=region1_resource,
+               ec2_name=constants.ec2_pri_2_vpc1, subnet=constants.subnet2_vpc1,
+               security_group=constants.sg_pri_2_vpc1,
+               keypair='defaultvpc_instance1', enable_public_ip=False,
+               image=constants.us_east_1_image,
                filename=section,
-               persist=True)
-    create_ec2(client=us_west_1_resource,
-               ec2_name=EC2_PRI_1_VPC2, subnet=SUBNET1_VPC2, security_group=SG_PRI_1_VPC2, keypair=None, enable_public_ip=False,
-               image=US_WEST_1_IMAGE,
+               persist=True,
+               count=constants.instance_count,
+               instance_type=constants.instance_type,
+               stream=instance_stream)
+    engine.add(create_ec2, constants.region2, client=region2_resource,
+               ec2_name=constants.ec2_pri_1_vpc2, subnet=constants.subnet1_vpc2,
+               security_group=constants.sg_pri_1_vpc2,
+               keypair=None, enable_public_ip=False,
+               image=constants.us_west_1_image,
                filename=section,
-               persist=True)
+               persist=True,
+               count=constants.instance_count,
+               instance_type=constants.instance_type,
+               stream=instance_stream)
+    return engine
+
+
+def create_vms(section, constants: InterRegionConstants, instance_stream: Optional[TextIO] = None):
+    vm_steps(section, constants, instance_stream=instance_stream).run()
+
+
+def plan_inter_region(section: str = 'inter_region') -> Plan:
+    # all three phases, worked out from constants.yaml and the state file without calling AWS
+    constants = fetch_constants(section=section)
+    with offline_clients():
+        return plan_phases(section, [vpc_steps(section, constants), tgw_steps(section, constants),
+                                     vm_steps(section, constants)])
 
 
-def run_inter_region():
+def run_inter_region(instance_stream: Optional[TextIO] = None):
     section = 'inter_region'
     constants = fetch_constants(section=section)
 
@@ -221,9 +212,23 @@ def run_inter_region():
         return
 
     logger.info('Starting EC2 and rules creation')
-    create_vms(section, constants)
+    create_vms(section, constants, instance_stream=instance_stream)
     logger.info('Created EC2 and routes. Go ahead and test it out')
 
 
 if __name__ == '__main__':
-    run_inter_region()
+    parser = startup_parser('Bring up the inter-region scenario')
+    parser.add_argument('--instances-out', metavar='FILE',
+                        help='write launched instance ids as JSON lines to FILE (- for stdout)')
+    add_plan_arguments(parser)
+    args = parser.parse_args()
+    apply_startup_args(args, __file__)
+    if args.plan:
+        print_plans([plan_inter_region()], args.plan_json)
+    elif args.instances_out == '-':
+        run_inter_region(instance_stream=sys.stdout)
+    elif args.instances_out:
+        with open(args.instances_out, 'a') as instance_stream:
+            run_inter_region(instance_stream=instance_stream)
+    else:
+        run_inter_region()
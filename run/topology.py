@@ -0,0 +1,107 @@
+import logging
+import sys
+import time
+from typing import Sequence
+
+from services.teardown import TeardownError
+from services.topology import provisioning_plan, teardown_plan
+from utils.clients import offline_clients
+from utils.plan import Plan, add_plan_arguments, print_plans
+from utils.reachability import check_topology, parse_probe, report
+from utils.startup import apply_startup_args, startup_parser
+from utils.tags import environment
+from utils.topology import load_topology
+from utils.utils import CONFIG_PATH, load_config
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+def run_topology(name: str, spec: str, destroy: bool = False, instance_stream=None):
+    topology = load_topology(spec, name, persist=not destroy)
+    if destroy:
+        try:
+            teardown_plan(topology).run()
+        except TeardownError as e:
+            logging.exception(f'Nevermind - {e}')
+        return
+    provisioning_plan(topology, instance_stream=instance_stream).run()
+    logger.info(f'Created {name}. Go ahead and test it out')
+
+
+def run_topologies_async(names: Sequence[str], spec: str, destroy: bool = False, instance_stream=None):
+    # every topology on one event loop, with its steps as tasks instead of threads
+    from utils.aio import run_concurrently
+    topologies = [load_topology(spec, name, persist=not destroy) for name in names]
+    engines = [teardown_plan(topology, asynchronous=True) if destroy else
+               provisioning_plan(topology, instance_stream=instance_stream, asynchronous=True)
+               for topology in topologies]
+    for name, outcome in zip(names, run_concurrently(engines, return_exceptions=True)):
+        if isinstance(outcome, TeardownError):
+            logger.error(f'Nevermind - {name}: {outcome}')
+        elif isinstance(outcome, BaseException):
+            logger.error(f'Could not {"tear down" if destroy else "create"} {name}: {outcome}')
+        else:
+            logger.info(f'{"Tore down" if destroy else "Created"} {name}')
+
+
+def run_topologies(names: Sequence[str], spec: str, destroy: bool = False, asynchronous: bool = False,
+                   instance_stream=None):
+    if asynchronous:
+        run_topologies_async(names, spec, destroy, instance_stream=instance_stream)
+        return
+    for name in names:
+        run_topology(name, spec, destroy, instance_stream=instance_stream)
+
+
+def plan_topology(name: str, spec: str, destroy: bool = False) -> Plan:
+    topology = load_topology(spec, name)
+    with offline_clients():
+        return (teardown_plan(topology) if destroy else provisioning_plan(topology)).plan()
+
+
+def check_reachability(name: str, spec: str, live: bool = False, probe: str = 'icmp', verbose: bool = False) -> str:
+    # from the spec, before anything is created, or from what the topology has in AWS now
+    topology = load_topology(spec, name)
+    if not live:
+        model, verdicts, elapsed = check_topology(topology, probe)
+        return report(model, verdicts, probe, elapsed, verbose)
+    from services.reachability import snapshot_model
+    model = snapshot_model(environment(name), topology.regions, load_config(filename=name))
+    started = time.perf_counter()
+    verdicts = model.matrix(*parse_probe(probe))
+    return report(model, verdicts, probe, time.perf_counter() - started, verbose)
+
+
+if __name__ == '__main__':
+    parser = startup_parser('Bring up or tear down a topology described in config/topologies.yaml')
+    parser.add_argument('names', nargs='+', metavar='name', help='topologies to act on')
+    parser.add_argument('--spec', default=CONFIG_PATH + 'topologies.yaml', help='topology spec file')
+    parser.add_argument('--destroy', action='store_true', help='tear the topology down instead')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run on aiobotocore, all topologies side by side on one event loop '
+                             '(pip install -r requirements-async.txt)')
+    parser.add_argument('--instances-out', metavar='FILE',
+                        help='write launched instance ids as JSON lines to FILE (- for stdout)')
+    parser.add_argument('--reachability', nargs='?', const='spec', choices=('spec', 'live'),
+                        help='check which instance groups can reach each other and by which hops, from the spec '
+                             '(no AWS calls) or from a snapshot of what is deployed (live), and exit')
+    parser.add_argument('--probe', default='icmp', metavar='PROTOCOL[:PORT]',
+                        help='the traffic --reachability checks for, e.g. tcp:22 (default icmp)')
+    parser.add_argument('--verbose', action='store_true', help='with --reachability, list reachable pairs too')
+    add_plan_arguments(parser)
+    args = parser.parse_args()
+    apply_startup_args(args, __file__)
+    if args.reachability:
+        for name in args.names:
+            print(check_reachability(name, args.spec, args.reachability == 'live', args.probe, args.verbose))
+    elif args.plan:
+        print_plans([plan_topology(name, args.spec, args.destroy) for name in args.names], args.plan_json)
+    elif args.instances_out == '-':
+        run_topologies(args.names, args.spec, args.destroy, args.asyncio, instance_stream=sys.stdout)
+    elif args.instances_out:
+        with open(args.instances_out, 'a') as instance_stream:
+            run_topologies(args.names, args.spec, args.destroy, args.asyncio, instance_stream=instance_stream)
+    else:
+        run_topologies(args.names, args.spec, args.destroy, args.asyncio)
@@ -0,0 +1,22 @@
+import logging
+
+from services.aio.teardown import AsyncTeardownEngine
+from services.cleanup import inter_region_teardown, intra_region_teardown
+from services.teardown import TeardownError
+
+# The asyncio variants of the services.cleanup wrappers; the clients are async EC2 clients
+# (utils.aio.get_async_client) and the teardown graphs are the same.
+
+
+async def cleanup_intra_region(section: str, us_east_1_client):
+    try:
+        await intra_region_teardown(section, us_east_1_client, AsyncTeardownEngine).run_async()
+    except TeardownError as e:
+        logging.exception(f'Nevermind - {e}')
+
+
+async def cleanup_inter_region(section, us_east_1_client, us_west_1_client):
+    try:
+        await inter_region_teardown(section, us_east_1_client, us_west_1_client, AsyncTeardownEngine).run_async()
+    except TeardownError as e:
+        logging.exception(f'Nevermind - {e}')
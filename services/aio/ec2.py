@@ -0,0 +1,116 @@
+import logging
+from typing import List, Optional, Sequence, TextIO, Union
+
+from botocore.exceptions import ClientError
+
+from services.ec2 import DEFAULT_INSTANCE_TYPE, _missing_rules, _stream_instances
+from services.inventory import name_index
+from services.security_groups import DEFAULT_RULES, ip_permissions
+from utils.engine import state_keys
+from utils.rules import Rule
+from utils.tags import tag_specifications
+from utils.utils import store_config, load_config
+
+# The asyncio variants of services.ec2, with the same names and arguments; `client` is an async EC2 client,
+# also where the threaded function takes a resource.
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+async def delete_security_group(client, group_id):
+    try:
+        response = await client.delete_security_group(GroupId=group_id)
+    except ClientError:
+        logger.exception('Could not delete security group')
+    else:
+        return response
+
+
+async def delete_ec2(client, instance_id: Union[str, List[str]]):
+    # fleet launches persist a list of ids under one name
+    instance_ids = [instance_id] if isinstance(instance_id, str) else list(instance_id)
+    try:
+        response = await client.terminate_instances(InstanceIds=instance_ids)
+    except ClientError:
+        logger.exception(f'Could not delete instances {instance_ids}')
+    else:
+        return response
+
+
+@state_keys(inputs=('vpc',), outputs=('group_name',), api_calls=lambda kwargs: 1 + bool(kwargs.get('rules', True)),
+            get_or_create=True)
+async def create_security_group(client, group_name: str, ec2_name: str, vpc: str, filename: str, persist: bool,
+                                rules: Sequence[Rule] = DEFAULT_RULES):
+    try:
+        vpc_id = load_config(filename=filename, key=vpc)
+        existing = await name_index.find_async(client, 'security_group', group_name, filename,
+                                               matches=lambda item: item['VpcId'] == vpc_id)
+        if existing:
+            security_group = {'GroupId': existing['GroupId']}
+            # a reused group only gets the rules it lacks, going by what it has now: the index only knows what
+            # it held when it was listed or created
+            described = await client.describe_security_groups(GroupIds=[existing['GroupId']])
+            rules = _missing_rules(described['SecurityGroups'][0], rules)
+            logger.info(f'Reusing Security Group {existing["GroupId"]} as {group_name}')
+        else:
+            security_group = await client.create_security_group(
+                Description=f'Automated Security Group created for {ec2_name}',
+                GroupName=group_name,
+                VpcId=vpc_id,
+                TagSpecifications=tag_specifications('security-group', group_name, filename))
+            name_index.add(client, 'security_group', group_name, filename,
+                           {'GroupId': security_group['GroupId'], 'VpcId': vpc_id})
+            logger.info(f'Security Group created: {security_group}')
+        if persist:
+            store_config(value=security_group['GroupId'], key=group_name, filename=filename)
+
+        if rules:
+            security_group_rules = await client.authorize_security_group_ingress(
+                GroupId=security_group['GroupId'], IpPermissions=ip_permissions(rules))
+            logger.info(f'Security Group Rules updated: {security_group_rules}')
+
+    except ClientError:
+        logger.exception('Could not create security group')
+    else:
+        return security_group
+
+
+@state_keys(inputs=('subnet', 'security_group'), outputs=('ec2_name',))
+async def create_ec2(client, ec2_name: str, subnet: str, security_group: str, keypair: Optional[str],
+                     enable_public_ip: bool, image: str, filename: str, persist: bool, count: int = 1,
+                     instance_type: str = DEFAULT_INSTANCE_TYPE, stream: Optional[TextIO] = None):
+    # launches the whole fleet for one subnet in a single call; all ids are persisted under ec2_name as a list
+    subnet_id = load_config(filename=filename, key=subnet)
+    security_group_id = load_config(filename=filename, key=security_group)
+    request = dict(
+        ImageId=image,
+        MinCount=count,
+        MaxCount=count,
+        InstanceType=instance_type,
+        NetworkInterfaces=[
+            {
+                'DeviceIndex': 0,
+                'SubnetId': subnet_id,
+                'Groups': [security_group_id],
+                'AssociatePublicIpAddress': enable_public_ip
+            }
+        ],
+        TagSpecifications=tag_specifications('instance', ec2_name, filename),
+    )
+    if keypair:
+        request['KeyName'] = keypair
+    try:
+        instances = (await client.run_instances(**request))['Instances']
+    except ClientError:
+        logger.exception(f'Could not launch {count} x {instance_type} for {ec2_name}')
+        return
+
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    logger.info(f'Instances launched for {ec2_name}: {instance_ids}')
+    if persist:
+        store_config(value=instance_ids, key=ec2_name, filename=filename)
+    if stream is not None:
+        _stream_instances(stream, ec2_name, subnet_id, instance_ids)
+    return instances
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Mapping, Sequence, Tuple
+
+from botocore.exceptions import ClientError
+
+from services.routes import DEFAULT_ROUTE_WORKERS, Route, RouteChange, RouteMap, RouteReconcileError, \
+    desired_routes, parse_route_tables, parse_tgw_routes, plan_changes, route_count, tgw_change_request, \
+    tgw_routes_request, vpc_change_request
+from utils.engine import state_keys
+
+# The asyncio variants of the route reconcilers in services.routes: the same diff, with the describes and the
+# changes in flight on the event loop instead of a thread pool.
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+async def _vpc_routes(client, route_table_ids: List[str]) -> Dict[str, RouteMap]:
+    paginator = await client.get_paginator('describe_route_tables')
+    route_tables = []
+    async for page in paginator.paginate(RouteTableIds=route_table_ids):
+        route_tables.extend(page['RouteTables'])
+    return parse_route_tables(route_table_ids, route_tables)
+
+
+async def _tgw_routes(client, route_table_ids: List[str]) -> Dict[str, RouteMap]:
+    responses = await asyncio.gather(*(client.search_transit_gateway_routes(**tgw_routes_request(route_table_id))
+                                       for route_table_id in route_table_ids))
+    return {route_table_id: parse_tgw_routes(route_table_id, response)
+            for route_table_id, response in zip(route_table_ids, responses)}
+
+
+async def _apply_changes(client, request: Callable[[RouteChange], Tuple[str, dict]], changes: List[RouteChange],
+                         workers: int):
+    failed: Dict[RouteChange, BaseException] = {}
+    in_flight = asyncio.Semaphore(workers)
+
+    async def run(change: RouteChange):
+        method, arguments = request(change)
+        async with in_flight:
+            try:
+                await getattr(client, method)(**arguments)
+                logger.info(f'Route {change}')
+            except ClientError as e:
+                logger.exception(f'Could not {change}')
+                failed[change] = e
+
+    await asyncio.gather(*(run(change) for change in changes))
+    if failed:
+        raise RouteReconcileError(failed)
+
+
+@state_keys(api_calls=lambda kwargs: 1 + route_count(kwargs))
+async def reconcile_vpc_routes(client, routes: Mapping[str, Sequence[Route]], filename: str, prune: bool = True,
+                               workers: int = DEFAULT_ROUTE_WORKERS) -> List[RouteChange]:
+    desired = desired_routes(routes, filename)
+    changes = plan_changes(desired, await _vpc_routes(client, list(desired)), prune)
+    await _apply_changes(client, vpc_change_request, changes, workers)
+    return changes
+
+
+@state_keys(api_calls=lambda kwargs: len(kwargs['routes']) + route_count(kwargs))
+async def reconcile_tgw_routes(client, routes: Mapping[str, Sequence[Route]], filename: str, prune: bool = True,
+                               workers: int = DEFAULT_ROUTE_WORKERS) -> List[RouteChange]:
+    desired = desired_routes(routes, filename)
+    changes = plan_changes(desired, await _tgw_routes(client, list(desired)), prune)
+    await _apply_changes(client, tgw_change_request, changes, workers)
+    return changes
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Dict, List, Mapping, Sequence
+
+from botocore.exceptions import ClientError
+
+from services.security_groups import DEFAULT_RULE_WORKERS, RuleChange, RuleMap, SecurityGroupReconcileError, \
+    desired_rules, parse_security_groups, plan_rule_changes, rule_change_request
+from utils.engine import state_keys
+from utils.rules import Rule
+
+# The asyncio variant of the security group reconciler in services.security_groups.
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+async def _security_groups(client, group_ids: List[str]) -> RuleMap:
+    paginator = await client.get_paginator('describe_security_groups')
+    security_groups = []
+    async for page in paginator.paginate(GroupIds=group_ids):
+        security_groups.extend(page['SecurityGroups'])
+    return parse_security_groups(group_ids, security_groups)
+
+
+async def _apply_changes(client, changes: List[RuleChange], workers: int):
+    failed: Dict[RuleChange, BaseException] = {}
+    in_flight = asyncio.Semaphore(workers)
+
+    async def run(change: RuleChange):
+        method, arguments = rule_change_request(change)
+        async with in_flight:
+            try:
+                await getattr(client, method)(**arguments)
+                logger.info(f'Security group rules: {change}')
+            except ClientError as e:
+                logger.exception(f'Could not {change}')
+                failed[change] = e
+
+    for action in ('authorize', 'revoke'):
+        await asyncio.gather(*(run(change) for change in changes if change.action == action))
+    if failed:
+        raise SecurityGroupReconcileError(failed)
+
+
+@state_keys(api_calls=lambda kwargs: 1 + len(kwargs['groups']))
+async def reconcile_security_groups(client, groups: Mapping[str, Sequence[Rule]], filename: str, prune: bool = True,
+                                    workers: int = DEFAULT_RULE_WORKERS) -> List[RuleChange]:
+    desired = desired_rules(groups, filename)
+    changes = plan_rule_changes(desired, await _security_groups(client, list(desired)), prune)
+    await _apply_changes(client, changes, workers)
+    return changes
@@ -0,0 +1,114 @@
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from services.aio.waiters import DEFAULT_TIMEOUT, wait_for_instances_terminated, \
+    wait_for_transit_gateway_attachment_deleted, wait_for_transit_gateway_deleted
+from services.teardown import TeardownEngine, TeardownError, _Teardown, _as_list, _error_code, _is_gone
+from utils.aio import DEFAULT_ASYNC_WORKERS_PER_REGION, AsyncProvisioningEngine, run_concurrently
+from utils.engine import ProvisioningError
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+async def _terminate_instances(client, instance_ids, **_):
+    await client.terminate_instances(InstanceIds=_as_list(instance_ids))
+
+
+async def _wait_for_instances_terminated(client, instance_ids):
+    await wait_for_instances_terminated(client, _as_list(instance_ids))
+
+
+async def _delete_tgw_vpc_attachment(client, attachment_id: str, **_):
+    await client.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=attachment_id)
+
+
+async def _delete_tgw_peering_attachment(client, attachment_id: str, **_):
+    await client.delete_transit_gateway_peering_attachment(TransitGatewayAttachmentId=attachment_id)
+
+
+async def _delete_tgw(client, tgw_id: str, **_):
+    await client.delete_transit_gateway(TransitGatewayId=tgw_id)
+
+
+async def _delete_security_group(client, group_id: str, **_):
+    await client.delete_security_group(GroupId=group_id)
+
+
+async def _delete_subnet(client, subnet_id: str, **_):
+    await client.delete_subnet(SubnetId=subnet_id)
+
+
+async def _delete_route_table(client, rt_id: str, **_):
+    response = await client.describe_route_tables(RouteTableIds=[rt_id])
+    for route_table in response['RouteTables']:
+        for association in route_table.get('Associations', []):
+            if not association.get('Main'):
+                await client.disassociate_route_table(AssociationId=association['RouteTableAssociationId'])
+    await client.delete_route_table(RouteTableId=rt_id)
+
+
+async def _delete_igw(client, igw_id: str, vpc_id: Optional[str] = None, **_):
+    if vpc_id:
+        try:
+            await client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+        except ClientError as e:
+            if not _is_gone(_error_code(e)):
+                raise
+    await client.delete_internet_gateway(InternetGatewayId=igw_id)
+
+
+async def _delete_vpc(client, vpc_id: str, **_):
+    await client.delete_vpc(VpcId=vpc_id)
+
+
+# the same kinds as services.teardown.RESOURCE_KINDS, as coroutines
+RESOURCE_KINDS: Dict[str, Tuple[Callable, Optional[Callable]]] = {
+    'instances': (_terminate_instances, _wait_for_instances_terminated),
+    'tgw_vpc_attachment': (_delete_tgw_vpc_attachment, wait_for_transit_gateway_attachment_deleted),
+    'tgw_peering_attachment': (_delete_tgw_peering_attachment, wait_for_transit_gateway_attachment_deleted),
+    'tgw': (_delete_tgw, wait_for_transit_gateway_deleted),
+    'security_group': (_delete_security_group, None),
+    'subnet': (_delete_subnet, None),
+    'route_table': (_delete_route_table, None),
+    'igw': (_delete_igw, None),
+    'vpc': (_delete_vpc, None),
+}
+
+
+class _AsyncTeardown(_Teardown):
+    async def __call__(self):
+        delete, wait = RESOURCE_KINDS[self.kind]
+        if not self.deleted:
+            self._start()
+            try:
+                await delete(self.client, self.resource_id, **self.references)
+            except ClientError as e:
+                self._delete_failed(e)
+            self.deleted = True
+        if wait is not None:
+            await wait(self.client, self.resource_id)
+        self._forget()
+
+
+class AsyncTeardownEngine(TeardownEngine):
+    # The same teardown graph with async EC2 clients (utils.aio.get_async_client), run as tasks on one loop.
+    engine_class = AsyncProvisioningEngine
+    step_class = _AsyncTeardown
+
+    def __init__(self, filename: str, workers_per_region: int = DEFAULT_ASYNC_WORKERS_PER_REGION,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(filename=filename, workers_per_region=workers_per_region, timeout=timeout)
+
+    async def run_async(self):
+        engine = self._prepare()
+        try:
+            return await engine.run_async()
+        except ProvisioningError as e:
+            raise TeardownError(e.failed, e.skipped) from None
+
+    def run(self):
+        return run_concurrently([self])[0]
@@ -0,0 +1,211 @@
+import logging
+import random
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from services import transit_gateways
+from services.aio.waiters import AsyncBatchPoller, wait_for_transit_gateway, wait_for_transit_gateway_attachment
+from services.aio.routes import reconcile_tgw_routes, reconcile_vpc_routes
+from services.inventory import name_index
+from services.routes import TGW_ROUTE_TARGET, Route, RouteReconcileError
+from services.transit_gateways import attaches, owner_account
+from utils.engine import state_keys
+from utils.tags import tag_specifications
+from utils.utils import store_config, load_config
+
+# The asyncio variants of services.transit_gateways, with the same names and arguments; `client` is an async
+# EC2 client, also where the threaded function takes a resource.
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+@state_keys(outputs=('tgw_name', 'tgw_route_table'), get_or_create=True)
+async def create_transit_gateway(client, tgw_name: str, tgw_route_table: str, filename: str, persist: bool):
+    try:
+        existing = await name_index.find_async(client, 'tgw', tgw_name, filename)
+        if existing:
+            tg = {'TransitGateway': existing}
+            logger.info(f'Reusing transit gateway {existing["TransitGatewayId"]} as {tgw_name}')
+        else:
+            tg = await client.create_transit_gateway(
+                Description="Automated Transit gateway created to connect VPCs",
+                Options={
+                    'AmazonSideAsn': random.randrange(64512, 65534),
+                },
+                TagSpecifications=tag_specifications('transit-gateway', tgw_name, filename)
+            )
+            name_index.add(client, 'tgw', tgw_name, filename, tg['TransitGateway'])
+            logger.info(f'Transit gateway created : {tg}')
+        if persist:
+            store_config(value=tg['TransitGateway']['TransitGatewayId'], key=tgw_name, filename=filename)
+            store_config(value=tg['TransitGateway']['Options']['AssociationDefaultRouteTableId'], key=tgw_route_table,
+                         filename=filename)
+    except ClientError:
+        logger.exception('Could not create transit gateway')
+    else:
+        return tg
+
+
+async def delete_transit_gateway(client, tgw_id):
+    try:
+        response = await client.delete_transit_gateway(TransitGatewayId=tgw_id)
+    except ClientError:
+        logger.exception('Could not delete transit gateway')
+    else:
+        return response
+
+
+async def delete_transit_gateway_vpc_attachments(client, tgw_attach_id):
+    try:
+        response = await client.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=tgw_attach_id)
+    except ClientError:
+        logger.exception('Could not delete transit gateway attachment')
+    else:
+        return response
+
+
+async def delete_transit_gateway_peering_attachments(client, tgw_peer_id):
+    try:
+        response = await client.delete_transit_gateway_peering_attachment(TransitGatewayAttachmentId=tgw_peer_id)
+    except ClientError:
+        logger.exception('Could not delete transit gateway peering attachment')
+    else:
+        return response
+
+
+@state_keys(inputs=('tgw', 'vpc', 'subnet'), outputs=('tgw_attachment_name',), get_or_create=True)
+async def create_transit_gateway_attachments(client, tgw_attachment_name: str, tgw: str, vpc: str, subnet: str,
+                                             filename: str, persist: bool):
+    try:
+        tgw_id = load_config(filename=filename, key=tgw)
+        vpc_id = load_config(filename=filename, key=vpc)
+        subnet_id = load_config(filename=filename, key=subnet)
+        existing = await name_index.find_async(client, 'tgw_attachment', tgw_attachment_name, filename,
+                                               matches=attaches(tgw_id, vpc_id))
+        if existing:
+            tga = {'TransitGatewayVpcAttachment': existing}
+            logger.info(f'Reusing transit gateway attachment {existing["TransitGatewayAttachmentId"]} '
+                        f'as {tgw_attachment_name}')
+        else:
+            tga = await client.create_transit_gateway_vpc_attachment(
+                TransitGatewayId=tgw_id,
+                VpcId=vpc_id,
+                SubnetIds=[subnet_id],
+                TagSpecifications=tag_specifications('transit-gateway-attachment', tgw_attachment_name, filename)
+            )
+            attachment_id = tga['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId']
+            name_index.add(client, 'tgw_attachment', tgw_attachment_name, filename,
+                           {'TransitGatewayAttachmentId': attachment_id, 'TransitGatewayId': tgw_id,
+                            'ResourceId': vpc_id})
+        if persist:
+            store_config(value=tga['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId'],
+                         key=tgw_attachment_name, filename=filename)
+    except ClientError:
+        logger.exception('Could not create transit gateway attachment')
+    else:
+        return tga
+
+
+@state_keys(inputs=('tgw_1', 'tgw_2'), outputs=('tgw_peer_name',), api_calls=2, get_or_create=True)
+async def create_transit_gateway_peering_connection(client, tgw_peer_name: str, tgw_1: str, tgw_2: str,
+                                                    tgw_2_region: str, filename: str, persist: bool,
+                                                    peer_account: Optional[str] = None):
+    try:
+        tgw_1_id = load_config(filename=filename, key=tgw_1)
+        tgw_2_id = load_config(filename=filename, key=tgw_2)
+        existing = await name_index.find_async(client, 'tgw_attachment', tgw_peer_name, filename,
+                                               matches=attaches(tgw_1_id, tgw_2_id))
+        if existing:
+            tga = {'TransitGatewayPeeringAttachment': existing}
+            logger.info(f'Reusing transit gateway peering attachment {existing["TransitGatewayAttachmentId"]} '
+                        f'as {tgw_peer_name}')
+        else:
+            if peer_account is None:
+                peer_account = owner_account(await client.describe_transit_gateways(TransitGatewayIds=[tgw_1_id]))
+            tga = await client.create_transit_gateway_peering_attachment(
+                TransitGatewayId=tgw_1_id,
+                PeerTransitGatewayId=tgw_2_id,
+                PeerAccountId=peer_account,
+                PeerRegion=tgw_2_region,
+                TagSpecifications=tag_specifications('transit-gateway-attachment', tgw_peer_name, filename)
+            )
+            attachment_id = tga['TransitGatewayPeeringAttachment']['TransitGatewayAttachmentId']
+            name_index.add(client, 'tgw_attachment', tgw_peer_name, filename,
+                           {'TransitGatewayAttachmentId': attachment_id, 'TransitGatewayId': tgw_1_id,
+                            'ResourceId': tgw_2_id})
+        if persist:
+            store_config(value=tga['TransitGatewayPeeringAttachment']['TransitGatewayAttachmentId'],
+                         key=tgw_peer_name, filename=filename)
+    except ClientError:
+        logger.exception('Could not create transit gateway peering attachment')
+    else:
+        return tga
+
+
+@state_keys(inputs=('tgw_peer_name',))
+async def describe_transit_gateway_attachment(client, tgw_peer_name: str, filename: str, persist: bool):
+    tgw_peer_attachment = load_config(filename=filename, key=tgw_peer_name)
+    try:
+        desc = await client.describe_transit_gateway_attachments(TransitGatewayAttachmentIds=[tgw_peer_attachment])
+    except ClientError:
+        logger.exception('Could not describe transit gateway attachment')
+    else:
+        return desc
+
+
+@state_keys(inputs=('tgw',))
+async def wait_for_tgw(client, tgw: str, filename: str):
+    tgw_id = load_config(filename=filename, key=tgw)
+    return await wait_for_transit_gateway(client, tgw_id)
+
+
+@state_keys(inputs=('tgw_attachment',))
+async def wait_for_tgw_attachment(client, tgw_attachment: str, filename: str, states=('available',)):
+    tgw_attachment_id = load_config(filename=filename, key=tgw_attachment)
+    return await wait_for_transit_gateway_attachment(client, tgw_attachment_id, states=states)
+
+
+class AttachmentWatch(transit_gateways.AttachmentWatch):
+    # re-queued like the threaded watch, so a pending peering does not hold one of the region's slots either
+    poller_class = AsyncBatchPoller
+
+    async def __call__(self, client, tgw_attachment: str, filename: str):
+        return super().__call__(client, tgw_attachment, filename)
+
+
+@state_keys(inputs=('tgw_peer_connect',))
+async def accept_tgw_peering_connection(client, tgw_peer_connect: str, filename: str, persist: bool):
+    try:
+        tgw_peer_id = load_config(filename=filename, key=tgw_peer_connect)
+        response = await client.accept_transit_gateway_peering_attachment(TransitGatewayAttachmentId=tgw_peer_id)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'IncorrectState':
+            # a peering reused from an earlier run is accepted already
+            logger.info(f'{tgw_peer_connect} is not pending acceptance')
+            return None
+        logger.exception('Could not accept transit gateway peering attachment')
+    else:
+        return response
+
+
+@state_keys(inputs=('tgw_route_table', 'tgw_peer_connect'), api_calls=2)
+async def create_tgw_route_with_peering_attachment(client, tgw_route_table: str, vpc_network: str,
+                                                   tgw_peer_connect: str, filename: str):
+    try:
+        return await reconcile_tgw_routes(
+            client, {tgw_route_table: (Route(vpc_network, tgw_peer_connect, TGW_ROUTE_TARGET),)}, filename=filename,
+            prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with tgw peering')
+
+
+@state_keys(inputs=('tgw', 'route_table'), api_calls=2)
+async def create_route_with_tgw(client, tgw: str, vpc_network: str, route_table: str, filename: str):
+    try:
+        return await reconcile_vpc_routes(client, {route_table: (Route(vpc_network, tgw),)}, filename=filename,
+                                          prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with tgw')
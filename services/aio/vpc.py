@@ -0,0 +1,192 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+from services.aio.waiters import wait_for_vpc
+from services.aio.routes import reconcile_vpc_routes
+from services.inventory import name_index
+from services.routes import Route, RouteReconcileError
+from utils.engine import state_keys
+from utils.tags import tag_specifications
+from utils.utils import store_config, load_config
+
+# The asyncio variants of services.vpc, with the same names and arguments. aiobotocore has no resource API,
+# so `resource` is an async EC2 client here, and the functions return the response's resource dict.
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+@state_keys(outputs=('name',), api_calls=2, get_or_create=True)
+async def create_vpc(resource, name: str, ip_cidr: str, filename: str, persist: bool):
+    try:
+        vpc = await name_index.find_async(resource, 'vpc', name, filename,
+                                          matches=lambda item: item['CidrBlock'] == ip_cidr)
+        if vpc:
+            if vpc.get('State') != 'available':
+                await wait_for_vpc(resource, vpc['VpcId'])
+            logger.info(f'Reusing VPC {vpc["VpcId"]} as {name}')
+        else:
+            vpc = (await resource.create_vpc(CidrBlock=ip_cidr,
+                                             InstanceTenancy='default',
+                                             TagSpecifications=tag_specifications('vpc', name, filename)))['Vpc']
+            await wait_for_vpc(resource, vpc['VpcId'])
+            name_index.add(resource, 'vpc', name, filename, vpc)
+            logger.info(f'Custom VPC created: {vpc["VpcId"]}')
+    except ClientError:
+        logger.exception(f'Could not create the VPC {name}')
+        return
+    if persist:
+        store_config(value=vpc['VpcId'], key=name, filename=filename)
+    return vpc
+
+
+@state_keys(inputs=('vpc_name',), outputs=('subnet_name',), get_or_create=True)
+async def create_subnet(resource, subnet_name: str, subnet_ip_cidr: str, vpc_name: str, az: str, filename: str,
+                        persist: bool):
+    vpc_id = load_config(filename=filename, key=vpc_name)
+    try:
+        subnet = await name_index.find_async(
+            resource, 'subnet', subnet_name, filename,
+            matches=lambda item: item['VpcId'] == vpc_id and item['CidrBlock'] == subnet_ip_cidr)
+        if subnet:
+            logger.info(f'Reusing subnet {subnet["SubnetId"]} as {subnet_name}')
+        else:
+            subnet = (await resource.create_subnet(CidrBlock=subnet_ip_cidr,
+                                                   VpcId=vpc_id,
+                                                   AvailabilityZone=az,
+                                                   TagSpecifications=tag_specifications('subnet', subnet_name,
+                                                                                        filename)))['Subnet']
+            name_index.add(resource, 'subnet', subnet_name, filename, subnet)
+            logger.info(f'Subnet created: {subnet["SubnetId"]}')
+    except ClientError:
+        logger.exception('Could not create a subnet')
+        return
+    if persist:
+        store_config(subnet['SubnetId'], subnet_name, filename=filename)
+    return subnet
+
+
+async def delete_subnet(client, subnet_id):
+    try:
+        response = await client.delete_subnet(SubnetId=subnet_id)
+    except ClientError:
+        logger.exception('Could not delete subnet')
+    else:
+        return response
+
+
+async def delete_vpc(client, vpc_id: str):
+    try:
+        response = await client.delete_vpc(VpcId=vpc_id)
+    except ClientError:
+        logger.exception('Could not delete the VPC')
+    else:
+        return response
+
+
+async def delete_route_table(client, rt_id: str):
+    try:
+        response = await client.delete_route_table(RouteTableId=rt_id)
+    except ClientError:
+        logger.exception('Could not delete the Route Table')
+    else:
+        return response
+
+
+async def delete_igw(client, igw_id: str, vpc_id: str):
+    try:
+        await client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+        response = await client.delete_internet_gateway(InternetGatewayId=igw_id)
+    except ClientError:
+        logger.exception('Could not delete the IGW')
+    else:
+        return response
+
+
+@state_keys(outputs=('ig_name',), get_or_create=True)
+async def create_internet_gateways(resource, ig_name: str, filename: str, persist=True):
+    try:
+        igw = await name_index.find_async(resource, 'igw', ig_name, filename)
+        if igw:
+            logger.info(f'Reusing Internet Gateway {igw["InternetGatewayId"]} as {ig_name}')
+        else:
+            igw = (await resource.create_internet_gateway(
+                TagSpecifications=tag_specifications('internet-gateway', ig_name, filename)))['InternetGateway']
+            name_index.add(resource, 'igw', ig_name, filename, igw)
+            logger.info(f'Internet Gateway created: {igw["InternetGatewayId"]}')
+        if persist:
+            store_config(value=igw['InternetGatewayId'], key=ig_name, filename=filename)
+    except ClientError:
+        logger.exception('Could not create an internet gateway')
+    else:
+        return igw
+
+
+@state_keys(inputs=('vpc', 'igw'))
+async def attach_vpc_with_ig(resource, vpc: str, igw: str, filename: str):
+    try:
+        vpc_id = load_config(filename=filename, key=vpc)
+        ig_id = load_config(filename=filename, key=igw)
+        res = await resource.attach_internet_gateway(InternetGatewayId=ig_id, VpcId=vpc_id)
+        logger.info(f'Attaching {ig_id} with {vpc_id}')
+    except ClientError:
+        logger.exception('Could not attach vpc to ig')
+    else:
+        return res
+
+
+@state_keys(inputs=('vpc', 'subnet'), outputs=('route_table_name',), api_calls=2, get_or_create=True)
+async def create_routing_table_associate(resource, route_table_name: str, vpc: str, subnet: str, filename: str,
+                                         persist: bool):
+    try:
+        vpc_id = load_config(filename=filename, key=vpc)
+        subnet_id = load_config(filename=filename, key=subnet)
+        route_table = await name_index.find_async(resource, 'route_table', route_table_name, filename,
+                                                  matches=lambda item: item['VpcId'] == vpc_id)
+        if route_table:
+            route_table_id = route_table['RouteTableId']
+            logger.info(f'Reusing Route Table {route_table_id} as {route_table_name}')
+        else:
+            response = await resource.create_route_table(
+                VpcId=vpc_id, TagSpecifications=tag_specifications('route-table', route_table_name, filename))
+            route_table = response['RouteTable']
+            route_table_id = route_table['RouteTableId']
+            logger.info(f"Route table created: {route_table_id}")
+            name_index.add(resource, 'route_table', route_table_name, filename, route_table)
+        if persist:
+            store_config(value=route_table_id, key=route_table_name, filename=filename)
+        if any(association.get('SubnetId') == subnet_id for association in route_table.get('Associations', [])):
+            logger.info(f'Route Table {route_table_id} is already associated with subnet {subnet_id}')
+        else:
+            response = await resource.associate_route_table(RouteTableId=route_table_id, SubnetId=subnet_id)
+            route_table.setdefault('Associations', []).append({'SubnetId': subnet_id})
+            logger.info(f"Route Table {route_table_id} associated with subnet {subnet_id}: {response}")
+    except ClientError:
+        logger.exception('Could not create routing table')
+    else:
+        return route_table
+
+
+@state_keys(inputs=('igw', 'route_table'), api_calls=2)
+async def create_route_with_igw(resource, igw: str, route_table: str, destination_ip_cidr: str, filename: str):
+    try:
+        return await reconcile_vpc_routes(resource, {route_table: (Route(destination_ip_cidr, igw, 'GatewayId'),)},
+                                          filename=filename, prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with igw')
+
+
+@state_keys(inputs=('vpc',), outputs=('route_table_name',), get_or_create=True)
+async def find_existing_route_tables(resource, route_table_name: str, vpc: str, filename: str, persist=True):
+    vpc_id = load_config(filename=filename, key=vpc)
+    response = await resource.describe_route_tables(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]},
+                                                             {'Name': 'association.main', 'Values': ['true']}])
+    route_tables = response['RouteTables']
+    if route_tables:
+        logger.info(f'Route Tables found: {route_tables[0]["RouteTableId"]}')
+        if persist:
+            store_config(value=route_tables[0]['RouteTableId'], key=route_table_name, filename=filename)
+    else:
+        logger.error(f'No main route table found in {vpc_id}')
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from services.waiters import BATCH_WINDOW, DEFAULT_TIMEOUT, INITIAL_DELAY, MAX_BATCH_IDS, MAX_DELAY, BatchKind, \
+    BatchPollerBase, StatePoller, Waiting, attachment_waiting, batch_poller, instances_waiting, polling, \
+    transit_gateway_waiting, vpc_waiting
+from utils.describe_cache import uncached
+
+
+async def wait_for_state(describe_state: Callable[[], Awaitable[Optional[str]]], targets: Sequence[str],
+                         description: str, failures: Sequence[str] = (), timeout: float = DEFAULT_TIMEOUT,
+                         initial_delay: float = INITIAL_DELAY, max_delay: float = MAX_DELAY) -> str:
+    poller = StatePoller(targets, description, failures, timeout, initial_delay, max_delay)
+    while True:
+        with uncached():
+            state = await describe_state()
+        done, delay = poller.observe(state)
+        if done:
+            return state
+        await asyncio.sleep(delay)
+
+
+class AsyncBatchPoller(BatchPollerBase):
+    # The batch poller as a task on the event loop, started with the first wait and ended after the last one.
+    def __init__(self, client, kind: BatchKind, window: float = BATCH_WINDOW, batch_size: int = MAX_BATCH_IDS):
+        super().__init__(client, kind, window, batch_size)
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, waiting: Waiting) -> asyncio.Future:
+        # returns at once, with a future that is done once the wait is
+        if self.retired:
+            return self._successor().submit(waiting)
+        loop = asyncio.get_running_loop()
+        self._add(waiting)
+        future = self._futures[id(waiting)] = loop.create_future()
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wake.set()
+        return future
+
+    async def wait(self, waiting: Waiting) -> str:
+        await self.submit(waiting)
+        return waiting.result()
+
+    async def _describe(self, requests: List[dict]) -> Dict[str, str]:
+        found = {}
+        paginator = await self.client.get_paginator(self.kind.operation)
+        with polling(), uncached():
+            for request in requests:
+                async for page in paginator.paginate(**request):
+                    self.calls += 1
+                    found.update(self.kind.states(page))
+        return found
+
+    async def _run(self):
+        while self.waiting:
+            remaining = self.due - time.monotonic()
+            if remaining > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = self._take()
+            found, error = {}, None
+            try:
+                found = await self._describe(self.requests(batch))
+            except Exception as e:
+                error = e
+            for waiting in self._deliver(batch, found, error):
+                self._futures.pop(id(waiting)).set_result(None)
+        self._retire()
+
+
+async def wait_for_vpc(client, vpc_id: str, timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await batch_poller(client, 'vpc', AsyncBatchPoller).wait(vpc_waiting(vpc_id, timeout=timeout))
+
+
+async def wait_for_transit_gateway(client, tgw_id: str, states: Sequence[str] = ('available',),
+                                   timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await batch_poller(client, 'transit_gateway', AsyncBatchPoller).wait(
+        transit_gateway_waiting(tgw_id, states, timeout))
+
+
+async def wait_for_transit_gateway_attachment(client, attachment_id: str, states: Sequence[str] = ('available',),
+                                              timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await batch_poller(client, 'attachment', AsyncBatchPoller).wait(
+        attachment_waiting(attachment_id, states, timeout))
+
+
+async def wait_for_instances(client, instance_ids: Sequence[str], state: str = 'running',
+                             timeout: float = DEFAULT_TIMEOUT) -> str:
+    if not instance_ids:
+        # an empty filter would describe every instance in the region
+        return state
+    return await batch_poller(client, 'instance', AsyncBatchPoller).wait(
+        instances_waiting(instance_ids, state, timeout))
+
+
+async def wait_for_transit_gateway_deleted(client, tgw_id: str, timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await wait_for_transit_gateway(client, tgw_id, states=('deleted',), timeout=timeout)
+
+
+async def wait_for_transit_gateway_attachment_deleted(client, attachment_id: str,
+                                                      timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await wait_for_transit_gateway_attachment(client, attachment_id, states=('deleted',), timeout=timeout)
+
+
+async def wait_for_instances_terminated(client, instance_ids: Sequence[str], timeout: float = DEFAULT_TIMEOUT) -> str:
+    return await wait_for_instances(client, instance_ids, state='terminated', timeout=timeout)
@@ -1,131 +1,117 @@
 import logging
-import time
-
-import boto3
-from botocore.exceptions import ClientError
-
-from services.ec2 import delete_security_group, delete_ec2
-from services.transit_gateways import delete_transit_gateway_vpc_attachments, delete_transit_gateway, \
-    delete_transit_gateway_peering_attachments
-from services.vpc import delete_subnet, delete_vpc, delete_igw, delete_route_table
-from utils.utils import load_config, fetch_constants
-
-
-def _cleanup_vpc(client, vpc_id):
-    delete_vpc(client, vpc_id)
-
-
-def _cleanup_routing_table(client, rt_id):
-    delete_route_table(client, rt_id)
-
-
-def _cleanup_igw(client, igw_id, vpc_id):
-    delete_igw(client, igw_id, vpc_id)
-
-
-def _cleanup_subnets(client, subnet_id):
-    delete_subnet(client, subnet_id)
-
-
-def _cleanup_transit_gateway_vpc_attachments(client, tgw_id):
-    delete_transit_gateway_vpc_attachments(client, tgw_id)
-
-
-def _cleanup_transit_gateway_peering_attachments(client, tgw_id):
-    delete_transit_gateway_peering_attachments(client, tgw_id)
-
-
-def _cleanup_transit_gateway(client, tgw_id):
-    delete_transit_gateway(client, tgw_id)
-
-
-def _cleanup_security_groups(client, sg_id):
-    delete_security_group(client, sg_id)
-
-
-def _cleanup_ec2(client, instance_id):
-    delete_ec2(client, instance_id)
+from typing import List, Sequence
+
+from services.inventory import build_inventory
+from services.teardown import TeardownEngine, TeardownError
+from utils.clients import get_client, offline_clients
+from utils.constants import IntraRegionConstants, InterRegionConstants
+from utils.plan import Plan, add_plan_arguments, print_plans
+from utils.startup import apply_startup_args, startup_parser
+from utils.tags import environment
+from utils.utils import fetch_constants, load_config, update_config
+
+
+def _add_vpcs(teardown: TeardownEngine, constants, vpc1_client, vpc2_client, vpc2_region: str):
+    # each resource lists what it was built on; teardown deletes in the reverse order
+    region1 = constants.region1
+    teardown.add('vpc', constants.vpc1, region1, vpc1_client)
+    teardown.add('vpc', constants.vpc2, vpc2_region, vpc2_client)
+    teardown.add('igw', constants.igw, region1, vpc1_client, depends_on=[constants.vpc1], vpc_id=constants.vpc1)
+    teardown.add('route_table', constants.vpc1_pri_route_table, region1, vpc1_client, depends_on=[constants.vpc1])
+
+    teardown.add('subnet', constants.subnet1_vpc1, region1, vpc1_client, depends_on=[constants.vpc1])
+    teardown.add('subnet', constants.subnet2_vpc1, region1, vpc1_client,
+                 depends_on=[constants.vpc1, constants.vpc1_pri_route_table])
+    teardown.add('subnet', constants.subnet1_vpc2, vpc2_region, vpc2_client, depends_on=[constants.vpc2])
+
+    teardown.add('security_group', constants.sg_pub_1_vpc1, region1, vpc1_client, depends_on=[constants.vpc1])
+    teardown.add('security_group', constants.sg_pri_2_vpc1, region1, vpc1_client, depends_on=[constants.vpc1])
+    teardown.add('security_group', constants.sg_pri_1_vpc2, vpc2_region, vpc2_client, depends_on=[constants.vpc2])
+
+    # public addresses keep the IGW from detaching until the public instances are gone
+    teardown.add('instances', constants.ec2_pub_1_vpc1, region1, vpc1_client,
+                 depends_on=[constants.subnet1_vpc1, constants.sg_pub_1_vpc1, constants.igw])
+    teardown.add('instances', constants.ec2_pri_2_vpc1, region1, vpc1_client,
+                 depends_on=[constants.subnet2_vpc1, constants.sg_pri_2_vpc1])
+    teardown.add('instances', constants.ec2_pri_1_vpc2, vpc2_region, vpc2_client,
+                 depends_on=[constants.subnet1_vpc2, constants.sg_pri_1_vpc2])
+
+
+def intra_region_teardown(section: str, us_east_1_client, teardown_class=TeardownEngine) -> TeardownEngine:
+    constants: IntraRegionConstants = fetch_constants(section=section)
+    region = constants.region1
+    teardown = teardown_class(filename=section)
+    _add_vpcs(teardown, constants, us_east_1_client, us_east_1_client, region)
+    teardown.add('tgw', constants.tgw, region, us_east_1_client)
+    teardown.add('tgw_vpc_attachment', constants.tgw_attach_vpc1, region, us_east_1_client,
+                 depends_on=[constants.tgw, constants.vpc1, constants.subnet2_vpc1])
+    teardown.add('tgw_vpc_attachment', constants.tgw_attach_vpc2, region, us_east_1_client,
+                 depends_on=[constants.tgw, constants.vpc2, constants.subnet1_vpc2])
+    return teardown
 
 
 def cleanup_intra_region(section: str, us_east_1_client):
-    actual_values: dict = load_config(filename=section)
-    constants = fetch_constants(section=section)
     try:
-        _cleanup_ec2(us_east_1_client, actual_values[constants['EC2_PUB_1_VPC1']])
-        _cleanup_ec2(us_east_1_client, actual_values[constants['EC2_PRI_2_VPC1']])
-        _cleanup_ec2(us_east_1_client, actual_values[constants['EC2_PRI_1_VPC2']])
-
-        _cleanup_transit_gateway_vpc_attachments(us_east_1_client, actual_values[constants['TGW_ATTACH_VPC1']])
-        _cleanup_transit_gateway_vpc_attachments(us_east_1_client, actual_values[constants['TGW_ATTACH_VPC2']])
-
-        time.sleep(100)
-
-        _cleanup_transit_gateway(us_east_1_client, actual_values[constants['TGW_1']])
-        _cleanup_transit_gateway(us_east_1_client, actual_values[constants['TGW_2']])
-
-        time.sleep(100)
-
-        _cleanup_subnets(us_east_1_client, actual_values[constants['SUBNET1_VPC1']])
-        _cleanup_subnets(us_east_1_client, actual_values[constants['SUBNET2_VPC1']])
-        _cleanup_subnets(us_east_1_client, actual_values[constants['SUBNET1_VPC2']])
-
-        _cleanup_security_groups(us_east_1_client, actual_values[constants['SG_PUB_1_VPC1']])
-        _cleanup_security_groups(us_east_1_client, actual_values[constants['SG_PRI_2_VPC1']])
-        _cleanup_security_groups(us_east_1_client, actual_values[constants['SG_PRI_1_VPC2']])
-
-        _cleanup_igw(us_east_1_client, actual_values[constants['IGW']], actual_values[constants['VPC1']])
-        _cleanup_routing_table(us_east_1_client, actual_values[constants['VPC1_PRI_ROUTE_TABLE']])
+        intra_region_teardown(section, us_east_1_client).run()
+    except TeardownError as e:
+        logging.exception(f'Nevermind - {e}')
 
-        _cleanup_vpc(us_east_1_client, actual_values[constants['VPC1']])
-        _cleanup_vpc(us_east_1_client, actual_values[constants['VPC2']])
 
-    except ClientError as e:
-        logging.exception(f'Nevermind - {e}')
+def inter_region_teardown(section, us_east_1_client, us_west_1_client, teardown_class=TeardownEngine) -> TeardownEngine:
+    constants: InterRegionConstants = fetch_constants(section=section)
+    teardown = teardown_class(filename=section)
+    _add_vpcs(teardown, constants, us_east_1_client, us_west_1_client, constants.region2)
+    teardown.add('tgw', constants.tgw_1, constants.region1, us_east_1_client)
+    teardown.add('tgw', constants.tgw_2, constants.region2, us_west_1_client)
+    teardown.add('tgw_peering_attachment', constants.tgw_peer_connect, constants.region2, us_west_1_client,
+                 depends_on=[constants.tgw_1, constants.tgw_2])
+    teardown.add('tgw_vpc_attachment', constants.tgw_attach_vpc1, constants.region1, us_east_1_client,
+                 depends_on=[constants.tgw_1, constants.vpc1, constants.subnet2_vpc1])
+    teardown.add('tgw_vpc_attachment', constants.tgw_attach_vpc2, constants.region2, us_west_1_client,
+                 depends_on=[constants.tgw_2, constants.vpc2, constants.subnet1_vpc2])
+    return teardown
 
 
 def cleanup_inter_region(section, us_east_1_client, us_west_1_client):
-    actual_values: dict = load_config(filename=section)
-    constants = fetch_constants(section=section)
     try:
-        _cleanup_ec2(us_east_1_client, actual_values[constants['EC2_PUB_1_VPC1']])
-        _cleanup_ec2(us_east_1_client, actual_values[constants['EC2_PRI_2_VPC1']])
-        _cleanup_ec2(us_west_1_client, actual_values[constants['EC2_PRI_1_VPC2']])
-
-        _cleanup_transit_gateway_vpc_attachments(us_east_1_client, actual_values[constants['TGW_ATTACH_VPC1']])
-        _cleanup_transit_gateway_vpc_attachments(us_east_1_client, actual_values[constants['TGW_ATTACH_VPC2']])
-        _cleanup_transit_gateway_peering_attachments(us_west_1_client, actual_values[constants['TGW_PEER_CONNECT']])
-
-        time.sleep(100)
-
-        _cleanup_transit_gateway(us_east_1_client, actual_values[constants['TGW_1']])
-        _cleanup_transit_gateway(us_west_1_client, actual_values[constants['TGW_2']])
-
-        time.sleep(100)
-
-        _cleanup_subnets(us_east_1_client, actual_values[constants['SUBNET1_VPC1']])
-        _cleanup_subnets(us_east_1_client, actual_values[constants['SUBNET2_VPC1']])
-        _cleanup_subnets(us_west_1_client, actual_values[constants['SUBNET1_VPC2']])
+        inter_region_teardown(section, us_east_1_client, us_west_1_client).run()
+    except TeardownError as e:
+        logging.exception(f'Nevermind - {e}')
 
-        _cleanup_security_groups(us_east_1_client, actual_values[constants['SG_PUB_1_VPC1']])
-        _cleanup_security_groups(us_east_1_client, actual_values[constants['SG_PRI_2_VPC1']])
-        _cleanup_security_groups(us_west_1_client, actual_values[constants['SG_PRI_1_VPC2']])
 
-        _cleanup_igw(us_east_1_client, actual_values[constants['IGW']], actual_values[constants['VPC1']])
-        _cleanup_routing_table(us_east_1_client, actual_values[constants['VPC1_PRI_ROUTE_TABLE']])
+def plan_cleanup() -> List[Plan]:
+    # what a teardown of both scenarios would delete, from the state files alone
+    with offline_clients():
+        us_east_1_client = get_client('ec2', region='us-east-1')
+        us_west_1_client = get_client('ec2', region='us-west-1')
+        return [intra_region_teardown('intra_region', us_east_1_client).plan(),
+                inter_region_teardown('inter_region', us_east_1_client, us_west_1_client).plan()]
 
-        _cleanup_vpc(us_east_1_client, actual_values[constants['VPC1']])
-        _cleanup_vpc(us_west_1_client, actual_values[constants['VPC2']])
 
-    except ClientError as e:
-        logging.exception(f'Nevermind - {e}')
+def recover_state(section: str, regions: Sequence[str]):
+    # rebuild a lost or stale state file from the tags the resources were created with
+    inventory = build_inventory(environment(section), regions)
+    update_config(dict(load_config(filename=section), **inventory.state()), filename=section)
 
 
 if __name__ == '__main__':
-    us_east_1_resource = boto3.resource('ec2', region_name='us-east-1')
-    us_west_1_resource = boto3.resource('ec2', region_name='us-west-1')
-
-    us_east_1_client = boto3.client('ec2', region_name='us-east-1')
-    us_west_1_client = boto3.client('ec2', region_name='us-west-1')
-
-    cleanup_intra_region(section='inter_region', us_east_1_client=us_east_1_client)
-    cleanup_inter_region(section='inter_region', us_east_1_client=us_east_1_client, us_west_1_client=us_west_1_client)
+    parser = startup_parser('Tear down the resources recorded for a scenario')
+    parser.add_argument('--recover', action='store_true',
+                        help='rebuild the state files from Environment tags before tearing down')
+    add_plan_arguments(parser)
+    args = parser.parse_args()
+    apply_startup_args(args, __file__)
+    if args.plan:
+        print_plans(plan_cleanup(), args.plan_json)
+    else:
+        us_east_1_client = get_client('ec2', region='us-east-1')
+        us_west_1_client = get_client('ec2', region='us-west-1')
+
+        if args.recover:
+            recover_state('intra_region', [fetch_constants('intra_region').region1])
+            inter_region = fetch_constants('inter_region')
+            recover_state('inter_region', [inter_region.region1, inter_region.region2])
+
+        cleanup_intra_region(section='intra_region', us_east_1_client=us_east_1_client)
+        cleanup_inter_region(section='inter_region', us_east_1_client=us_east_1_client,
+                             us_west_1_client=us_west_1_client)
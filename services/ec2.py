@@ -1,18 +1,25 @@
+import json
 import logging
-from typing import Optional
+import threading
+from typing import List, Optional, Sequence, TextIO, Union
 
-import boto3
 from botocore.exceptions import ClientError
 
+from services.inventory import name_index
+from services.security_groups import DEFAULT_RULES, ip_permissions, parse_security_groups
+from utils.engine import state_keys
+from utils.rules import Rule
+from utils.tags import tag_specifications
 from utils.utils import store_config, load_config
 
-client = boto3.resource('ec2')
-ec2client = client.meta.client
-
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s: %(levelname)s: %(message)s')
 
+DEFAULT_INSTANCE_TYPE = 't2.micro'
+
+_stream_lock = threading.Lock()
+
 
 def delete_security_group(client, group_id):
     try:
@@ -23,51 +30,55 @@ def delete_security_group(client, group_id):
         return response
 
 
-def delete_ec2(client, instance_id):
+def delete_ec2(client, instance_id: Union[str, List[str]]):
+    # fleet launches persist a list of ids under one name
+    instance_ids = [instance_id] if isinstance(instance_id, str) else list(instance_id)
     try:
-        response = client.terminate_instances(InstanceIds=[instance_id])
+        response = client.terminate_instances(InstanceIds=instance_ids)
     except ClientError as e:
-        logger.exception(f'Could not delete instance {instance_id}')
+        logger.exception(f'Could not delete instances {instance_ids}')
     else:
         return response
 
 
-def create_security_group(client, group_name: str, ec2_name: str, vpc: str, filename: str, persist: bool):
+def _missing_rules(security_group: dict, rules: Sequence[Rule]) -> List[Rule]:
+    present = parse_security_groups([security_group['GroupId']], [security_group])[security_group['GroupId']]
+    return [rule for rule in rules if rule not in present]
+
+
+@state_keys(inputs=('vpc',), outputs=('group_name',), api_calls=lambda kwargs: 1 + bool(kwargs.get('rules', True)),
+            get_or_create=True)
+def create_security_group(client, group_name: str, ec2_name: str, vpc: str, filename: str, persist: bool,
+                          rules: Sequence[Rule] = DEFAULT_RULES):
+    # rules are compiled by utils.rules.compile_rules; without any, the rules are left to a reconcile step
     try:
         vpc_id = load_config(filename=filename, key=vpc)
-        security_group = client.create_security_group(Description=f'Automated Security Group created for {ec2_name}',
-                                                      GroupName=group_name,
-                                                      VpcId=vpc_id,
-                                                      TagSpecifications=[
-                                                          {
-                                                              'ResourceType': 'security-group',
-                                                              'Tags': [
-                                                                  {
-                                                                      'Key': "Name",
-                                                                      'Value': group_name
-                                                                  },
-                                                              ]
-                                                          },
-                                                      ]
-                                                      )
+        existing = name_index.find(client, 'security_group', group_name, filename,
+                                   matches=lambda item: item['VpcId'] == vpc_id)
+        if existing:
+            security_group = {'GroupId': existing['GroupId']}
+            # a reused group only gets the rules it lacks, going by what it has now: the index only knows what
+            # it held when it was listed or created
+            described = client.describe_security_groups(GroupIds=[existing['GroupId']])
+            rules = _missing_rules(described['SecurityGroups'][0], rules)
+            logger.info(f'Reusing Security Group {existing["GroupId"]} as {group_name}')
+        else:
+            security_group = client.create_security_group(
+                Description=f'Automated Security Group created for {ec2_name}',
+                GroupName=group_name,
+                VpcId=vpc_id,
+                TagSpecifications=tag_specifications('security-group', group_name, filename))
+            name_index.add(client, 'security_group', group_name, filename,
+                           {'GroupId': security_group['GroupId'], 'VpcId': vpc_id})
+            logger.info(f'Security Group created: {security_group}')
         if persist:
             store_config(value=security_group['GroupId'],
                          key=group_name, filename=filename)
 
-        logger.info(f'Security Group created: {security_group}')
-        security_group_rules = client.authorize_security_group_ingress(
-            GroupId=security_group['GroupId'],
-            IpPermissions=[
-                {'IpProtocol': 'tcp',
-                 'FromPort': 22,
-                 'ToPort': 22,
-                 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
-                {'IpProtocol': 'icmp',
-                 'FromPort': -1,
-                 'ToPort': -1,
-                 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
-            ])
-        logger.info(f'Security Group Rules updated: {security_group_rules}')
+        if rules:
+            security_group_rules = client.authorize_security_group_ingress(GroupId=security_group['GroupId'],
+                                                                           IpPermissions=ip_permissions(rules))
+            logger.info(f'Security Group Rules updated: {security_group_rules}')
 
     except ClientError as e:
         logger.exception('Could not create security group', e)
@@ -75,72 +86,52 @@ def create_security_group(client, group_name: str, ec2_name: str, vpc: str, file
         return security_group
 
 
-def create_ec2(client, ec2_name: str, subnet: str, security_group: str, keypair: Optional[str], enable_public_ip: bool, image: str,
-               filename: str, persist: bool):
-    # defaulted hence hardcoded
-    min_count = 1
-    max_count = 1
-    instance_type = 't2.micro'
+@state_keys(inputs=('subnet', 'security_group'), outputs=('ec2_name',))
+def create_ec2(client, ec2_name: str, subnet: str, security_group: str, keypair: Optional[str], enable_public_ip: bool,
+               image: str, filename: str, persist: bool, count: int = 1, instance_type: str = DEFAULT_INSTANCE_TYPE,
+               stream: Optional[TextIO] = None):
+    # launches the whole fleet for one subnet in a single call; all ids are persisted under ec2_name as a list
     subnet_id = load_config(filename=filename, key=subnet)
     security_group_id = load_config(filename=filename, key=security_group)
+    request = dict(
+        ImageId=image,
+        MinCount=count,
+        MaxCount=count,
+        InstanceType=instance_type,
+        NetworkInterfaces=[
+            {
+                'DeviceIndex': 0,
+                'SubnetId': subnet_id,
+                'Groups': [security_group_id],
+                'AssociatePublicIpAddress': enable_public_ip
+            }
+        ],
+        TagSpecifications=tag_specifications('instance', ec2_name, filename),
+    )
     if keypair:
-        instances = client.create_instances(
-            ImageId=image,
-            MinCount=min_count,
-            MaxCount=max_count,
-            InstanceType=instance_type,
-            KeyName=keypair,
-            NetworkInterfaces=[
-                {
-                    'DeviceIndex': 0,
-                    'SubnetId': subnet_id,
-                    'Groups': [security_group_id],
-                    'AssociatePublicIpAddress': enable_public_ip
-                }
-            ],
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': ec2_name
-                        },
-                    ]
-                },
-            ],
-        )
-    else:
-        instances = client.create_instances(
-            ImageId=image,
-            MinCount=min_count,
-            MaxCount=max_count,
-            InstanceType=instance_type,
-            NetworkInterfaces=[
-                {
-                    'DeviceIndex': 0,
-                    'SubnetId': subnet_id,
-                    'Groups': [security_group_id],
-                    'AssociatePublicIpAddress': enable_public_ip
-                }
-            ],
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': ec2_name
-                        },
-                    ]
-                },
-            ],
-        )
-    logger.info(instances)
+        request['KeyName'] = keypair
+    try:
+        instances = client.create_instances(**request)
+    except ClientError as e:
+        logger.exception(f'Could not launch {count} x {instance_type} for {ec2_name}')
+        return
+
+    instance_ids = [instance.id for instance in instances]
+    logger.info(f'Instances launched for {ec2_name}: {instance_ids}')
     if persist:
-        pass
+        store_config(value=instance_ids, key=ec2_name, filename=filename)
+    if stream is not None:
+        _stream_instances(stream, ec2_name, subnet_id, instance_ids)
     return instances
 
 
+def _stream_instances(stream: TextIO, ec2_name: str, subnet_id: str, instance_ids: List[str]):
+    lines = ''.join(json.dumps({'name': ec2_name, 'subnet_id': subnet_id, 'instance_id': instance_id}) + '\n'
+                    for instance_id in instance_ids)
+    with _stream_lock:
+        stream.write(lines)
+        stream.flush()
+
+
 if __name__ == '__main__':
     pass
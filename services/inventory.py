@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from utils.clients import get_client
+from utils.describe_cache import uncached
+from utils.journal import StepJournal
+from utils.state import resource_type_of
+from utils.tags import ENVIRONMENT_TAG, RUN_ID_TAG, environment
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_INVENTORY_WORKERS = 16
+# terminated instances stay visible for about an hour and must not be mistaken for live ones
+LIVE_INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+
+# EC2 takes up to 200 values per filter
+MAX_FILTER_VALUES = 200
+
+
+@dataclass(frozen=True)
+class ResourceType:
+    operation: str
+    result_key: str
+    id_key: str
+    # the filter that selects resources by id
+    id_filter: str
+    filters: Tuple[Tuple[str, Tuple[str, ...]], ...] = ()
+
+    def items(self, page: dict) -> Iterator[dict]:
+        for item in page.get(self.result_key, []):
+            if self.result_key == 'Reservations':
+                yield from item.get('Instances', [])
+            else:
+                yield item
+
+
+RESOURCE_TYPES: Dict[str, ResourceType] = {
+    'vpc': ResourceType('describe_vpcs', 'Vpcs', 'VpcId', 'vpc-id'),
+    'subnet': ResourceType('describe_subnets', 'Subnets', 'SubnetId', 'subnet-id'),
+    'route_table': ResourceType('describe_route_tables', 'RouteTables', 'RouteTableId', 'route-table-id'),
+    'igw': ResourceType('describe_internet_gateways', 'InternetGateways', 'InternetGatewayId',
+                        'internet-gateway-id'),
+    'tgw': ResourceType('describe_transit_gateways', 'TransitGateways', 'TransitGatewayId', 'transit-gateway-id',
+                        filters=(('state', ('pending', 'available', 'modifying')),)),
+    'tgw_attachment': ResourceType('describe_transit_gateway_attachments', 'TransitGatewayAttachments',
+                                   'TransitGatewayAttachmentId', 'transit-gateway-attachment-id',
+                                   filters=(('state', ('initiating', 'pendingAcceptance', 'pending', 'available',
+                                                       'modifying')),)),
+    'security_group': ResourceType('describe_security_groups', 'SecurityGroups', 'GroupId', 'group-id'),
+    'instance': ResourceType('describe_instances', 'Reservations', 'InstanceId', 'instance-id',
+                             filters=(('instance-state-name', tuple(LIVE_INSTANCE_STATES)),)),
+}
+
+
+@dataclass(frozen=True)
+class InventoryItem:
+    region: str
+    resource_type: str
+    resource_id: str
+    name: Optional[str]
+    tags: Dict[str, str] = field(default_factory=dict, hash=False, compare=False)
+
+
+class Inventory:
+    # Local index of what one environment has in AWS, by id, by (region, type) and by Name tag.
+    def __init__(self, environment: str, items: Iterable[InventoryItem] = ()):
+        self.environment = environment
+        self.items: Dict[str, InventoryItem] = {}
+        self._by_type: Dict[Tuple[str, str], List[InventoryItem]] = {}
+        self._by_name: Dict[str, List[InventoryItem]] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: InventoryItem):
+        # attachments show up in both regions of a peering; the first sighting wins
+        if item.resource_id in self.items:
+            return
+        self.items[item.resource_id] = item
+        self._by_type.setdefault((item.region, item.resource_type), []).append(item)
+        if item.name:
+            self._by_name.setdefault(item.name, []).append(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self) -> Iterator[InventoryItem]:
+        return iter(self.items.values())
+
+    def of_type(self, resource_type: str, region: Optional[str] = None) -> List[InventoryItem]:
+        return [item for (item_region, item_type), items in self._by_type.items()
+                if item_type == resource_type and region in (None, item_region) for item in items]
+
+    def named(self, name: str) -> List[InventoryItem]:
+        return list(self._by_name.get(name, []))
+
+    def state(self) -> Dict[str, object]:
+        # the Name -> id mapping the section state files hold; instance names map to all of their ids
+        state: Dict[str, object] = {}
+        for name, items in self._by_name.items():
+            if all(item.resource_type == 'instance' for item in items):
+                state[name] = sorted(item.resource_id for item in items)
+            else:
+                state[name] = items[0].resource_id
+                if len(items) > 1:
+                    logger.warning(f'{len(items)} resources are named {name} in {self.environment}, '
+                                   f'using {items[0].resource_id}')
+        return state
+
+
+def _filters(resource_type: ResourceType, environment: str, run_id: Optional[str]) -> List[dict]:
+    # filtered server side, so only this environment's resources cross the wire
+    filters = [{'Name': f'tag:{ENVIRONMENT_TAG}', 'Values': [environment]}]
+    if run_id:
+        filters.append({'Name': f'tag:{RUN_ID_TAG}', 'Values': [run_id]})
+    filters.extend({'Name': name, 'Values': list(values)} for name, values in resource_type.filters)
+    return filters
+
+
+def _discover(region: str, type_name: str, environment: str, run_id: Optional[str],
+              account: Optional[str]) -> List[InventoryItem]:
+    resource_type = RESOURCE_TYPES[type_name]
+    client = get_client('ec2', region, account)
+    paginator = client.get_paginator(resource_type.operation)
+    items = []
+    for page in paginator.paginate(Filters=_filters(resource_type, environment, run_id)):
+        for item in resource_type.items(page):
+            tags = {tag['Key']: tag['Value'] for tag in item.get('Tags', [])}
+            # never trust a filter blindly: an unsupported one is ignored, not rejected
+            if tags.get(ENVIRONMENT_TAG) != environment or (run_id and tags.get(RUN_ID_TAG) != run_id):
+                continue
+            items.append(InventoryItem(region=region, resource_type=type_name, resource_id=item[resource_type.id_key],
+                                       name=tags.get('Name'), tags=tags))
+    return items
+
+
+def build_inventory(environment: str, regions: Sequence[str], run_id: Optional[str] = None,
+                    resource_types: Optional[Sequence[str]] = None, account: Optional[str] = None,
+                    workers: int = DEFAULT_INVENTORY_WORKERS) -> Inventory:
+    started = time.monotonic()
+    type_names = list(resource_types or RESOURCE_TYPES)
+    queries = [(region, type_name) for region in regions for type_name in type_names]
+    # one paginated query per (region, type), all in flight at once
+    with ThreadPoolExecutor(max_workers=min(workers, len(queries)) or 1, thread_name_prefix='inventory') as pool:
+        results = pool.map(lambda query: _discover(*query, environment, run_id, account), queries)
+        inventory = Inventory(environment, (item for items in results for item in items))
+    logger.info(f'Inventory of {environment}: {len(inventory)} resources in {len(regions)} region(s), '
+                f'{len(queries)} queries in {time.monotonic() - started:.1f}s')
+    return inventory
+
+
+def _live(region: str, type_name: str, resource_ids: List[str], account: Optional[str]) -> Set[str]:
+    resource_type = RESOURCE_TYPES[type_name]
+    paginator = get_client('ec2', region, account).get_paginator(resource_type.operation)
+    live = set()
+    # a resume goes by what exists now, not by what this process saw earlier
+    with uncached():
+        for start in range(0, len(resource_ids), MAX_FILTER_VALUES):
+            # by filter, so ids that are gone are left out instead of failing the call
+            filters = [{'Name': resource_type.id_filter, 'Values': resource_ids[start:start + MAX_FILTER_VALUES]}]
+            filters.extend({'Name': name, 'Values': list(values)} for name, values in resource_type.filters)
+            for page in paginator.paginate(Filters=filters):
+                live.update(item[resource_type.id_key] for item in resource_type.items(page))
+    return live
+
+
+def missing_resources(ids: Dict[str, Set[str]], account: Optional[str] = None,
+                      workers: int = DEFAULT_INVENTORY_WORKERS) -> Set[str]:
+    # which of the ids (by region) are gone, with one paginated describe per region and resource type;
+    # ids of unknown types are taken to exist
+    queries: Dict[Tuple[str, str], List[str]] = {}
+    for region, resource_ids in ids.items():
+        for resource_id in sorted(resource_ids):
+            type_name = resource_type_of(resource_id)
+            if type_name:
+                queries.setdefault((region, type_name), []).append(resource_id)
+    with ThreadPoolExecutor(max_workers=min(workers, len(queries)) or 1, thread_name_prefix='inventory') as pool:
+        live = set().union(*pool.map(lambda query: _live(*query, queries[query], account), queries))
+    missing = {resource_id for resource_ids in queries.values() for resource_id in resource_ids} - live
+    # so the steps that run again create them rather than reuse what is gone
+    for resource_id in missing:
+        name_index.discard(resource_id)
+    return missing
+
+
+def step_journal(section: str) -> StepJournal:
+    # a journal whose completed steps are checked against AWS before a run skips them
+    return StepJournal(section, verify=missing_resources)
+
+
+def _name_of(item: dict) -> Optional[str]:
+    return next((tag['Value'] for tag in item.get('Tags', []) if tag['Key'] == 'Name'), None)
+
+
+class NameIndex:
+    # What an environment already has, by (region, resource type, Name tag), so the create functions reuse what
+    # an earlier run left behind instead of creating a second one. Each (environment, region, type) is filled
+    # on first use by one filtered, paginated describe, which concurrent steps wait for rather than repeat;
+    # resources created or deleted during the run are added and dropped as they go.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        # an asyncio.Lock belongs to the loop it is first awaited on, so each loop has its own
+        self._async_locks: Dict[asyncio.AbstractEventLoop, Dict[Tuple[str, str, str], asyncio.Lock]] = {}
+        self._names: Dict[Tuple[str, str, str], Dict[str, List[dict]]] = {}
+
+    @staticmethod
+    def _key(client, type_name: str, filename: str) -> Tuple[str, str, str]:
+        return environment(filename), client.meta.region_name, type_name
+
+    def _index(self, key: Tuple[str, str, str], items: Iterable[dict]):
+        names: Dict[str, List[dict]] = {}
+        for item in items:
+            name = _name_of(item)
+            if name:
+                names.setdefault(name, []).append(item)
+        self._names[key] = names
+
+    def _match(self, key: Tuple[str, str, str], name: str, matches) -> Optional[dict]:
+        items = [item for item in self._names[key].get(name, []) if matches is None or matches(item)]
+        if len(items) > 1:
+            logger.warning(f'{len(items)} {key[2]} resources are named {name} in {key[0]}, reusing the first')
+        return items[0] if items else None
+
+    def _key_lock(self, key: Tuple[str, str, str]) -> threading.Lock:
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _key_async_lock(self, key: Tuple[str, str, str]) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # a lock refers to its loop, so those of closed loops are dropped here rather than collected
+            for closed in [each for each in self._async_locks if each.is_closed()]:
+                del self._async_locks[closed]
+            locks = self._async_locks.setdefault(loop, {})
+            if key not in locks:
+                locks[key] = asyncio.Lock()
+            return locks[key]
+
+    def find(self, client, type_name: str, name: str, filename: str, matches=None) -> Optional[dict]:
+        # the describe item of a live resource with that Name (and for which matches(item) holds), if any
+        key = self._key(client, type_name, filename)
+        with self._key_lock(key):
+            if key not in self._names:
+                resource_type = RESOURCE_TYPES[type_name]
+                pages = client.get_paginator(resource_type.operation).paginate(
+                    Filters=_filters(resource_type, key[0], None))
+                self._index(key, (item for page in pages for item in resource_type.items(page)))
+            return self._match(key, name, matches)
+
+    async def find_async(self, client, type_name: str, name: str, filename: str, matches=None) -> Optional[dict]:
+        # the same with an async client, for services.aio
+        key = self._key(client, type_name, filename)
+        async with self._key_async_lock(key):
+            if key not in self._names:
+                resource_type = RESOURCE_TYPES[type_name]
+                pages = (await client.get_paginator(resource_type.operation)).paginate(
+                    Filters=_filters(resource_type, key[0], None))
+                self._index(key, [item async for page in pages for item in resource_type.items(page)])
+            return self._match(key, name, matches)
+
+    def add(self, client, type_name: str, name: str, filename: str, item: dict):
+        # only indexes that are loaded need it; the others will see it in their describe
+        key = self._key(client, type_name, filename)
+        with self._lock:
+            if key in self._names:
+                self._names[key].setdefault(name, []).append(item)
+
+    def discard(self, resource_id):
+        with self._lock:
+            for names in self._names.values():
+                for name, items in names.items():
+                    names[name] = [item for item in items if resource_id not in item.values()]
+
+
+# shared by every create function of the process
+name_index = NameIndex()
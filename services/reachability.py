@@ -0,0 +1,197 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from services.inventory import LIVE_INSTANCE_STATES, MAX_FILTER_VALUES
+from services.routes import VPC_ROUTE_TARGETS
+from services.security_groups import parse_security_groups
+from utils.clients import get_client
+from utils.reachability import BLACKHOLE, INTERNET_GATEWAY, TRANSIT_GATEWAY, NetworkModel
+from utils.tags import ENVIRONMENT_TAG
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_SNAPSHOT_WORKERS = 16
+
+
+@dataclass
+class RegionSnapshot:
+    # what one region of an environment looks like, as the describe calls return it
+    region: str
+    vpcs: List[dict] = field(default_factory=list)
+    subnets: List[dict] = field(default_factory=list)
+    route_tables: List[dict] = field(default_factory=list)
+    transit_gateways: List[dict] = field(default_factory=list)
+    attachments: List[dict] = field(default_factory=list)
+    # transit gateway id -> the routes of its default route table
+    tgw_routes: Dict[str, List[dict]] = field(default_factory=dict)
+    security_groups: List[dict] = field(default_factory=list)
+    instances: List[dict] = field(default_factory=list)
+
+
+def _all(client, operation: str, result_key: str, filters: List[dict]) -> List[dict]:
+    paginator = client.get_paginator(operation)
+    return [item for page in paginator.paginate(Filters=filters) for item in page.get(result_key, [])]
+
+
+def _by_ids(client, operation: str, result_key: str, name: str, values: List[str]) -> List[dict]:
+    # resources that are not tagged themselves (main route tables, default security groups), by what they belong to
+    items = []
+    for start in range(0, len(values), MAX_FILTER_VALUES):
+        chunk = values[start:start + MAX_FILTER_VALUES]
+        items.extend(_all(client, operation, result_key, [{'Name': name, 'Values': chunk}]))
+    return items
+
+
+def snapshot_region(region: str, environment: str, account: Optional[str] = None) -> RegionSnapshot:
+    # one describe per kind, filtered server side to the environment, plus one route search per transit gateway
+    client = get_client('ec2', region, account)
+    tagged = [{'Name': f'tag:{ENVIRONMENT_TAG}', 'Values': [environment]}]
+    snapshot = RegionSnapshot(region)
+    snapshot.vpcs = _all(client, 'describe_vpcs', 'Vpcs', tagged)
+    snapshot.transit_gateways = _all(client, 'describe_transit_gateways', 'TransitGateways',
+                                     tagged + [{'Name': 'state', 'Values': ['available', 'modifying']}])
+    vpc_ids = [vpc['VpcId'] for vpc in snapshot.vpcs]
+    tgw_ids = [tgw['TransitGatewayId'] for tgw in snapshot.transit_gateways]
+    if vpc_ids:
+        snapshot.subnets = _by_ids(client, 'describe_subnets', 'Subnets', 'vpc-id', vpc_ids)
+        snapshot.route_tables = _by_ids(client, 'describe_route_tables', 'RouteTables', 'vpc-id', vpc_ids)
+        snapshot.security_groups = _by_ids(client, 'describe_security_groups', 'SecurityGroups', 'vpc-id', vpc_ids)
+        reservations = _all(client, 'describe_instances', 'Reservations',
+                            tagged + [{'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES}])
+        snapshot.instances = [instance for reservation in reservations for instance in reservation['Instances']]
+    if tgw_ids:
+        # the accepter side of a peering is not tagged, so attachments are found by gateway
+        snapshot.attachments = _by_ids(client, 'describe_transit_gateway_attachments', 'TransitGatewayAttachments',
+                                       'transit-gateway-id', tgw_ids)
+        for tgw in snapshot.transit_gateways:
+            route_table_id = tgw.get('Options', {}).get('AssociationDefaultRouteTableId')
+            if route_table_id:
+                response = client.search_transit_gateway_routes(
+                    TransitGatewayRouteTableId=route_table_id,
+                    Filters=[{'Name': 'state', 'Values': ['active', 'blackhole']}])
+                snapshot.tgw_routes[tgw['TransitGatewayId']] = response.get('Routes', [])
+    return snapshot
+
+
+def _names(snapshots: Sequence[RegionSnapshot], state: Optional[Dict[str, object]] = None) -> Dict[str, str]:
+    # resources go by their key in the section's state file or their Name tag, and by id where they have neither
+    # or share one; main route tables and internet gateways are only named in the state file
+    names: Dict[str, str] = {}
+    taken: Dict[str, int] = {}
+    for snapshot in snapshots:
+        for kind, id_key in (('vpcs', 'VpcId'), ('subnets', 'SubnetId'), ('route_tables', 'RouteTableId'),
+                             ('transit_gateways', 'TransitGatewayId'), ('attachments', 'TransitGatewayAttachmentId'),
+                             ('instances', 'InstanceId')):
+            for item in getattr(snapshot, kind):
+                name = next((tag['Value'] for tag in item.get('Tags', []) if tag['Key'] == 'Name'), None)
+                names[item[id_key]] = name or item[id_key]
+                if name:
+                    taken[name] = taken.get(name, 0) + 1
+    names = {resource_id: resource_id if taken.get(name, 0) > 1 else name for resource_id, name in names.items()}
+    names.update((value, key) for key, value in (state or {}).items() if isinstance(value, str))
+    return names
+
+
+def _vpc_route(route: dict):
+    # (kind, target) of a VPC route
+    if route.get('State') == 'blackhole':
+        return BLACKHOLE, None
+    if route.get('GatewayId', '').startswith('igw-'):
+        return INTERNET_GATEWAY, route['GatewayId']
+    if route.get('TransitGatewayId'):
+        return TRANSIT_GATEWAY, route['TransitGatewayId']
+    target_type = next((key for key in VPC_ROUTE_TARGETS if route.get(key)), 'unknown')
+    return target_type, route.get(target_type)
+
+
+def model_from_snapshot(name: str, snapshots: Sequence[RegionSnapshot],
+                        state: Optional[Dict[str, object]] = None) -> NetworkModel:
+    model = NetworkModel(name)
+    names = _names(snapshots, state)
+
+    def label(resource_id: str) -> str:
+        return names.get(resource_id, resource_id)
+
+    for snapshot in snapshots:
+        for tgw in snapshot.transit_gateways:
+            model.add_transit_gateway(label(tgw['TransitGatewayId']))
+        for vpc in snapshot.vpcs:
+            model.add_vpc(label(vpc['VpcId']), vpc['CidrBlock'])
+
+    for snapshot in snapshots:
+        main_tables: Dict[str, str] = {}
+        subnet_tables: Dict[str, str] = {}
+        for route_table in snapshot.route_tables:
+            table, vpc = label(route_table['RouteTableId']), label(route_table['VpcId'])
+            model.add_route_table(table, vpc)
+            for association in route_table.get('Associations', []):
+                if association.get('Main'):
+                    main_tables[route_table['VpcId']] = table
+                elif association.get('SubnetId'):
+                    subnet_tables[association['SubnetId']] = table
+            for route in route_table.get('Routes', []):
+                # the local route comes with the table; IPv6 and prefix list routes are not modelled
+                if route.get('GatewayId') == 'local' or not route.get('DestinationCidrBlock'):
+                    continue
+                kind, target = _vpc_route(route)
+                model.add_route(table, route['DestinationCidrBlock'], kind, label(target) if target else None)
+        for subnet in snapshot.subnets:
+            # subnets without a table of their own use their VPC's main one
+            table = subnet_tables.get(subnet['SubnetId']) or main_tables.get(subnet['VpcId'])
+            if table:
+                model.add_subnet(label(subnet['SubnetId']), label(subnet['VpcId']), subnet['CidrBlock'], table)
+
+        for attachment in snapshot.attachments:
+            # a peering shows up in both regions, naming the gateway at the far end as its resource
+            if attachment['TransitGatewayAttachmentId'] in model.attachments:
+                continue
+            tgw = label(attachment['TransitGatewayId'])
+            if attachment.get('ResourceType') == 'vpc' and label(attachment['ResourceId']) in model.vpcs:
+                model.add_attachment(label(attachment['TransitGatewayAttachmentId']), tgw,
+                                     vpc=label(attachment['ResourceId']))
+            elif attachment.get('ResourceType') == 'peering':
+                model.add_attachment(label(attachment['TransitGatewayAttachmentId']), tgw,
+                                     peer=label(attachment['ResourceId']))
+        for tgw_id, routes in snapshot.tgw_routes.items():
+            for route in routes:
+                if route.get('State') == 'blackhole':
+                    model.add_tgw_route(label(tgw_id), route['DestinationCidrBlock'], None)
+                    continue
+                # an active route always names its attachment; one that does not cannot be followed
+                attachments = route.get('TransitGatewayAttachments') or [{}]
+                if attachments[0].get('TransitGatewayAttachmentId'):
+                    model.add_tgw_route(label(tgw_id), route['DestinationCidrBlock'],
+                                        label(attachments[0]['TransitGatewayAttachmentId']))
+
+        rules = parse_security_groups([group['GroupId'] for group in snapshot.security_groups],
+                                      snapshot.security_groups)
+        for instance in snapshot.instances:
+            if not instance.get('PrivateIpAddress') or label(instance['SubnetId']) not in model.subnets:
+                continue
+            instance_name = label(instance['InstanceId'])
+            endpoint = instance['InstanceId'] if instance_name == instance['InstanceId'] else \
+                f'{instance_name}/{instance["InstanceId"]}'
+            groups = {group['GroupId'] for group in instance.get('SecurityGroups', [])}
+            groups.update(group['GroupId'] for interface in instance.get('NetworkInterfaces', [])
+                          for group in interface.get('Groups', []))
+            model.add_endpoint(endpoint, label(instance['SubnetId']), instance['PrivateIpAddress'],
+                               (rule for group_id in sorted(groups) for rule in rules.get(group_id, ())))
+    return model
+
+
+def snapshot_model(environment: str, regions: Sequence[str], state: Optional[Dict[str, object]] = None,
+                   account: Optional[str] = None, workers: int = DEFAULT_SNAPSHOT_WORKERS) -> NetworkModel:
+    # the network one environment has in AWS now, from every region at once; state is the section's state file
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(workers, len(regions)) or 1, thread_name_prefix='snapshot') as pool:
+        snapshots = list(pool.map(lambda region: snapshot_region(region, environment, account), regions))
+    model = model_from_snapshot(environment, snapshots, state)
+    logger.info(f'Snapshot of {environment}: {len(model.route_tables)} route table(s), '
+                f'{len(model.tgw_routes)} transit gateway(s), {len(model.endpoints)} instance(s) in {len(regions)} '
+                f'region(s) in {time.monotonic() - started:.1f}s')
+    return model
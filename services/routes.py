@@ -0,0 +1,209 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from botocore.exceptions import ClientError
+
+from utils.engine import state_keys
+from utils.utils import load_config
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_ROUTE_WORKERS = 8
+# the target fields describe_route_tables can report; only one of them is set on a route
+VPC_ROUTE_TARGETS = ('GatewayId', 'TransitGatewayId', 'NatGatewayId', 'VpcPeeringConnectionId', 'NetworkInterfaceId',
+                     'InstanceId', 'EgressOnlyInternetGatewayId', 'CarrierGatewayId', 'LocalGatewayId',
+                     'CoreNetworkArn')
+TGW_ROUTE_TARGET = 'TransitGatewayAttachmentId'
+
+# destination -> (target field, target id); a blackhole route has no target id
+RouteMap = Dict[str, Tuple[str, Optional[str]]]
+
+
+@dataclass(frozen=True)
+class Route:
+    destination: str
+    # the state key of the target, resolved to its id when the routes are reconciled
+    target: str
+    target_type: str = 'TransitGatewayId'
+
+
+@dataclass(frozen=True)
+class RouteChange:
+    action: str
+    route_table_id: str
+    destination: str
+    target_type: Optional[str] = None
+    target_id: Optional[str] = None
+
+    def __str__(self):
+        target = f' -> {self.target_id}' if self.action != 'delete' else ''
+        return f'{self.action} {self.destination}{target} in {self.route_table_id}'
+
+
+class RouteReconcileError(Exception):
+    def __init__(self, failed: Dict[RouteChange, BaseException]):
+        self.failed = failed
+        super().__init__(f'{len(failed)} route change(s) failed: {", ".join(map(str, failed))}')
+
+
+def route_state_keys(routes: Mapping[str, Sequence[Route]]) -> Tuple[str, ...]:
+    # the state keys a reconcile step reads, so the engine runs it after whatever creates them
+    keys = []
+    for route_table, table_routes in routes.items():
+        keys.append(route_table)
+        keys.extend(route.target for route in table_routes)
+    return tuple(dict.fromkeys(keys))
+
+
+def diff_routes(route_table_id: str, desired: RouteMap, actual: RouteMap, prune: bool = True) -> List[RouteChange]:
+    changes = []
+    for destination, (target_type, target_id) in desired.items():
+        current = actual.get(destination)
+        if current is None:
+            changes.append(RouteChange('create', route_table_id, destination, target_type, target_id))
+        elif current != (target_type, target_id):
+            changes.append(RouteChange('replace', route_table_id, destination, target_type, target_id))
+    if prune:
+        changes.extend(RouteChange('delete', route_table_id, destination)
+                       for destination in actual if destination not in desired)
+    return changes
+
+
+def desired_routes(routes: Mapping[str, Sequence[Route]], filename: str) -> Dict[str, RouteMap]:
+    state = load_config(filename=filename)
+    return {state[route_table]: {route.destination: (route.target_type, state[route.target]) for route in table_routes}
+            for route_table, table_routes in routes.items()}
+
+
+def _vpc_routes(client, route_table_ids: List[str]) -> Dict[str, RouteMap]:
+    # one paginated describe for every table instead of one per route
+    paginator = client.get_paginator('describe_route_tables')
+    pages = paginator.paginate(RouteTableIds=route_table_ids)
+    return parse_route_tables(route_table_ids, (route_table for page in pages for route_table in page['RouteTables']))
+
+
+def parse_route_tables(route_table_ids: List[str], route_tables: Iterable[dict]) -> Dict[str, RouteMap]:
+    actual: Dict[str, RouteMap] = {route_table_id: {} for route_table_id in route_table_ids}
+    for route_table in route_tables:
+        routes = actual[route_table['RouteTableId']]
+        for route in route_table.get('Routes', []):
+            destination = route.get('DestinationCidrBlock') or route.get('DestinationIpv6CidrBlock')
+            # the local route and propagated routes are not ours to manage
+            if not destination or route.get('GatewayId') == 'local' or \
+                    route.get('Origin', 'CreateRoute') != 'CreateRoute':
+                continue
+            target_type = next((key for key in VPC_ROUTE_TARGETS if route.get(key)), None)
+            target_id = route.get(target_type) if route.get('State') != 'blackhole' else None
+            routes[destination] = (target_type, target_id)
+    return actual
+
+
+def tgw_routes_request(route_table_id: str) -> dict:
+    # not paginated: one call returns up to 1000 routes
+    return dict(TransitGatewayRouteTableId=route_table_id, Filters=[{'Name': 'type', 'Values': ['static']}])
+
+
+def parse_tgw_routes(route_table_id: str, response: dict) -> RouteMap:
+    if response.get('AdditionalRoutesAvailable'):
+        logger.warning(f'{route_table_id} has more than 1000 static routes, only the first 1000 are reconciled')
+    routes: RouteMap = {}
+    for route in response.get('Routes', []):
+        attachments = route.get('TransitGatewayAttachments') or [{}]
+        target_id = attachments[0].get(TGW_ROUTE_TARGET) if route.get('State') != 'blackhole' else None
+        routes[route['DestinationCidrBlock']] = (TGW_ROUTE_TARGET, target_id)
+    return routes
+
+
+def _tgw_routes(client, route_table_id: str) -> RouteMap:
+    return parse_tgw_routes(route_table_id, client.search_transit_gateway_routes(**tgw_routes_request(route_table_id)))
+
+
+def vpc_change_request(change: RouteChange) -> Tuple[str, dict]:
+    # (client method, arguments) applying the change
+    if change.action == 'delete':
+        return 'delete_route', dict(RouteTableId=change.route_table_id, DestinationCidrBlock=change.destination)
+    return f'{change.action}_route', dict(RouteTableId=change.route_table_id, DestinationCidrBlock=change.destination,
+                                          **{change.target_type: change.target_id})
+
+
+def tgw_change_request(change: RouteChange) -> Tuple[str, dict]:
+    request = dict(TransitGatewayRouteTableId=change.route_table_id, DestinationCidrBlock=change.destination)
+    if change.action != 'delete':
+        request['TransitGatewayAttachmentId'] = change.target_id
+    return f'{change.action}_transit_gateway_route', request
+
+
+def _apply_vpc_change(client, change: RouteChange):
+    method, request = vpc_change_request(change)
+    return getattr(client, method)(**request)
+
+
+def _apply_tgw_change(client, change: RouteChange):
+    method, request = tgw_change_request(change)
+    return getattr(client, method)(**request)
+
+
+def _apply_changes(client, apply: Callable, changes: List[RouteChange], workers: int):
+    failed: Dict[RouteChange, BaseException] = {}
+
+    def run(change: RouteChange):
+        try:
+            apply(client, change)
+            logger.info(f'Route {change}')
+        except ClientError as e:
+            logger.exception(f'Could not {change}')
+            failed[change] = e
+
+    if changes:
+        # changes to different tables (and destinations) are independent, so they all go out at once
+        with ThreadPoolExecutor(max_workers=min(workers, len(changes)), thread_name_prefix='routes') as pool:
+            list(pool.map(run, changes))
+    if failed:
+        raise RouteReconcileError(failed)
+
+
+def plan_changes(desired: Dict[str, RouteMap], actual: Dict[str, RouteMap], prune: bool) -> List[RouteChange]:
+    changes = [change for route_table_id, table_routes in desired.items()
+               for change in diff_routes(route_table_id, table_routes, actual.get(route_table_id, {}), prune)]
+    unchanged = sum(len(table_routes) for table_routes in desired.values()) - \
+        sum(change.action != 'delete' for change in changes)
+    logger.info(f'{len(changes)} route change(s) in {len(desired)} route table(s), '
+                f'{unchanged} route(s) already in place')
+    return changes
+
+
+def _reconcile(client, routes: Mapping[str, Sequence[Route]], filename: str, prune: bool, workers: int,
+               fetch: Callable[[List[str]], Dict[str, RouteMap]], apply: Callable) -> List[RouteChange]:
+    desired = desired_routes(routes, filename)
+    changes = plan_changes(desired, fetch(list(desired)), prune)
+    _apply_changes(client, apply, changes, workers)
+    return changes
+
+
+def route_count(kwargs: dict) -> int:
+    return sum(len(table_routes) for table_routes in kwargs['routes'].values())
+
+
+# one describe for all tables, then (on a fresh bring-up) one call per route
+@state_keys(api_calls=lambda kwargs: 1 + route_count(kwargs))
+def reconcile_vpc_routes(client, routes: Mapping[str, Sequence[Route]], filename: str, prune: bool = True,
+                         workers: int = DEFAULT_ROUTE_WORKERS) -> List[RouteChange]:
+    # routes maps route table state keys to every route the table should have besides the local one;
+    # with prune, routes that are not listed are deleted
+    return _reconcile(client, routes, filename, prune, workers, lambda ids: _vpc_routes(client, ids), _apply_vpc_change)
+
+
+@state_keys(api_calls=lambda kwargs: len(kwargs['routes']) + route_count(kwargs))
+def reconcile_tgw_routes(client, routes: Mapping[str, Sequence[Route]], filename: str, prune: bool = True,
+                         workers: int = DEFAULT_ROUTE_WORKERS) -> List[RouteChange]:
+    # the same for the static routes of transit gateway route tables; propagated routes are left alone
+    def fetch(route_table_ids: List[str]) -> Dict[str, RouteMap]:
+        with ThreadPoolExecutor(max_workers=min(workers, len(route_table_ids)) or 1,
+                                thread_name_prefix='routes') as pool:
+            return dict(zip(route_table_ids, pool.map(lambda x: _tgw_routes(client, x), route_table_ids)))
+
+    return _reconcile(client, routes, filename, prune, workers, fetch, _apply_tgw_change)
@@ -0,0 +1,142 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Sequence, Tuple
+
+from botocore.exceptions import ClientError
+
+from utils.engine import state_keys
+from utils.rules import Rule, compile_rules, protocol_name
+from utils.utils import load_config
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_RULE_WORKERS = 8
+# what the scenario scripts' instances accept: SSH and ping from anywhere
+DEFAULT_RULES = tuple(compile_rules([Rule('tcp', 22, 22, '0.0.0.0/0'), Rule('icmp', -1, -1, '0.0.0.0/0')]))
+
+# group id -> the inbound rules it has
+RuleMap = Dict[str, FrozenSet[Rule]]
+
+
+@dataclass(frozen=True)
+class RuleChange:
+    # authorize or revoke; all rules of one group go in one call
+    action: str
+    group_id: str
+    rules: Tuple[Rule, ...]
+
+    def __str__(self):
+        return f'{self.action} {", ".join(map(str, self.rules))} in {self.group_id}'
+
+
+class SecurityGroupReconcileError(Exception):
+    def __init__(self, failed: Dict[RuleChange, BaseException]):
+        self.failed = failed
+        super().__init__(f'{len(failed)} security group change(s) failed: {", ".join(map(str, failed))}')
+
+
+def ip_permissions(rules: Iterable[Rule]) -> List[dict]:
+    # one permission per protocol and port range, with all of its CIDRs
+    by_ports: Dict[Tuple[str, int, int], List[Rule]] = defaultdict(list)
+    for rule in sorted(rules):
+        by_ports[(rule.protocol, rule.from_port, rule.to_port)].append(rule)
+    permissions = []
+    for (protocol, from_port, to_port), port_rules in by_ports.items():
+        permission = {'IpProtocol': protocol}
+        if protocol != '-1':
+            permission.update(FromPort=from_port, ToPort=to_port)
+        v4 = [{'CidrIp': rule.cidr} for rule in port_rules if ':' not in rule.cidr]
+        v6 = [{'CidrIpv6': rule.cidr} for rule in port_rules if ':' in rule.cidr]
+        if v4:
+            permission['IpRanges'] = v4
+        if v6:
+            permission['Ipv6Ranges'] = v6
+        permissions.append(permission)
+    return permissions
+
+
+def parse_security_groups(group_ids: List[str], security_groups: Iterable[dict]) -> RuleMap:
+    # rules on other security groups or prefix lists are not ours to manage
+    actual: Dict[str, set] = {group_id: set() for group_id in group_ids}
+    for security_group in security_groups:
+        rules = actual[security_group['GroupId']]
+        for permission in security_group.get('IpPermissions', []):
+            protocol = protocol_name(permission['IpProtocol'])
+            from_port, to_port = permission.get('FromPort', -1), permission.get('ToPort', -1)
+            rules.update(Rule(protocol, from_port, to_port, ip_range['CidrIp'])
+                         for ip_range in permission.get('IpRanges', []))
+            rules.update(Rule(protocol, from_port, to_port, ip_range['CidrIpv6'])
+                         for ip_range in permission.get('Ipv6Ranges', []))
+    return {group_id: frozenset(rules) for group_id, rules in actual.items()}
+
+
+def desired_rules(groups: Mapping[str, Sequence[Rule]], filename: str) -> RuleMap:
+    state = load_config(filename=filename)
+    return {state[group]: frozenset(rules) for group, rules in groups.items()}
+
+
+def plan_rule_changes(desired: RuleMap, actual: RuleMap, prune: bool) -> List[RuleChange]:
+    # per group at most one authorize and one revoke; authorizing goes first, so traffic that stays allowed
+    # under a reshaped rule is never cut off in between
+    changes = []
+    for group_id, rules in desired.items():
+        current = actual.get(group_id, frozenset())
+        missing = tuple(sorted(rules - current))
+        if missing:
+            changes.append(RuleChange('authorize', group_id, missing))
+        stale = tuple(sorted(current - rules))
+        if prune and stale:
+            changes.append(RuleChange('revoke', group_id, stale))
+    unchanged = sum(len(rules & actual.get(group_id, frozenset())) for group_id, rules in desired.items())
+    logger.info(f'{len(changes)} security group change(s) in {len(desired)} group(s), '
+                f'{unchanged} rule(s) already in place')
+    return changes
+
+
+def rule_change_request(change: RuleChange) -> Tuple[str, dict]:
+    return f'{change.action}_security_group_ingress', dict(GroupId=change.group_id,
+                                                           IpPermissions=ip_permissions(change.rules))
+
+
+def _security_groups(client, group_ids: List[str]) -> RuleMap:
+    paginator = client.get_paginator('describe_security_groups')
+    pages = paginator.paginate(GroupIds=group_ids)
+    return parse_security_groups(group_ids, (group for page in pages for group in page['SecurityGroups']))
+
+
+def _apply_changes(client, changes: List[RuleChange], workers: int):
+    failed: Dict[RuleChange, BaseException] = {}
+
+    def run(change: RuleChange):
+        method, request = rule_change_request(change)
+        try:
+            getattr(client, method)(**request)
+            logger.info(f'Security group rules: {change}')
+        except ClientError as e:
+            logger.exception(f'Could not {change}')
+            failed[change] = e
+
+    # groups are independent of each other; within a group the revoke waits for the authorize
+    for action in ('authorize', 'revoke'):
+        batch = [change for change in changes if change.action == action]
+        if batch:
+            with ThreadPoolExecutor(max_workers=min(workers, len(batch)), thread_name_prefix='rules') as pool:
+                list(pool.map(run, batch))
+    if failed:
+        raise SecurityGroupReconcileError(failed)
+
+
+# one describe for every group of the region, then (on a fresh bring-up) one authorize per group
+@state_keys(api_calls=lambda kwargs: 1 + len(kwargs['groups']))
+def reconcile_security_groups(client, groups: Mapping[str, Sequence[Rule]], filename: str, prune: bool = True,
+                              workers: int = DEFAULT_RULE_WORKERS) -> List[RuleChange]:
+    # groups maps security group state keys to every inbound rule the group should have, as compiled by
+    # utils.rules.compile_rules; with prune, CIDR rules that are not listed are revoked
+    desired = desired_rules(groups, filename)
+    changes = plan_rule_changes(desired, _security_groups(client, list(desired)), prune)
+    _apply_changes(client, changes, workers)
+    return changes
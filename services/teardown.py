@@ -0,0 +1,223 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from botocore.exceptions import ClientError
+
+from services.inventory import name_index
+from services.waiters import DEFAULT_TIMEOUT, backoff_delays, wait_for_instances_terminated, \
+    wait_for_transit_gateway_attachment_deleted, wait_for_transit_gateway_deleted
+from utils.engine import ProvisioningEngine, ProvisioningError, RetryStep
+from utils.journal import StepJournal
+from utils.plan import Plan, PlannedStep, plan_phases
+from utils.utils import load_config, delete_config
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# deletes mostly wait on AWS, not on the CPU, so more of them can be in flight per region than creates
+DEFAULT_TEARDOWN_WORKERS = 8
+
+# the resource is still referenced by something that is on its way out (ENIs detaching, attachments deleting)
+DEPENDENCY_ERROR_CODES = ('DependencyViolation', 'IncorrectState', 'InvalidState', 'ResourceInUse')
+# besides *.NotFound: what is being undone is already undone
+GONE_ERROR_CODES = ('Gateway.NotAttached',)
+
+
+class TeardownError(ProvisioningError):
+    pass
+
+
+def _error_code(e: ClientError) -> str:
+    return e.response.get('Error', {}).get('Code', '')
+
+
+def _is_gone(code: str) -> bool:
+    return code.endswith('.NotFound') or code in GONE_ERROR_CODES
+
+
+def _as_list(value: Union[str, List[str]]) -> List[str]:
+    # fleet launches persist a list of ids per name, older state files a single id
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _terminate_instances(client, instance_ids, **_):
+    client.terminate_instances(InstanceIds=_as_list(instance_ids))
+
+
+def _wait_for_instances_terminated(client, instance_ids):
+    wait_for_instances_terminated(client, _as_list(instance_ids))
+
+
+def _delete_tgw_vpc_attachment(client, attachment_id: str, **_):
+    client.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=attachment_id)
+
+
+def _delete_tgw_peering_attachment(client, attachment_id: str, **_):
+    client.delete_transit_gateway_peering_attachment(TransitGatewayAttachmentId=attachment_id)
+
+
+def _delete_tgw(client, tgw_id: str, **_):
+    client.delete_transit_gateway(TransitGatewayId=tgw_id)
+
+
+def _delete_security_group(client, group_id: str, **_):
+    client.delete_security_group(GroupId=group_id)
+
+
+def _delete_subnet(client, subnet_id: str, **_):
+    client.delete_subnet(SubnetId=subnet_id)
+
+
+def _delete_route_table(client, rt_id: str, **_):
+    response = client.describe_route_tables(RouteTableIds=[rt_id])
+    for route_table in response['RouteTables']:
+        for association in route_table.get('Associations', []):
+            if not association.get('Main'):
+                client.disassociate_route_table(AssociationId=association['RouteTableAssociationId'])
+    client.delete_route_table(RouteTableId=rt_id)
+
+
+def _delete_igw(client, igw_id: str, vpc_id: Optional[str] = None, **_):
+    if vpc_id:
+        try:
+            client.detach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+        except ClientError as e:
+            if not _is_gone(_error_code(e)):
+                raise
+    client.delete_internet_gateway(InternetGatewayId=igw_id)
+
+
+def _delete_vpc(client, vpc_id: str, **_):
+    client.delete_vpc(VpcId=vpc_id)
+
+
+# kind: (delete call, waiter for the resource to be gone, or None when the delete is synchronous)
+RESOURCE_KINDS: Dict[str, Tuple[Callable, Optional[Callable]]] = {
+    'instances': (_terminate_instances, _wait_for_instances_terminated),
+    'tgw_vpc_attachment': (_delete_tgw_vpc_attachment, wait_for_transit_gateway_attachment_deleted),
+    'tgw_peering_attachment': (_delete_tgw_peering_attachment, wait_for_transit_gateway_attachment_deleted),
+    'tgw': (_delete_tgw, wait_for_transit_gateway_deleted),
+    'security_group': (_delete_security_group, None),
+    'subnet': (_delete_subnet, None),
+    'route_table': (_delete_route_table, None),
+    'igw': (_delete_igw, None),
+    'vpc': (_delete_vpc, None),
+}
+
+
+# AWS calls a delete makes besides the one delete call; waiters count one poll
+_EXTRA_DELETE_CALLS = {'route_table': 2, 'igw': 1}
+
+
+class _Teardown:
+    # One resource: delete it, re-queue on dependency errors until the blockers are gone or the deadline
+    # passes, then wait for it to actually be gone and drop it from the state file.
+    def __init__(self, kind: str, key: str, client, resource_id, filename: str, timeout: float, **references):
+        self.kind = kind
+        self.key = key
+        self.client = client
+        self.resource_id = resource_id
+        self.filename = filename
+        self.timeout = timeout
+        self.references = references
+        self.deadline: Optional[float] = None
+        self.delays = None
+        self.deleted = False
+        self.deletes = (key,)
+        self.api_calls = 1 + _EXTRA_DELETE_CALLS.get(kind, 0) + (RESOURCE_KINDS[kind][1] is not None)
+
+    def _start(self):
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.timeout
+            self.delays = backoff_delays()
+
+    def _delete_failed(self, e: ClientError):
+        code = _error_code(e)
+        if code in DEPENDENCY_ERROR_CODES and time.monotonic() < self.deadline:
+            raise RetryStep(next(self.delays), f'{self.key} is still in use ({code})') from e
+        if not _is_gone(code):
+            raise e
+        logger.info(f'{self.kind} {self.key} is already gone')
+
+    def _forget(self):
+        delete_config(self.filename, self.key)
+        for resource_id in _as_list(self.resource_id):
+            name_index.discard(resource_id)
+        # whatever created the resource has to run again on the next bring-up
+        StepJournal(self.filename).forget_outputs(self.key)
+
+    def __call__(self):
+        delete, wait = RESOURCE_KINDS[self.kind]
+        if not self.deleted:
+            self._start()
+            try:
+                delete(self.client, self.resource_id, **self.references)
+            except ClientError as e:
+                self._delete_failed(e)
+            self.deleted = True
+        if wait is not None:
+            wait(self.client, self.resource_id)
+        self._forget()
+
+
+class TeardownEngine:
+    # Resources are declared with what they were built on (depends_on); teardown runs that graph in
+    # reverse on the provisioning engine, so independent deletes run in parallel, per region.
+    engine_class = ProvisioningEngine
+    step_class = _Teardown
+
+    def __init__(self, filename: str, workers_per_region: int = DEFAULT_TEARDOWN_WORKERS,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.filename = filename
+        self.workers_per_region = workers_per_region
+        self.timeout = timeout
+        self.resources: Dict[str, dict] = {}
+
+    def add(self, kind: str, key: str, region: str, client, depends_on: Sequence[str] = (), **references):
+        # references name other state keys the delete call needs, e.g. the VPC an IGW is attached to
+        if kind not in RESOURCE_KINDS:
+            raise ValueError(f'Unknown resource kind {kind}')
+        if key in self.resources:
+            raise ValueError(f'Duplicate resource {key}')
+        self.resources[key] = dict(kind=kind, region=region, client=client, depends_on=tuple(depends_on),
+                                   references=references)
+
+    def absent(self, state: dict) -> List[str]:
+        return sorted(key for key in self.resources if key not in state)
+
+    def _engine(self, state: dict) -> ProvisioningEngine:
+        present = {key: resource for key, resource in self.resources.items() if key in state}
+        engine = self.engine_class(filename=self.filename, workers_per_region=self.workers_per_region)
+        for key, resource in present.items():
+            references = {name: state.get(value) for name, value in resource['references'].items()}
+            teardown = self.step_class(resource['kind'], key, resource['client'], state[key], self.filename,
+                                       self.timeout, **references)
+            # whatever was built on this resource has to be gone first
+            blockers = [self._label(x, present[x]) for x, other in present.items() if key in other['depends_on']]
+            engine.add(teardown, resource['region'], label=self._label(key, resource), after=blockers)
+        return engine
+
+    def plan_steps(self, state: dict, produced: Set[str] = frozenset(), offset: int = 0) -> List[PlannedStep]:
+        return self._engine(state).plan_steps(state, produced, offset)
+
+    def plan(self, state: Optional[dict] = None) -> Plan:
+        return plan_phases(self.filename, [self], state)
+
+    def _prepare(self) -> ProvisioningEngine:
+        state = load_config(filename=self.filename)
+        for key in self.absent(state):
+            logger.info(f'Nothing to delete for {key}')
+        return self._engine(state)
+
+    def run(self):
+        engine = self._prepare()
+        try:
+            return engine.run()
+        except ProvisioningError as e:
+            raise TeardownError(e.failed, e.skipped) from None
+
+    @staticmethod
+    def _label(key: str, resource: dict) -> str:
+        return f'delete {resource["kind"]} {key}'
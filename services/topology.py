@@ -0,0 +1,217 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from services.inventory import step_journal
+from services.routes import TGW_ROUTE_TARGET, Route, route_state_keys
+from services.teardown import TeardownEngine
+from utils.engine import ProvisioningEngine, Step
+from utils.rules import Rule
+from utils.topology import INTERNET, Topology, VpcSpec
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+class _Backend:
+    # What a plan is built from: the threaded services functions on boto3, or their asyncio variants
+    # (services.aio) on aiobotocore, which run as tasks on one event loop. Both have the same names and arguments.
+    def __init__(self, asynchronous: bool = False):
+        if asynchronous:
+            from services.aio import ec2, routes, security_groups, transit_gateways, vpc
+            from services.aio.teardown import AsyncTeardownEngine
+            from utils.aio import AsyncProvisioningEngine, get_async_client
+            self.engine_class, self.teardown_class = AsyncProvisioningEngine, AsyncTeardownEngine
+            self.client = self.resource = get_async_client
+        else:
+            from services import ec2, routes, security_groups, transit_gateways, vpc
+            from utils.clients import get_client, get_resource
+            self.engine_class, self.teardown_class = ProvisioningEngine, TeardownEngine
+            self.client, self.resource = get_client, get_resource
+        self.ec2, self.routes, self.transit_gateways, self.vpc = ec2, routes, transit_gateways, vpc
+        self.security_groups = security_groups
+
+
+class _RoutePlan:
+    # Routes collected while the plan is built, per region and route table, so each region gets one step that
+    # reads its route tables once and only issues the calls needed to match them.
+    def __init__(self):
+        self.routes: Dict[str, Dict[str, List[Route]]] = defaultdict(lambda: defaultdict(list))
+        self.after: Dict[str, List[Step]] = defaultdict(list)
+
+    def add(self, region: str, route_table: str, route: Route, after: Step):
+        self.routes[region][route_table].append(route)
+        if after not in self.after[region]:
+            self.after[region].append(after)
+
+    def add_steps(self, engine: ProvisioningEngine, backend: _Backend, reconcile, label: str, section: str):
+        for region, routes in self.routes.items():
+            routes = {route_table: tuple(table_routes) for route_table, table_routes in routes.items()}
+            engine.add(reconcile, region, label=f'{label} in {region}', inputs=route_state_keys(routes),
+                       after=self.after[region], client=backend.client('ec2', region), routes=routes,
+                       filename=section)
+
+
+class _RulePlan:
+    # The compiled inbound rules of every security group, per region: one step per region reads all of its
+    # groups at once and authorizes (or revokes) each group's rules in a single call.
+    def __init__(self):
+        self.groups: Dict[str, Dict[str, Tuple[Rule, ...]]] = defaultdict(dict)
+
+    def add(self, region: str, security_group: str, rules: List[Rule]):
+        self.groups[region][security_group] = tuple(rules)
+
+    def add_steps(self, engine: ProvisioningEngine, backend: _Backend, section: str):
+        for region, groups in self.groups.items():
+            engine.add(backend.security_groups.reconcile_security_groups, region,
+                       label=f'reconcile security groups in {region}', inputs=tuple(groups),
+                       client=backend.client('ec2', region), groups=dict(groups), filename=section)
+
+
+def _add_vpc(engine: ProvisioningEngine, backend: _Backend, topology: Topology, vpc: VpcSpec, section: str,
+             instance_stream: Optional[TextIO], vpc_routes: _RoutePlan, rules: _RulePlan):
+    region = vpc.region
+    resource = backend.resource('ec2', region)
+    client = backend.client('ec2', region)
+    network, ec2 = backend.vpc, backend.ec2
+    engine.add(network.create_vpc, region, resource=resource, name=vpc.name, ip_cidr=vpc.cidr, filename=section,
+               persist=True)
+    for subnet in vpc.subnets:
+        engine.add(network.create_subnet, region, resource=resource, subnet_name=subnet.name,
+                   subnet_ip_cidr=subnet.cidr, vpc_name=vpc.name, az=subnet.az, filename=section, persist=True)
+
+    # the main route table has to be picked up before any other route table exists in the VPC
+    main_route_table = engine.add(network.find_existing_route_tables, region, resource=resource,
+                                  route_table_name=vpc.main_route_table, vpc=vpc.name, filename=section, persist=True)
+    if vpc.internet_gateway:
+        engine.add(network.create_internet_gateways, region, resource=resource, ig_name=vpc.igw, filename=section,
+                   persist=True)
+        attach_igw = engine.add(network.attach_vpc_with_ig, region, resource=resource, vpc=vpc.name, igw=vpc.igw,
+                                filename=section)
+        vpc_routes.add(region, vpc.main_route_table, Route(INTERNET, vpc.igw, 'GatewayId'), after=attach_igw)
+        for subnet in vpc.subnets:
+            if not subnet.public:
+                engine.add(network.create_routing_table_associate, region, after=[main_route_table],
+                           resource=resource, route_table_name=subnet.route_table, vpc=vpc.name, subnet=subnet.name,
+                           filename=section, persist=True)
+
+    for subnet in vpc.subnets:
+        group = subnet.instances
+        if not group:
+            continue
+        # the rules come with the region's reconcile step, which leaves the instances free to launch meanwhile
+        engine.add(ec2.create_security_group, region, client=client, group_name=group.security_group,
+                   ec2_name=group.name, vpc=vpc.name, filename=section, persist=True, rules=())
+        rules.add(region, group.security_group, topology.ingress_rules(vpc, group))
+        engine.add(ec2.create_ec2, region, client=resource, ec2_name=group.name, subnet=subnet.name,
+                   security_group=group.security_group, keypair=group.keypair, enable_public_ip=subnet.public,
+                   image=topology.images[region], filename=section, persist=True, count=group.count,
+                   instance_type=group.instance_type or topology.instance_type, stream=instance_stream)
+
+
+def _add_transit(engine: ProvisioningEngine, backend: _Backend, topology: Topology, section: str,
+                 vpc_routes: _RoutePlan, tgw_routes: _RoutePlan):
+    tgws = backend.transit_gateways
+    ready: Dict[str, Step] = {}
+    for tgw in topology.transit_gateways:
+        client = backend.client('ec2', tgw.region)
+        engine.add(tgws.create_transit_gateway, tgw.region, client=client, tgw_name=tgw.name,
+                   tgw_route_table=tgw.route_table, filename=section, persist=True)
+        ready[tgw.name] = engine.add(tgws.wait_for_tgw, tgw.region, client=client, tgw=tgw.name, filename=section)
+
+    for vpc in topology.vpcs:
+        if not vpc.transit_gateway:
+            continue
+        client = backend.client('ec2', vpc.region)
+        engine.add(tgws.create_transit_gateway_attachments, vpc.region, after=[ready[vpc.transit_gateway]],
+                   client=client, tgw_attachment_name=vpc.attachment, tgw=vpc.transit_gateway, vpc=vpc.name,
+                   subnet=vpc.attachment_subnet().name, filename=section, persist=True)
+        attachment_ready = engine.add(tgws.wait_for_tgw_attachment, vpc.region, client=client,
+                                      tgw_attachment=vpc.attachment, filename=section)
+        for route_table in vpc.transit_route_tables():
+            for destination in topology.transit_destinations(vpc):
+                vpc_routes.add(vpc.region, route_table, Route(destination, vpc.transit_gateway),
+                               after=attachment_ready)
+
+    for peering in topology.peerings:
+        requester = topology.transit_gateway(peering.requester)
+        accepter = topology.transit_gateway(peering.accepter)
+        requester_client = backend.client('ec2', requester.region)
+        accepter_client = backend.client('ec2', accepter.region)
+        engine.add(tgws.create_transit_gateway_peering_connection, requester.region,
+                   after=[ready[requester.name], ready[accepter.name]], client=requester_client,
+                   tgw_peer_name=peering.name, tgw_1=requester.name, tgw_2=accepter.name,
+                   tgw_2_region=accepter.region, filename=section, persist=True)
+        # every peering is requested as soon as its gateways are up and accepted as soon as it is pending; the
+        # watches re-queue between polls, so a mesh's peerings all progress at once whatever the worker count
+        pending = engine.add(tgws.AttachmentWatch(('pendingAcceptance', 'available')), requester.region,
+                             label=f'wait for {peering.name} acceptance', client=requester_client,
+                             tgw_attachment=peering.name, filename=section)
+        accepted = engine.add(tgws.accept_tgw_peering_connection, accepter.region, after=[pending],
+                              client=accepter_client, tgw_peer_connect=peering.name, filename=section, persist=True)
+        peering_ready = engine.add(tgws.AttachmentWatch(), accepter.region, label=f'wait for {peering.name}',
+                                   after=[accepted], client=accepter_client, tgw_attachment=peering.name,
+                                   filename=section)
+        # each side routes the other side's VPCs over the peering attachment
+        for local, remote in ((requester, accepter), (accepter, requester)):
+            for vpc in topology.attached(remote.name):
+                tgw_routes.add(local.region, local.route_table, Route(vpc.cidr, peering.name, TGW_ROUTE_TARGET),
+                               after=peering_ready)
+
+
+def provisioning_plan(topology: Topology, section: Optional[str] = None, instance_stream: Optional[TextIO] = None,
+                      asynchronous: bool = False) -> ProvisioningEngine:
+    # the whole topology is one plan, so everything that does not depend on each other runs in parallel
+    section = section or topology.name
+    backend = _Backend(asynchronous)
+    # a run that died partway resumes from the steps it had not completed
+    engine = backend.engine_class(filename=section, journal=step_journal(section))
+    vpc_routes, tgw_routes, rules = _RoutePlan(), _RoutePlan(), _RulePlan()
+    for vpc in topology.vpcs:
+        _add_vpc(engine, backend, topology, vpc, section, instance_stream, vpc_routes, rules)
+    _add_transit(engine, backend, topology, section, vpc_routes, tgw_routes)
+    vpc_routes.add_steps(engine, backend, backend.routes.reconcile_vpc_routes, 'reconcile routes', section)
+    tgw_routes.add_steps(engine, backend, backend.routes.reconcile_tgw_routes, 'reconcile transit gateway routes',
+                         section)
+    rules.add_steps(engine, backend, section)
+    logger.info(f'Plan for {topology.name}: {len(engine.steps)} steps in {len(topology.regions)} region(s)')
+    return engine
+
+
+def teardown_plan(topology: Topology, section: Optional[str] = None, asynchronous: bool = False) -> TeardownEngine:
+    section = section or topology.name
+    backend = _Backend(asynchronous)
+    teardown = backend.teardown_class(filename=section)
+    for tgw in topology.transit_gateways:
+        teardown.add('tgw', tgw.name, tgw.region, backend.client('ec2', tgw.region))
+    for peering in topology.peerings:
+        accepter = topology.transit_gateway(peering.accepter)
+        teardown.add('tgw_peering_attachment', peering.name, accepter.region, backend.client('ec2', accepter.region),
+                     depends_on=[peering.requester, peering.accepter])
+
+    for vpc in topology.vpcs:
+        region = vpc.region
+        client = backend.client('ec2', region)
+        teardown.add('vpc', vpc.name, region, client)
+        if vpc.internet_gateway:
+            teardown.add('igw', vpc.igw, region, client, depends_on=[vpc.name], vpc_id=vpc.name)
+        for subnet in vpc.subnets:
+            route_table = vpc.route_table_of(subnet)
+            depends_on = [vpc.name]
+            if route_table != vpc.main_route_table:
+                # the main route table goes away with the VPC, the others have to be deleted
+                teardown.add('route_table', route_table, region, client, depends_on=[vpc.name])
+                depends_on.append(route_table)
+            teardown.add('subnet', subnet.name, region, client, depends_on=depends_on)
+
+            group = subnet.instances
+            if group:
+                teardown.add('security_group', group.security_group, region, client, depends_on=[vpc.name])
+                # public addresses keep the IGW from detaching until the public instances are gone
+                teardown.add('instances', group.name, region, client,
+                             depends_on=[subnet.name, group.security_group] + ([vpc.igw] if subnet.public else []))
+        if vpc.transit_gateway:
+            teardown.add('tgw_vpc_attachment', vpc.attachment, region, client,
+                         depends_on=[vpc.transit_gateway, vpc.name, vpc.attachment_subnet().name])
+    return teardown
@@ -1,32 +1,44 @@
 import logging
 import random
-import time
+from typing import Optional, Sequence
 
-import boto3
 from botocore.exceptions import ClientError
 
+from services.inventory import name_index
+from services.routes import TGW_ROUTE_TARGET, Route, RouteReconcileError, reconcile_tgw_routes, \
+    reconcile_vpc_routes
+from services.waiters import BATCH_WINDOW, DEFAULT_TIMEOUT, BatchPoller, Waiting, attachment_waiting, batch_poller, \
+    wait_for_transit_gateway, wait_for_transit_gateway_attachment
+from utils.engine import RetryStep, state_keys
+from utils.tags import tag_specifications
 from utils.utils import store_config, load_config
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s: %(levelname)s: %(message)s')
 
-account_id = "337332556540"
-
 
+@state_keys(outputs=('tgw_name', 'tgw_route_table'), get_or_create=True)
 def create_transit_gateway(client, tgw_name: str, tgw_route_table: str, filename: str, persist: bool):
     try:
-        tg = client.create_transit_gateway(
-            Description="Automated Transit gateway created to connect VPCs",
-            Options={
-                'AmazonSideAsn': random.randrange(64512, 65534),
-            }
-        )
+        existing = name_index.find(client, 'tgw', tgw_name, filename)
+        if existing:
+            tg = {'TransitGateway': existing}
+            logger.info(f'Reusing transit gateway {existing["TransitGatewayId"]} as {tgw_name}')
+        else:
+            tg = client.create_transit_gateway(
+                Description="Automated Transit gateway created to connect VPCs",
+                Options={
+                    'AmazonSideAsn': random.randrange(64512, 65534),
+                },
+                TagSpecifications=tag_specifications('transit-gateway', tgw_name, filename)
+            )
+            name_index.add(client, 'tgw', tgw_name, filename, tg['TransitGateway'])
+            logger.info(f'Transit gateway created : {tg}')
         if persist:
             store_config(value=tg['TransitGateway']['TransitGatewayId'], key=tgw_name, filename=filename)
             store_config(value=tg['TransitGateway']['Options']['AssociationDefaultRouteTableId'], key=tgw_route_table,
                          filename=filename)
-        logger.info(f'Transit gateway created : {tg}')
     except ClientError as e:
         logger.exception('Could not create transit gateway', e)
     else:
@@ -60,62 +72,82 @@ def delete_transit_gateway_peering_attachments(client, tgw_peer_id):
         return response
 
 
+def attaches(tgw_id: str, resource_id: str):
+    # matches the describe item of an attachment between the two; the two sides of a peering each describe
+    # it with their own gateway first
+    return lambda item: {item['TransitGatewayId'], item.get('ResourceId')} == {tgw_id, resource_id}
+
+
+@state_keys(inputs=('tgw', 'vpc', 'subnet'), outputs=('tgw_attachment_name',), get_or_create=True)
 def create_transit_gateway_attachments(client, tgw_attachment_name: str, tgw: str, vpc: str, subnet: str, filename: str,
                                        persist: bool):
     try:
         tgw_id = load_config(filename=filename, key=tgw)
         vpc_id = load_config(filename=filename, key=vpc)
         subnet_id = load_config(filename=filename, key=subnet)
-        tga = client.create_transit_gateway_vpc_attachment(
-            TransitGatewayId=tgw_id,
-            VpcId=vpc_id,
-            SubnetIds=[subnet_id],
-            TagSpecifications=[
-                {
-                    'ResourceType': 'transit-gateway-attachment',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': tgw_attachment_name
-                        },
-                    ]
-                },
-            ]
-        )
+        existing = name_index.find(client, 'tgw_attachment', tgw_attachment_name, filename,
+                                   matches=attaches(tgw_id, vpc_id))
+        if existing:
+            tga = {'TransitGatewayVpcAttachment': existing}
+            logger.info(f'Reusing transit gateway attachment {existing["TransitGatewayAttachmentId"]} '
+                        f'as {tgw_attachment_name}')
+        else:
+            tga = client.create_transit_gateway_vpc_attachment(
+                TransitGatewayId=tgw_id,
+                VpcId=vpc_id,
+                SubnetIds=[subnet_id],
+                TagSpecifications=tag_specifications('transit-gateway-attachment', tgw_attachment_name, filename)
+            )
+            attachment_id = tga['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId']
+            name_index.add(client, 'tgw_attachment', tgw_attachment_name, filename,
+                           {'TransitGatewayAttachmentId': attachment_id, 'TransitGatewayId': tgw_id,
+                            'ResourceId': vpc_id})
         if persist:
             store_config(value=tga['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId'],
                          key=tgw_attachment_name, filename=filename)
     except ClientError as e:
         logger.exception('Could not create transit gateway attachment', e)
+    else:
+        return tga
+
 
+def owner_account(response: dict) -> str:
+    return response['TransitGateways'][0]['OwnerId']
 
+
+@state_keys(inputs=('tgw_1', 'tgw_2'), outputs=('tgw_peer_name',), api_calls=2, get_or_create=True)
 def create_transit_gateway_peering_connection(client,
                                               tgw_peer_name: str,
                                               tgw_1: str,
                                               tgw_2: str,
                                               tgw_2_region: str,
                                               filename: str,
-                                              persist: bool):
+                                              persist: bool,
+                                              peer_account: Optional[str] = None):
+    # without peer_account both gateways are taken to belong to the account that owns tgw_1
     try:
         tgw_1_id = load_config(filename=filename, key=tgw_1)
         tgw_2_id = load_config(filename=filename, key=tgw_2)
-        tga = client.create_transit_gateway_peering_attachment(
-            TransitGatewayId=tgw_1_id,
-            PeerTransitGatewayId=tgw_2_id,
-            PeerAccountId=account_id,
-            PeerRegion=tgw_2_region,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'transit-gateway-attachment',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': tgw_peer_name
-                        },
-                    ]
-                },
-            ]
-        )
+        existing = name_index.find(client, 'tgw_attachment', tgw_peer_name, filename,
+                                   matches=attaches(tgw_1_id, tgw_2_id))
+        if existing:
+            tga = {'TransitGatewayPeeringAttachment': existing}
+            logger.info(f'Reusing transit gateway peering attachment {existing["TransitGatewayAttachmentId"]} '
+                        f'as {tgw_peer_name}')
+        else:
+            if peer_account is None:
+                peer_account = owner_account(client.describe_transit_gateways(TransitGatewayIds=[tgw_1_id]))
+            tga = client.create_transit_gateway_peering_attachment(
+                TransitGatewayId=tgw_1_id,
+                PeerTransitGatewayId=tgw_2_id,
+                PeerAccountId=peer_account,
+                PeerRegion=tgw_2_region,
+                TagSpecifications=tag_specifications('transit-gateway-attachment', tgw_peer_name, filename)
+            )
+            attachment_id = tga['TransitGatewayPeeringAttachment']['TransitGatewayAttachmentId']
+            name_index.add(client, 'tgw_attachment', tgw_peer_name, filename,
+                           {'TransitGatewayAttachmentId': attachment_id, 'TransitGatewayId': tgw_1_id,
+                            'ResourceId': tgw_2_id})
         if persist:
             store_config(value=tga['TransitGatewayPeeringAttachment']['TransitGatewayAttachmentId'],
                          key=tgw_peer_name, filename=filename)
@@ -125,6 +157,7 @@ def create_transit_gateway_peering_connection(client,
         return tga
 
 
+@state_keys(inputs=('tgw_peer_name',))
 def describe_transit_gateway_attachment(client,
                                         tgw_peer_name: str,
                                         filename: str,
@@ -138,6 +171,47 @@ def describe_transit_gateway_attachment(client,
         return desc
 
 
+@state_keys(inputs=('tgw',))
+def wait_for_tgw(client, tgw: str, filename: str):
+    tgw_id = load_config(filename=filename, key=tgw)
+    return wait_for_transit_gateway(client, tgw_id)
+
+
+@state_keys(inputs=('tgw_attachment',))
+def wait_for_tgw_attachment(client, tgw_attachment: str, filename: str, states=('available',)):
+    tgw_attachment_id = load_config(filename=filename, key=tgw_attachment)
+    return wait_for_transit_gateway_attachment(client, tgw_attachment_id, states=states)
+
+
+class AttachmentWatch:
+    # A wait on a transit gateway attachment that does not hold a worker while it waits: the first run hands the
+    # attachment to the region's batch poller, and the step re-queues (RetryStep) until the poller has seen it
+    # reach one of `states`, so all peerings of a mesh are watched at once however few workers a region has.
+    # One instance per step, it keeps the wait.
+    state_inputs = ('tgw_attachment',)
+    state_outputs = ()
+    api_calls = 1
+    poller_class = BatchPoller
+    __name__ = 'watch_tgw_attachment'
+
+    def __init__(self, states: Sequence[str] = ('available',), timeout: float = DEFAULT_TIMEOUT):
+        self.states = tuple(states)
+        self.timeout = timeout
+        self.waiting: Optional[Waiting] = None
+
+    def __call__(self, client, tgw_attachment: str, filename: str):
+        if self.waiting is None:
+            tgw_attachment_id = load_config(filename=filename, key=tgw_attachment)
+            self.waiting = attachment_waiting(tgw_attachment_id, self.states, self.timeout)
+            batch_poller(client, 'attachment', self.poller_class).submit(self.waiting)
+        if not self.waiting.done:
+            # look again right after the poller's next tick for this wait
+            raise RetryStep(self.waiting.delay + BATCH_WINDOW,
+                            f'{tgw_attachment} is {self.waiting.state or "not polled yet"}')
+        return self.waiting.result()
+
+
+@state_keys(inputs=('tgw_peer_connect',))
 def accept_tgw_peering_connection(client,
                                   tgw_peer_connect: str,
                                   filename: str,
@@ -148,36 +222,34 @@ def accept_tgw_peering_connection(client,
             TransitGatewayAttachmentId=tgw_peer_id
         )
     except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'IncorrectState':
+            # a peering reused from an earlier run is accepted already
+            logger.info(f'{tgw_peer_connect} is not pending acceptance')
+            return None
         logger.exception('Could not create transit gateway attachment', e)
     else:
         return response
 
 
+@state_keys(inputs=('tgw_route_table', 'tgw_peer_connect'), api_calls=2)
 def create_tgw_route_with_peering_attachment(client,
                                              tgw_route_table: str,
                                              vpc_network: str,
                                              tgw_peer_connect: str,
                                              filename: str):
+    # the route is only created if the table lacks it; the table's other static routes are left alone
     try:
-        tgw_peer_id = load_config(filename=filename, key=tgw_peer_connect)
-        tgw_rt_id = load_config(filename=filename, key=tgw_route_table)
-        response = client.create_transit_gateway_route(
-            DestinationCidrBlock=vpc_network,
-            TransitGatewayRouteTableId=tgw_rt_id,
-            TransitGatewayAttachmentId=tgw_peer_id
-        )
-    except ClientError as e:
-        logger.exception(f'Could not create route with tgw peering', e)
-    else:
-        return response
+        routes = {tgw_route_table: (Route(vpc_network, tgw_peer_connect, TGW_ROUTE_TARGET),)}
+        return reconcile_tgw_routes(client, routes, filename=filename, prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with tgw peering')
 
 
+@state_keys(inputs=('tgw', 'route_table'), api_calls=2)
 def create_route_with_tgw(client, tgw: str, vpc_network: str, route_table: str, filename: str):
+    # client is an EC2 resource here, as in the scenarios this was written for
     try:
-        tgw_id = load_config(filename=filename, key=tgw)
-        route_table_id = load_config(filename=filename, key=route_table)
-        route_table_client = client.RouteTable(route_table_id)
-        response = route_table_client.create_route(DestinationCidrBlock=vpc_network, TransitGatewayId=tgw_id)
-        logger.info(f'Route created with {tgw_id} and {vpc_network} in {route_table_id}')
-    except ClientError as e:
-        logger.exception(f'Could not create route with tgw', e)
+        return reconcile_vpc_routes(client.meta.client, {route_table: (Route(vpc_network, tgw),)}, filename=filename,
+                                    prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with tgw')
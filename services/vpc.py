@@ -1,6 +1,11 @@
 import logging
 from botocore.exceptions import ClientError
 
+from services.inventory import name_index
+from services.routes import Route, RouteReconcileError, reconcile_vpc_routes
+from services.waiters import wait_for_vpc
+from utils.engine import state_keys
+from utils.tags import tag_specifications
 from utils.utils import store_config, load_config, CONFIG_PATH, fetch_constants
 
 logger = logging.getLogger()
@@ -8,47 +13,68 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s: %(levelname)s: %(message)s')
 
 
+@state_keys(outputs=('name',), api_calls=2, get_or_create=True)
 def create_vpc(resource, name: str, ip_cidr: str, filename: str, persist: bool):
-    vpc = __create_vpc_util(client=resource, name=name, ip_cidr=ip_cidr)
-    logger.info(f'Custom VPC created: {vpc}')
+    # a VPC of that name left by an earlier run is reused if it has the same CIDR
+    existing = name_index.find(resource.meta.client, 'vpc', name, filename,
+                               matches=lambda item: item['CidrBlock'] == ip_cidr)
+    if existing:
+        vpc = resource.Vpc(existing['VpcId'])
+        if existing.get('State') != 'available':
+            wait_for_vpc(resource.meta.client, vpc.id)
+        logger.info(f'Reusing VPC {vpc.id} as {name}')
+    else:
+        vpc = __create_vpc_util(client=resource, name=name, ip_cidr=ip_cidr, filename=filename)
+        if vpc is None:
+            # logged by the util; with nothing stored, the engine fails the step
+            return
+        logger.info(f'Custom VPC created: {vpc}')
+        name_index.add(resource.meta.client, 'vpc', name, filename, {'VpcId': vpc.id, 'CidrBlock': ip_cidr})
     if persist:
         store_config(value=vpc.id, key=name, filename=filename)
     return vpc
 
 
-def __create_vpc_util(client, name: str, ip_cidr: str):
+def __create_vpc_util(client, name: str, ip_cidr: str, filename: str):
     try:
         vpc = client.create_vpc(CidrBlock=ip_cidr,
                                 InstanceTenancy='default',
-                                TagSpecifications=[{
-                                    'ResourceType': 'vpc',
-                                    'Tags': [{'Key': 'Name', 'Value': name}]}])
-        vpc.wait_until_available()
+                                TagSpecifications=tag_specifications('vpc', name, filename))
+        wait_for_vpc(client.meta.client, vpc.id)
     except ClientError as e:
-        logger.exception('Could not delete the VPC', e)
+        logger.exception('Could not create the VPC', e)
     else:
         return vpc
 
 
-def create_subnet(resource, subnet_name: str, subnet_ip_cidr: str, vpc_name: str, az: str, filename: str, persist: bool):
+@state_keys(inputs=('vpc_name',), outputs=('subnet_name',), get_or_create=True)
+def create_subnet(resource, subnet_name: str, subnet_ip_cidr: str, vpc_name: str, az: str, filename: str,
+                  persist: bool):
     vpc_id = load_config(filename=filename, key=vpc_name)
-    subnet = __create_subnet_util(client=resource, subnet_name=subnet_name, subnet_cidr=subnet_ip_cidr, vpc_id=vpc_id,
-                                  az=az)
-    logger.info(f'Subnet created: {subnet}')
+    existing = name_index.find(resource.meta.client, 'subnet', subnet_name, filename,
+                               matches=lambda item: item['VpcId'] == vpc_id and item['CidrBlock'] == subnet_ip_cidr)
+    if existing:
+        subnet = resource.Subnet(existing['SubnetId'])
+        logger.info(f'Reusing subnet {subnet.id} as {subnet_name}')
+    else:
+        subnet = __create_subnet_util(client=resource, subnet_name=subnet_name, subnet_cidr=subnet_ip_cidr,
+                                      vpc_id=vpc_id, az=az, filename=filename)
+        if subnet is None:
+            return
+        logger.info(f'Subnet created: {subnet}')
+        name_index.add(resource.meta.client, 'subnet', subnet_name, filename,
+                       {'SubnetId': subnet.id, 'VpcId': vpc_id, 'CidrBlock': subnet_ip_cidr})
     if persist:
         store_config(subnet.id, subnet_name, filename=filename)
     return subnet
 
 
-def __create_subnet_util(client, subnet_name: str, subnet_cidr: str, vpc_id: str, az: str):
+def __create_subnet_util(client, subnet_name: str, subnet_cidr: str, vpc_id: str, az: str, filename: str):
     try:
         subnet = client.create_subnet(CidrBlock=subnet_cidr,
                                       VpcId=vpc_id,
                                       AvailabilityZone=az,
-                                      TagSpecifications=[{
-                                          'ResourceType': 'subnet',
-                                          'Tags': [{'Key': 'Name', 'Value': subnet_name}]}
-                                      ])
+                                      TagSpecifications=tag_specifications('subnet', subnet_name, filename))
     except ClientError as e:
         logger.exception('Could not create a subnet', e)
     else:
@@ -92,10 +118,18 @@ def delete_igw(client, igw_id: str, vpc_id: str):
         return response
 
 
+@state_keys(outputs=('ig_name',), get_or_create=True)
 def create_internet_gateways(resource, ig_name: str, filename: str, persist=True):
     try:
-        igw = resource.create_internet_gateway()
-        logger.info(f'Internet Gateway created: {igw}')
+        existing = name_index.find(resource.meta.client, 'igw', ig_name, filename)
+        if existing:
+            igw = resource.InternetGateway(existing['InternetGatewayId'])
+            logger.info(f'Reusing Internet Gateway {igw.id} as {ig_name}')
+        else:
+            igw = resource.create_internet_gateway(
+                TagSpecifications=tag_specifications('internet-gateway', ig_name, filename))
+            logger.info(f'Internet Gateway created: {igw}')
+            name_index.add(resource.meta.client, 'igw', ig_name, filename, {'InternetGatewayId': igw.id})
         if persist:
             store_config(value=igw.id, key=ig_name, filename=filename)
     except ClientError as e:
@@ -104,6 +138,7 @@ def create_internet_gateways(resource, ig_name: str, filename: str, persist=True
         return igw
 
 
+@state_keys(inputs=('vpc', 'igw'))
 def attach_vpc_with_ig(resource, vpc: str, igw: str, filename: str):
     try:
         vpc_id = load_config(filename=filename, key=vpc)
@@ -118,52 +153,59 @@ def attach_vpc_with_ig(resource, vpc: str, igw: str, filename: str):
         return res
 
 
-def create_routing_table_associate(resource, route_table_name: str, vpc: str, subnet: str, filename: str, persist: bool):
+@state_keys(inputs=('vpc', 'subnet'), outputs=('route_table_name',), api_calls=2, get_or_create=True)
+def create_routing_table_associate(resource, route_table_name: str, vpc: str, subnet: str, filename: str,
+                                   persist: bool):
     try:
         vpc_id = load_config(filename=filename, key=vpc)
         subnet_id = load_config(filename=filename, key=subnet)
-        vpc_client = resource.Vpc(vpc_id)
-        route_table = vpc_client.create_route_table(TagSpecifications=[
-            {
-                'ResourceType': 'route-table',
-                'Tags': [
-                    {
-                        'Key': "Name",
-                        'Value': route_table_name
-                    },
-                ]
-            },
-        ])
-        logger.info(f"Route table created: {route_table}")
+        existing = name_index.find(resource.meta.client, 'route_table', route_table_name, filename,
+                                   matches=lambda item: item['VpcId'] == vpc_id)
+        if existing:
+            route_table = resource.RouteTable(existing['RouteTableId'])
+            logger.info(f'Reusing Route Table {route_table.id} as {route_table_name}')
+        else:
+            vpc_client = resource.Vpc(vpc_id)
+            route_table = vpc_client.create_route_table(
+                TagSpecifications=tag_specifications('route-table', route_table_name, filename))
+            logger.info(f"Route table created: {route_table}")
+            existing = {'RouteTableId': route_table.id, 'VpcId': vpc_id, 'Associations': []}
+            name_index.add(resource.meta.client, 'route_table', route_table_name, filename, existing)
         if persist:
             store_config(value=route_table.route_table_id, key=route_table_name, filename=filename)
-        response = route_table.associate_with_subnet(SubnetId=subnet_id)
-        logger.info(f"Route Table {route_table} associated with subnet {subnet_id}: {response}")
+        if any(association.get('SubnetId') == subnet_id for association in existing.get('Associations', [])):
+            logger.info(f'Route Table {route_table.id} is already associated with subnet {subnet_id}')
+        else:
+            response = route_table.associate_with_subnet(SubnetId=subnet_id)
+            existing.setdefault('Associations', []).append({'SubnetId': subnet_id})
+            logger.info(f"Route Table {route_table} associated with subnet {subnet_id}: {response}")
     except ClientError as e:
         logger.exception('Could not create routing table', e)
     else:
         return route_table
 
 
+@state_keys(inputs=('igw', 'route_table'), api_calls=2)
 def create_route_with_igw(resource, igw: str, route_table: str, destination_ip_cidr: str, filename: str):
-    route_table_id = load_config(filename=filename, key=route_table)
-    igw_id = load_config(filename=filename, key=igw)
-    route_table_client = resource.RouteTable(route_table_id)
-    route = route_table_client.create_route(DestinationCidrBlock=destination_ip_cidr,
-                                            GatewayId=igw_id)
-    if route:
-        logger.info(f"Route created for {igw_id} with {destination_ip_cidr}")
+    # the route is only created if the table lacks it; the table's other routes are left alone
+    try:
+        routes = {route_table: (Route(destination_ip_cidr, igw, 'GatewayId'),)}
+        return reconcile_vpc_routes(resource.meta.client, routes, filename=filename, prune=False)
+    except RouteReconcileError:
+        logger.exception('Could not create route with igw')
 
 
+@state_keys(inputs=('vpc',), outputs=('route_table_name',), get_or_create=True)
 def find_existing_route_tables(resource, route_table_name: str, vpc: str, filename: str, persist=True):
-    vpc1_id = load_config(filename=filename, key=vpc)
-    vpc1_client = resource.Vpc(vpc1_id)
-    route_tables = vpc1_client.route_tables.all()
-    rt = [x for x in route_tables]
-    if rt is not None:
-        logger.info(f'Route Tables found: {rt[0].id}')
+    # the VPC's main route table, the one its subnets use until they are given another
+    vpc_id = load_config(filename=filename, key=vpc)
+    response = resource.meta.client.describe_route_tables(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]},
+                                                                   {'Name': 'association.main', 'Values': ['true']}])
+    route_tables = response['RouteTables']
+    if route_tables:
+        logger.info(f'Route Tables found: {route_tables[0]["RouteTableId"]}')
         if persist:
-            store_config(value=rt[0].id, key=route_table_name, filename=filename)
+            store_config(value=route_tables[0]['RouteTableId'], key=route_table_name, filename=filename)
     else:
-        logger.exception('No Route tables found')
+        logger.error(f'No main route table found in {vpc_id}')
     return
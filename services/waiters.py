@@ -0,0 +1,396 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from utils.clients import client_account
+from utils.describe_cache import uncached
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_TIMEOUT = 900
+INITIAL_DELAY = 2.0
+MAX_DELAY = 30.0
+BACKOFF_FACTOR = 1.6
+
+# EC2 takes up to 200 values per filter
+MAX_BATCH_IDS = 200
+# how long a poller between ticks lets new waits gather before it describes them. The first wait on an idle
+# poller is described at once, as it would have been polling on its own, and waits that come in during a describe
+# go out right after it, together: they have gathered meanwhile.
+BATCH_WINDOW = 0.05
+
+# set while a batch poller describes. How many polls a wait takes is down to timing, so whoever counts API calls
+# can tell them apart from the calls a flow makes
+_polling: contextvars.ContextVar = contextvars.ContextVar('polling', default=False)
+
+
+class WaiterError(Exception):
+    pass
+
+
+class WaiterTimeoutError(WaiterError):
+    pass
+
+
+@contextmanager
+def polling():
+    token = _polling.set(True)
+    try:
+        yield
+    finally:
+        _polling.reset(token)
+
+
+def is_polling() -> bool:
+    return _polling.get()
+
+
+def backoff_delays(initial: float = INITIAL_DELAY, maximum: float = MAX_DELAY,
+                   factor: float = BACKOFF_FACTOR) -> Iterator[float]:
+    delay = initial
+    while True:
+        # equal jitter: never less than half the nominal delay, so callers polling together drift apart
+        yield random.uniform(delay / 2, delay)
+        delay = min(maximum, delay * factor)
+
+
+class StatePoller:
+    # The bookkeeping of one wait, apart from how the state is described and how to sleep, so the threaded and
+    # the asyncio waiters (services.aio.waiters) poll alike.
+    def __init__(self, targets: Sequence[str], description: str, failures: Sequence[str] = (),
+                 timeout: float = DEFAULT_TIMEOUT, initial_delay: float = INITIAL_DELAY, max_delay: float = MAX_DELAY):
+        self.targets = targets
+        self.description = description
+        self.failures = failures
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = time.monotonic() + timeout
+        self.delays = backoff_delays(initial_delay, max_delay)
+        self.last_state = None
+
+    def observe(self, state: Optional[str]) -> Tuple[bool, float]:
+        # (done, seconds until the next poll)
+        if state in self.targets:
+            logger.info(f'{self.description} is {state}')
+            return True, 0.0
+        if state in self.failures:
+            raise WaiterError(f'{self.description} entered terminal state {state}, expected {list(self.targets)}')
+        if state != self.last_state:
+            # the resource is making progress, so the next transition is likely to be close: poll eagerly again
+            logger.info(f'Waiting for {self.description}: {state}')
+            self.delays = backoff_delays(self.initial_delay, self.max_delay)
+            self.last_state = state
+
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaiterTimeoutError(f'Timed out after {self.timeout}s waiting for {self.description} '
+                                     f'to become {list(self.targets)}, last state {state}')
+        return False, min(next(self.delays), remaining)
+
+
+@dataclass(frozen=True)
+class BatchKind:
+    # How to describe many resources of one kind at once: by filter rather than by id, since a filter skips ids
+    # that do not exist (yet, or any more) where an id list fails the whole call
+    operation: str
+    filter_name: str
+    states: Callable[[dict], Iterable[Tuple[str, str]]]
+
+
+BATCH_KINDS: Dict[str, BatchKind] = {
+    'vpc': BatchKind('describe_vpcs', 'vpc-id',
+                     lambda page: ((vpc['VpcId'], vpc['State']) for vpc in page['Vpcs'])),
+    'transit_gateway': BatchKind('describe_transit_gateways', 'transit-gateway-id',
+                                 lambda page: ((tgw['TransitGatewayId'], tgw['State'])
+                                               for tgw in page['TransitGateways'])),
+    'attachment': BatchKind('describe_transit_gateway_attachments', 'transit-gateway-attachment-id',
+                            lambda page: ((attachment['TransitGatewayAttachmentId'], attachment['State'])
+                                          for attachment in page['TransitGatewayAttachments'])),
+    'instance': BatchKind('describe_instances', 'instance-id',
+                          lambda page: ((instance['InstanceId'], instance['State']['Name'])
+                                        for reservation in page['Reservations']
+                                        for instance in reservation['Instances'])),
+}
+
+
+class Waiting:
+    # One caller's wait on a batch poller: the ids it needs, how their states add up to the one it waits for,
+    # and its own StatePoller for targets, failures, timeout and the pace it would like to be polled at.
+    def __init__(self, ids: Sequence[str], summarize: Callable[[Dict[str, str]], Optional[str]],
+                 poller: StatePoller):
+        self.ids = tuple(ids)
+        self.summarize = summarize
+        self.poller = poller
+        # seconds until the wait wants its next poll; none yet before the first one
+        self.delay = 0.0
+        self.done = False
+        self.state: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+    def observe(self, found: Dict[str, str]):
+        try:
+            self.state = self.summarize(found)
+            self.done, self.delay = self.poller.observe(self.state)
+        except WaiterError as e:
+            self.fail(e)
+
+    def fail(self, error: BaseException):
+        self.done, self.error = True, error
+
+    def result(self) -> str:
+        if self.error is not None:
+            raise self.error
+        return self.state
+
+
+class BatchPollerBase:
+    # The bookkeeping of a batch poller, apart from how it describes and sleeps (BatchPoller below, the asyncio
+    # one in services.aio.waiters): every tick describes the ids of all current waits with one call per
+    # MAX_BATCH_IDS, hands each wait its states, and the next tick comes when the most eager wait wants it.
+    def __init__(self, client, kind: BatchKind, window: float = BATCH_WINDOW, batch_size: int = MAX_BATCH_IDS):
+        self.client = client
+        self.kind = kind
+        self.window = window
+        self.batch_size = batch_size
+        self.waiting: List[Waiting] = []
+        self.due = float('inf')
+        self.describing = False
+        self.calls = 0
+        # (account, region, kind, class) under which batch_poller hands the poller out
+        self.key: Optional[tuple] = None
+        self.retired = False
+
+    def _retire(self):
+        # nothing left to wait on: the poller lets go of its key, and of its client with it. A wait that comes in
+        # later, through a reference taken before, is handed to the poller holding the key by then.
+        if self.key is not None:
+            self.retired = True
+            _release(self)
+
+    def _successor(self) -> 'BatchPollerBase':
+        return batch_poller(self.client, self.key[2], type(self))
+
+    def _add(self, waiting: Waiting):
+        gathered = not self.waiting or self.describing
+        self.due = min(self.due, time.monotonic() + (0.0 if gathered else self.window))
+        self.waiting.append(waiting)
+
+    def _take(self) -> List[Waiting]:
+        # the waits this tick describes; waits added while it runs are due as soon as it is over
+        self.due, self.describing = float('inf'), True
+        return list(self.waiting)
+
+    def requests(self, batch: List[Waiting]) -> List[dict]:
+        ids = sorted({resource_id for waiting in batch for resource_id in waiting.ids})
+        return [{'Filters': [{'Name': self.kind.filter_name, 'Values': ids[start:start + self.batch_size]}]}
+                for start in range(0, len(ids), self.batch_size)]
+
+    def _deliver(self, batch: List[Waiting], found: Dict[str, str], error: Optional[BaseException]) -> List[Waiting]:
+        # only the waits the tick described get its states; the ones done are returned
+        self.describing = False
+        for waiting in batch:
+            if error is not None:
+                waiting.fail(error)
+            else:
+                waiting.observe(found)
+        finished = [waiting for waiting in batch if waiting.done]
+        self.waiting = [waiting for waiting in self.waiting if not waiting.done]
+        pending = [waiting.delay for waiting in batch if not waiting.done]
+        if pending:
+            self.due = min(self.due, time.monotonic() + min(pending))
+        return finished
+
+
+class BatchPoller(BatchPollerBase):
+    # Polls on a thread of its own, started when the first wait comes in and ended when the last one is done.
+    def __init__(self, client, kind: BatchKind, window: float = BATCH_WINDOW, batch_size: int = MAX_BATCH_IDS):
+        super().__init__(client, kind, window, batch_size)
+        self._events: Dict[int, threading.Event] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, waiting: Waiting) -> threading.Event:
+        # returns at once, with an event that is set once the wait is done
+        with self._condition:
+            if not self.retired:
+                self._add(waiting)
+                event = self._events[id(waiting)] = threading.Event()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f'poller-{self.kind.operation}',
+                                                    daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+                return event
+        return self._successor().submit(waiting)
+
+    def wait(self, waiting: Waiting) -> str:
+        self.submit(waiting).wait()
+        return waiting.result()
+
+    def _describe(self, requests: List[dict]) -> Dict[str, str]:
+        found = {}
+        paginator = self.client.get_paginator(self.kind.operation)
+        with polling(), uncached():
+            for request in requests:
+                for page in paginator.paginate(**request):
+                    self.calls += 1
+                    found.update(self.kind.states(page))
+        return found
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self.waiting:
+                        self._thread = None
+                        self._retire()
+                        return
+                    remaining = self.due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._take()
+            found, error = {}, None
+            try:
+                found = self._describe(self.requests(batch))
+            except Exception as e:
+                # every wait of the tick fails with the describe, as it would have polling on its own
+                error = e
+            with self._condition:
+                finished = self._deliver(batch, found, error)
+                for waiting in finished:
+                    self._events.pop(id(waiting)).set()
+
+
+_pollers: Dict[Tuple[Optional[str], str, str, type], BatchPollerBase] = {}
+_pollers_lock = threading.Lock()
+
+
+def batch_poller(client, kind: str, poller_class=BatchPoller) -> BatchPollerBase:
+    # one poller per account, region and kind, whichever of their clients (one per worker thread, for resources)
+    # the waits come with; it polls with the client of the wait that started it
+    key = (client_account(client), client.meta.region_name, kind, poller_class)
+    with _pollers_lock:
+        poller = _pollers.get(key)
+        if poller is None:
+            poller = _pollers[key] = poller_class(client, BATCH_KINDS[kind])
+            poller.key = key
+    return poller
+
+
+def _release(poller: BatchPollerBase):
+    with _pollers_lock:
+        if _pollers.get(poller.key) is poller:
+            del _pollers[poller.key]
+
+
+def vpc_waiting(vpc_id: str, states: Sequence[str] = ('available',), timeout: float = DEFAULT_TIMEOUT) -> Waiting:
+    # a VPC that has just been created can be missing from describe calls for a moment
+    return Waiting([vpc_id], lambda found: found.get(vpc_id, 'pending'),
+                   StatePoller(states, f'VPC {vpc_id}', timeout=timeout))
+
+
+def not_found_state(states: Sequence[str]) -> str:
+    # describe calls keep returning deleted gateways and attachments for a while and then leave them out, and can
+    # miss one that has just been created: an id that is missing is gone only if that is what the wait is for
+    return 'deleted' if 'deleted' in states else 'pending'
+
+
+def transit_gateway_failures(states: Sequence[str]) -> Tuple[str, ...]:
+    return ('deleted',) if 'deleted' not in states else ()
+
+
+def transit_gateway_waiting(tgw_id: str, states: Sequence[str] = ('available',),
+                            timeout: float = DEFAULT_TIMEOUT) -> Waiting:
+    return Waiting([tgw_id], lambda found: found.get(tgw_id, not_found_state(states)),
+                   StatePoller(states, f'transit gateway {tgw_id}', transit_gateway_failures(states), timeout))
+
+
+def attachment_failures(states: Sequence[str]) -> List[str]:
+    failures = ['failed', 'rejected']
+    if 'deleted' not in states:
+        failures.append('deleted')
+    return failures
+
+
+def attachment_waiting(attachment_id: str, states: Sequence[str] = ('available',),
+                       timeout: float = DEFAULT_TIMEOUT) -> Waiting:
+    # covers VPC and peering attachments alike;
+    # a peering request goes initiatingRequest -> pendingAcceptance -> pending -> available
+    return Waiting([attachment_id], lambda found: found.get(attachment_id, not_found_state(states)),
+                   StatePoller(states, f'transit gateway attachment {attachment_id}', attachment_failures(states),
+                               timeout))
+
+
+def instances_failures(state: str) -> Tuple[str, ...]:
+    return ('terminated',) if state != 'terminated' else ()
+
+
+def instances_not_found_state(state: str) -> str:
+    # freshly launched instances can briefly be unknown to describe_instances
+    return 'terminated' if state == 'terminated' else 'pending'
+
+
+def instances_state(found: Dict[str, str], instance_ids: Sequence[str], state: str) -> str:
+    states = {found.get(instance_id, instances_not_found_state(state)) for instance_id in instance_ids}
+    if states == {state}:
+        return state
+    failed = states.intersection(instances_failures(state))
+    if failed:
+        return failed.pop()
+    # report one of the stragglers so progress stays visible while instances move together
+    return sorted(states - {state})[0]
+
+
+def instances_description(instance_ids: Sequence[str], shown: int = 3) -> str:
+    if len(instance_ids) <= shown:
+        return f'instances {", ".join(instance_ids)}'
+    return f'{len(instance_ids)} instances ({", ".join(instance_ids[:shown])}, ...)'
+
+
+def instances_waiting(instance_ids: Sequence[str], state: str = 'running', timeout: float = DEFAULT_TIMEOUT) -> Waiting:
+    instance_ids = list(instance_ids)
+    return Waiting(instance_ids, lambda found: instances_state(found, instance_ids, state),
+                   StatePoller((state,), instances_description(instance_ids), instances_failures(state), timeout))
+
+
+def wait_for_vpc(client, vpc_id: str, timeout: float = DEFAULT_TIMEOUT) -> str:
+    return batch_poller(client, 'vpc').wait(vpc_waiting(vpc_id, timeout=timeout))
+
+
+def wait_for_transit_gateway(client, tgw_id: str, states: Sequence[str] = ('available',),
+                             timeout: float = DEFAULT_TIMEOUT) -> str:
+    return batch_poller(client, 'transit_gateway').wait(transit_gateway_waiting(tgw_id, states, timeout))
+
+
+def wait_for_transit_gateway_attachment(client, attachment_id: str, states: Sequence[str] = ('available',),
+                                        timeout: float = DEFAULT_TIMEOUT) -> str:
+    return batch_poller(client, 'attachment').wait(attachment_waiting(attachment_id, states, timeout))
+
+
+def wait_for_instances(client, instance_ids: Sequence[str], state: str = 'running',
+                       timeout: float = DEFAULT_TIMEOUT) -> str:
+    if not instance_ids:
+        # an empty filter would describe every instance in the region
+        return state
+    return batch_poller(client, 'instance').wait(instances_waiting(instance_ids, state, timeout))
+
+
+def wait_for_transit_gateway_deleted(client, tgw_id: str, timeout: float = DEFAULT_TIMEOUT) -> str:
+    return wait_for_transit_gateway(client, tgw_id, states=('deleted',), timeout=timeout)
+
+
+def wait_for_transit_gateway_attachment_deleted(client, attachment_id: str, timeout: float = DEFAULT_TIMEOUT) -> str:
+    return wait_for_transit_gateway_attachment(client, attachment_id, states=('deleted',), timeout=timeout)
+
+
+def wait_for_instances_terminated(client, instance_ids: Sequence[str], timeout: float = DEFAULT_TIMEOUT) -> str:
+    return wait_for_instances(client, instance_ids, state='terminated', timeout=timeout)
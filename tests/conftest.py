@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from utils import utils as config
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    # state files (and journals) of the test go to its own directory, as JSON
+    monkeypatch.setattr(config, 'CONFIG_PATH', str(tmp_path) + os.sep)
+    monkeypatch.setattr(config, '_state_db', None)
+    return tmp_path
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    # moto in place of EC2, as in benchmarks/bench.py
+    moto = pytest.importorskip('moto')
+    for variable in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(variable, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    with moto.mock_aws():
+        yield
+
+
+@pytest.fixture
+def ec2(aws):
+    import boto3
+    return boto3.client('ec2', region_name='us-east-1')
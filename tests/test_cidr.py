@@ -0,0 +1,89 @@
+import ipaddress
+import random
+
+import pytest
+
+from utils.cidr import AllocationError, CidrAllocator, IntervalIndex, PrefixTrie
+
+
+def test_interval_index_overlap_and_containment():
+    index = IntervalIndex()
+    index.add(10, 19, 'a')
+    index.add(30, 39, 'b')
+    index.add(20, 29, 'c')
+
+    assert [name for _, _, name in index] == ['a', 'c', 'b']
+    assert index.overlapping(15, 35) == ['a', 'c', 'b']
+    assert index.overlapping(0, 9) == []
+    assert index.is_free(40, 50) and not index.is_free(39, 50) and not index.is_free(0, 10)
+    with pytest.raises(AllocationError, match='overlaps c'):
+        index.add(25, 26, 'd')
+
+    index.remove(20)
+    assert index.is_free(20, 29) and len(index) == 2
+
+
+def test_interval_index_matches_a_scan():
+    rng = random.Random(7)
+    index, ranges = IntervalIndex(), []
+    for i in range(200):
+        start = rng.randrange(0, 10000)
+        end = start + rng.randrange(0, 50)
+        free = all(end < low or start > high for low, high in ranges)
+        assert index.is_free(start, end) == free
+        if free:
+            index.add(start, end, str(i))
+            ranges.append((start, end))
+
+
+def test_allocations_are_packed_and_aligned():
+    allocator = CidrAllocator('10.0.0.0/16')
+    assert str(allocator.allocate('a', 24)) == '10.0.0.0/24'
+    assert str(allocator.allocate('b', 22)) == '10.0.4.0/22'
+    # the /24 left over next to a is used before anything bigger is split
+    assert str(allocator.allocate('c', 24)) == '10.0.1.0/24'
+    assert str(allocator.allocate('d', 23)) == '10.0.2.0/23'
+    assert allocator.allocate('a', 24) == ipaddress.ip_network('10.0.0.0/24')
+    with pytest.raises(AllocationError, match='already holds'):
+        allocator.allocate('a', 25)
+
+
+def test_reserved_ranges_are_kept_and_allocated_around():
+    allocator = CidrAllocator('10.0.0.0/16', {'fixed': '10.0.0.0/24'})
+    assert str(allocator.allocate('next', 24)) == '10.0.1.0/24'
+    assert not allocator.is_free('10.0.0.128/25')
+    assert not allocator.is_free('10.1.0.0/24')
+    with pytest.raises(AllocationError, match='overlaps fixed'):
+        allocator.reserve('clash', '10.0.0.0/23')
+    with pytest.raises(AllocationError, match='outside'):
+        allocator.reserve('far', '192.168.0.0/24')
+    assert allocator.state() == {'fixed': '10.0.0.0/24', 'next': '10.0.1.0/24'}
+
+
+def test_release_merges_buddies_back():
+    allocator = CidrAllocator('10.0.0.0/24')
+    for name in 'abcd':
+        allocator.allocate(name, 26)
+    with pytest.raises(AllocationError, match='no free'):
+        allocator.allocate('e', 26)
+    for name in 'abcd':
+        allocator.release(name)
+    # the whole supernet is one block again
+    assert str(allocator.allocate('all', 24)) == '10.0.0.0/24'
+
+
+def test_prefix_trie_longest_match():
+    trie = PrefixTrie()
+    trie.insert('0.0.0.0/0', 'internet')
+    trie.insert('10.0.0.0/8', 'tgw')
+    trie.insert('10.1.0.0/16', 'local')
+    trie.insert('10.1.0.0/16', 'local again')
+
+    assert len(trie) == 3
+    assert trie.longest_match('10.1.2.3')[1] == 'local again'
+    assert trie.longest_match('10.2.0.1')[1] == 'tgw'
+    assert trie.longest_match('8.8.8.8') == (ipaddress.ip_network('0.0.0.0/0'), 'internet')
+    assert PrefixTrie().longest_match('10.0.0.1') is None
+    assert sorted(value for _, value in trie) == ['internet', 'local again', 'tgw']
+    with pytest.raises(ValueError):
+        trie.insert('fd00::/8', 'v6')
@@ -0,0 +1,69 @@
+import pytest
+
+from utils.describe_cache import DEFAULT_TTLS, DescribeCache, invalidated_types, uncached
+
+
+@pytest.fixture
+def cached(ec2):
+    # a cache of its own on one client, rather than the process-wide one on every client
+    cache = DescribeCache()
+    ec2.meta.events.register_first('before-call.ec2', cache._before_call)
+    ec2.meta.events.register('after-call.ec2', cache._after_call)
+    return cache
+
+
+def vpc_ids(ec2):
+    return sorted(vpc['VpcId'] for vpc in ec2.describe_vpcs()['Vpcs'])
+
+
+def test_mutations_make_the_types_they_touch_stale():
+    assert invalidated_types('CreateRoute') == ('route_table',)
+    assert invalidated_types('CreateTransitGatewayRoute')[0] == 'tgw_route'
+    assert 'route_table' in invalidated_types('CreateVpc')
+    # tags are read by every filter
+    assert invalidated_types('CreateTags') == tuple(DEFAULT_TTLS)
+
+
+def test_repeated_describes_are_answered_from_memory(ec2, cached):
+    first = vpc_ids(ec2)
+    assert vpc_ids(ec2) == first
+    assert cached.stats()['vpc'] == {'hits': 1, 'misses': 1, 'invalidations': 0}
+
+    # other parameters are another entry
+    ec2.describe_vpcs(Filters=[{'Name': 'tag:Name', 'Values': ['x']}])
+    assert cached.stats()['vpc']['misses'] == 2
+
+
+def test_answers_are_copies(ec2, cached):
+    ec2.describe_vpcs()['Vpcs'].clear()
+    assert ec2.describe_vpcs()['Vpcs']
+
+
+def test_a_mutation_invalidates_what_it_touches(ec2, cached):
+    before = vpc_ids(ec2)
+    ec2.describe_subnets()
+    ec2.describe_instances()
+    vpc_id = ec2.create_vpc(CidrBlock='10.9.0.0/16')['Vpc']['VpcId']
+
+    assert vpc_ids(ec2) == sorted(before + [vpc_id])
+    ec2.describe_instances()
+    assert cached.stats()['vpc']['invalidations'] == 1
+    assert cached.stats()['instance'] == {'hits': 1, 'misses': 1, 'invalidations': 0}
+    # creating a VPC leaves subnets alone
+    assert cached.stats()['subnet']['invalidations'] == 0
+
+
+def test_uncached_reads_go_to_aws_and_refresh(ec2, cached):
+    vpc_ids(ec2)
+    with uncached():
+        vpc_ids(ec2)
+    vpc_ids(ec2)
+    assert cached.stats()['vpc'] == {'hits': 1, 'misses': 2, 'invalidations': 0}
+
+
+def test_entries_expire_with_their_ttl(ec2, cached):
+    cached.ttls['vpc'] = 0.0
+    vpc_ids(ec2)
+    vpc_ids(ec2)
+    assert cached.stats()['vpc'] == {'hits': 0, 'misses': 2, 'invalidations': 0}
+    assert cached.totals()['hit_rate'] == 0.0
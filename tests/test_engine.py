@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+from utils import utils as config
+from utils.engine import ProvisioningEngine, ProvisioningError, RetryStep, state_keys
+
+
+@state_keys(inputs=('source',), outputs=('name',))
+def make(name: str, filename: str, source: str = None, persist: bool = True, log: list = None):
+    if log is not None:
+        log.append(name)
+    config.store_config(value=f'id-{name}', key=name, filename=filename)
+
+
+@state_keys(inputs=('source',), outputs=('name',))
+def fail(name: str, filename: str, source: str = None):
+    raise RuntimeError(f'{name} failed')
+
+
+@state_keys(outputs=('name',))
+def forget(name: str, filename: str):
+    # like a services function that logged a ClientError and stored nothing
+    return None
+
+
+def test_dependencies_follow_state_keys_and_after(state_dir):
+    engine = ProvisioningEngine('section')
+    vpc = engine.add(make, 'us-east-1', name='vpc', filename='section')
+    subnet = engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section')
+    check = engine.add(make, 'us-east-1', label='check', name='other', filename='section', after=[subnet])
+
+    assert vpc.name == 'make(vpc)'
+    assert engine.dependencies() == {'make(vpc)': set(), 'make(subnet)': {'make(vpc)'}, 'check': {'make(subnet)'}}
+    assert check.outputs == ('other',)
+
+
+def test_inputs_nobody_produces_are_read_from_state(state_dir):
+    engine = ProvisioningEngine('section')
+    engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section')
+    assert engine.dependencies() == {'make(subnet)': set()}
+
+
+def test_persist_false_produces_nothing(state_dir):
+    engine = ProvisioningEngine('section')
+    step = engine.add(make, 'us-east-1', name='vpc', filename='section', persist=False)
+    assert step.outputs == ()
+
+
+def test_invalid_graphs_are_rejected(state_dir):
+    engine = ProvisioningEngine('section')
+    engine.add(make, 'us-east-1', name='vpc', filename='section')
+    with pytest.raises(ValueError, match='Duplicate step'):
+        engine.add(make, 'us-east-1', name='vpc', filename='section')
+
+    engine.add(make, 'us-east-1', label='again', name='vpc', filename='section')
+    with pytest.raises(ValueError, match='produced by both'):
+        engine.dependencies()
+
+    engine = ProvisioningEngine('section')
+    engine.add(make, 'us-east-1', name='a', filename='section', after=['nowhere'])
+    with pytest.raises(ValueError, match='unknown step'):
+        engine.dependencies()
+
+    engine = ProvisioningEngine('section')
+    engine.add(make, 'us-east-1', name='a', source='b', filename='section')
+    engine.add(make, 'us-east-1', name='b', source='a', filename='section')
+    with pytest.raises(ValueError, match='cycle'):
+        engine.dependencies()
+
+
+def test_run_respects_dependencies(state_dir):
+    log = []
+    engine = ProvisioningEngine('section', workers_per_region=4)
+    engine.add(make, 'us-east-1', name='vpc', filename='section', log=log)
+    engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section', log=log)
+    engine.add(make, 'us-west-1', name='peer', source='subnet', filename='section', log=log)
+    engine.run()
+
+    assert log == ['vpc', 'subnet', 'peer']
+    assert config.load_config('section') == {'vpc': 'id-vpc', 'subnet': 'id-subnet', 'peer': 'id-peer'}
+
+
+def test_failure_skips_dependents_only(state_dir):
+    log = []
+    engine = ProvisioningEngine('section')
+    engine.add(fail, 'us-east-1', name='vpc', filename='section')
+    engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section', log=log)
+    engine.add(make, 'us-east-1', name='route', source='subnet', filename='section', log=log)
+    engine.add(make, 'us-east-1', name='unrelated', filename='section', log=log)
+    with pytest.raises(ProvisioningError) as error:
+        engine.run()
+
+    assert set(error.value.failed) == {'fail(vpc)'}
+    assert error.value.skipped == {'make(subnet)', 'make(route)'}
+    assert log == ['unrelated']
+
+
+def test_missing_output_fails_the_step(state_dir):
+    engine = ProvisioningEngine('section')
+    engine.add(forget, 'us-east-1', name='vpc', filename='section')
+    with pytest.raises(ProvisioningError) as error:
+        engine.run()
+    assert 'did not store' in str(error.value.failed['forget(vpc)'])
+
+
+def test_retry_step_requeues_without_blocking_others(state_dir):
+    attempts = []
+    others = threading.Event()
+
+    @state_keys(outputs=('name',))
+    def eventually(name: str, filename: str):
+        attempts.append(others.is_set())
+        if len(attempts) < 3:
+            raise RetryStep(0.01, 'not yet')
+        config.store_config(value='ready', key=name, filename=filename)
+
+    @state_keys(outputs=('name',))
+    def quick(name: str, filename: str):
+        others.set()
+        config.store_config(value='done', key=name, filename=filename)
+
+    engine = ProvisioningEngine('section', workers_per_region=1)
+    engine.add(eventually, 'us-east-1', name='slow', filename='section')
+    engine.add(quick, 'us-east-1', name='fast', filename='section')
+    engine.run()
+
+    assert len(attempts) == 3
+    # the single worker ran the other step while the first waited
+    assert attempts[-1]
+    assert config.load_config('section') == {'slow': 'ready', 'fast': 'done'}
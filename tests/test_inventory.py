@@ -0,0 +1,48 @@
+from services.inventory import NameIndex
+
+
+def tagged(name: str, environment: str = 'section') -> list:
+    return [{'ResourceType': 'vpc', 'Tags': [{'Key': 'Name', 'Value': name},
+                                             {'Key': 'Environment', 'Value': environment}]}]
+
+
+def count_describes(ec2) -> list:
+    calls = []
+    ec2.meta.events.register('before-call.ec2.DescribeVpcs', lambda **kwargs: calls.append(1))
+    return calls
+
+
+def test_finds_what_an_earlier_run_left_behind(ec2):
+    vpc_id = ec2.create_vpc(CidrBlock='10.1.0.0/16', TagSpecifications=tagged('vpc_a'))['Vpc']['VpcId']
+    ec2.create_vpc(CidrBlock='10.2.0.0/16', TagSpecifications=tagged('vpc_a', 'other'))
+    index = NameIndex()
+
+    assert index.find(ec2, 'vpc', 'vpc_a', 'section')['VpcId'] == vpc_id
+    assert index.find(ec2, 'vpc', 'vpc_b', 'section') is None
+    # the same name in another environment is someone else's
+    assert index.find(ec2, 'vpc', 'vpc_b', 'other') is None
+    assert index.find(ec2, 'vpc', 'vpc_a', 'section', matches=lambda item: item['CidrBlock'] == '10.9.0.0/16') \
+        is None
+
+
+def test_one_describe_per_environment_region_and_type(ec2):
+    calls = count_describes(ec2)
+    index = NameIndex()
+    for name in ('vpc_a', 'vpc_b', 'vpc_c'):
+        index.find(ec2, 'vpc', name, 'section')
+    assert len(calls) == 1
+    index.find(ec2, 'vpc', 'vpc_a', 'other')
+    assert len(calls) == 2
+
+
+def test_resources_are_added_and_dropped_as_they_go(ec2):
+    index = NameIndex()
+    assert index.find(ec2, 'vpc', 'vpc_a', 'section') is None
+    calls = count_describes(ec2)
+    vpc = ec2.create_vpc(CidrBlock='10.1.0.0/16', TagSpecifications=tagged('vpc_a'))['Vpc']
+    index.add(ec2, 'vpc', 'vpc_a', 'section', vpc)
+    assert index.find(ec2, 'vpc', 'vpc_a', 'section') is vpc
+
+    index.discard(vpc['VpcId'])
+    assert index.find(ec2, 'vpc', 'vpc_a', 'section') is None
+    assert calls == []
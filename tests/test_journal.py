@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+
+from utils import utils as config
+from utils.engine import ProvisioningEngine, state_keys
+from utils.journal import StepJournal
+
+
+class Log:
+    # what ran; like a client, it is not part of a step's fingerprint
+    def __init__(self):
+        self.names = []
+
+
+@state_keys(inputs=('source',), outputs=('name',))
+def make(name: str, filename: str, log: Log, cidr: str = '10.0.0.0/16', source: str = None, client=None):
+    log.names.append(name)
+    config.store_config(value=f'{name}-{len(log.names)}', key=name, filename=filename)
+
+
+@dataclass(frozen=True)
+class Spec:
+    cidr: str
+
+
+def bring_up(log: Log, journal: StepJournal, vpc_cidr: str = '10.0.0.0/16'):
+    engine = ProvisioningEngine('section', journal=journal)
+    engine.add(make, 'us-east-1', name='vpc', cidr=vpc_cidr, filename='section', log=log)
+    engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section', log=log)
+    engine.add(make, 'us-east-1', name='igw', filename='section', log=log)
+    engine.run()
+    return engine
+
+
+def test_fingerprint_covers_arguments_and_inputs_only(state_dir):
+    journal = StepJournal('section')
+    engine = ProvisioningEngine('section')
+    step = engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section', client=object(), log=Log())
+    same = ProvisioningEngine('section').add(make, 'us-east-1', name='subnet', source='vpc', filename='section',
+                                             client=object(), log=Log())
+    state = {'vpc': 'vpc-1'}
+
+    # clients and the like are not part of what a step does
+    assert journal.fingerprint(step, state) == journal.fingerprint(same, state)
+    assert journal.fingerprint(step, state) != journal.fingerprint(step, {'vpc': 'vpc-2'})
+    other = ProvisioningEngine('section').add(make, 'us-east-1', name='subnet', source='vpc', cidr='10.1.0.0/16',
+                                              filename='section', log=Log())
+    assert journal.fingerprint(step, state) != journal.fingerprint(other, state)
+    # dataclass arguments count by value
+    with_spec = ProvisioningEngine('section').add(make, 'us-east-1', name='subnet', cidr=Spec('10.0.0.0/16'),
+                                                  filename='section', log=Log())
+    assert journal.fingerprint(with_spec, state) != journal.fingerprint(step, state)
+
+
+def test_a_second_run_skips_completed_steps(state_dir):
+    log = Log()
+    bring_up(log, StepJournal('section'))
+    assert sorted(log.names) == ['igw', 'subnet', 'vpc']
+    state = config.load_config('section')
+
+    log.names.clear()
+    bring_up(log, StepJournal('section'))
+    assert log.names == []
+    assert config.load_config('section') == state
+
+
+def test_a_changed_step_runs_again_with_its_dependents(state_dir):
+    log = Log()
+    bring_up(log, StepJournal('section'))
+    log.names.clear()
+    bring_up(log, StepJournal('section'), vpc_cidr='10.1.0.0/16')
+    assert log.names == ['vpc', 'subnet']
+
+
+def test_resume_reruns_steps_whose_resources_are_gone(state_dir):
+    log = Log()
+    bring_up(log, StepJournal('section'))
+    vpc_id = config.load_config('section', 'vpc')
+    checked = []
+
+    def verify(ids):
+        checked.append(ids)
+        return {vpc_id}
+
+    log.names.clear()
+    bring_up(log, StepJournal('section', verify=verify))
+    assert checked and vpc_id in checked[0]['us-east-1']
+    assert log.names == ['vpc', 'subnet']
+
+
+def test_resume_restores_the_recorded_outputs(state_dir):
+    log = Log()
+    bring_up(log, StepJournal('section'))
+    recorded = config.load_config('section')
+
+    # the state file lost what the journal still has, e.g. after a crash before the last flush
+    config.update_config({}, filename='section')
+    log.names.clear()
+    bring_up(log, StepJournal('section'))
+    assert log.names == []
+    assert config.load_config('section') == recorded
+
+
+def test_forget_outputs_drops_the_steps_that_stored_them(state_dir):
+    journal = StepJournal('section')
+    bring_up(Log(), journal)
+    journal.forget_outputs('subnet')
+    assert set(journal.store.get()) == {'make(vpc)', 'make(igw)'}
+
+
+def test_completed_is_worked_out_offline(state_dir):
+    journal = StepJournal('section')
+    engine = bring_up(Log(), journal)
+    deps = engine.dependencies()
+    order = engine._check_acyclic(deps)
+    state = config.load_config('section')
+
+    assert journal.completed(engine.steps, deps, order, state) == set(engine.steps)
+    # a step whose input changed since is not, and neither is anything after it
+    changed = dict(state, vpc='vpc-elsewhere')
+    journal.forget('make(vpc)')
+    assert journal.completed(engine.steps, deps, order, changed) == {'make(igw)'}
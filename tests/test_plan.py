@@ -0,0 +1,70 @@
+from utils import utils as config
+from utils.engine import ProvisioningEngine, state_keys
+from utils.journal import StepJournal
+
+
+@state_keys(inputs=('source',), outputs=('name',), api_calls=lambda kwargs: 1 + kwargs.get('waits', 0))
+def make(name: str, filename: str, source: str = None, waits: int = 0):
+    config.store_config(value=f'{name}-1', key=name, filename=filename)
+
+
+@state_keys(inputs=('source',), outputs=('name',), get_or_create=True)
+def get_or_make(name: str, filename: str, source: str = None):
+    config.store_config(value=f'{name}-1', key=name, filename=filename)
+
+
+@state_keys(inputs=('name',))
+def remove(name: str, filename: str):
+    config.delete_config(filename, name)
+
+
+remove.deletes = ('name',)
+
+
+def engine_of() -> ProvisioningEngine:
+    engine = ProvisioningEngine('section', journal=StepJournal('section'))
+    engine.add(make, 'us-east-1', name='vpc', filename='section', waits=2)
+    engine.add(make, 'us-east-1', name='subnet', source='vpc', filename='section')
+    engine.add(get_or_make, 'us-east-1', name='igw', source='vpc', filename='section')
+    engine.add(make, 'us-east-1', name='route', source='subnet', filename='section')
+    engine.add(make, 'us-west-2', name='peer', source='tgw', filename='section')
+    return engine
+
+
+def test_a_plan_from_the_state_alone(state_dir):
+    plan = engine_of().plan({'subnet': 'subnet-0', 'igw': 'igw-0'})
+    steps = {step.name: step for step in plan.steps}
+
+    assert steps['make(vpc)'].creates == ('vpc',) and steps['make(vpc)'].api_calls == 3
+    assert steps['make(subnet)'].recreates == ('subnet',)
+    # a get-or-create step finds what is already there
+    assert steps['get_or_make(igw)'].reuses == ('igw',) and steps['get_or_make(igw)'].creates == ()
+    assert steps['make(peer)'].missing == ('tgw',)
+    # creating again counts as a create too
+    assert plan.summary()['create'] == 4 and plan.summary()['recreate'] == 1 and plan.summary()['missing'] == 1
+    assert [step.name for step in plan.critical_path()] == ['make(vpc)', 'make(subnet)', 'make(route)']
+    assert plan.summary()['critical_path_api_calls'] == 5
+
+
+def test_deletes_and_external_inputs(state_dir):
+    engine = ProvisioningEngine('section')
+    engine.add(remove, 'us-east-1', name='vpc', filename='section')
+    engine.add(remove, 'us-east-1', name='igw', filename='section')
+    plan = engine.plan({'vpc': 'vpc-0'})
+
+    assert [step.deletes for step in plan.steps] == [('name',), ('name',)]
+    assert plan.summary()['missing'] == 1
+    assert 'MISSING from state (1): igw' in plan.report()
+
+
+def test_steps_an_earlier_run_completed_are_reused(state_dir):
+    engine = engine_of()
+    config.store_config(value='tgw-0', key='tgw', filename='section')
+    engine.run()
+
+    plan = engine_of().plan()
+    assert all(step.completed and step.api_calls == 0 for step in plan.steps)
+    assert plan.summary()['create'] == 0 and plan.summary()['recreate'] == 0
+    report = plan.report()
+    assert '[  1] make(vpc) [us-east-1], ~0 call(s), completed in an earlier run' in report
+    assert 'Would reuse (6): ' in report and plan.summary()['reuse'] == 6
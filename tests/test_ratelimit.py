@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils.ratelimit import BACKOFF_FACTOR, RECOVERY_STEP, RateLimiter, TokenBucket, ec2_category
+
+
+def operation(name: str, service: str = 'ec2'):
+    return SimpleNamespace(name=name, service_model=SimpleNamespace(service_name=service))
+
+
+def response(code=None):
+    return None, ({'Error': {'Code': code}} if code else {})
+
+
+def test_ec2_categories():
+    assert ec2_category('DescribeVpcs') == 'describe'
+    assert ec2_category('SearchTransitGatewayRoutes') == 'describe'
+    assert ec2_category('CreateVpc') == 'mutating'
+    assert ec2_category('RunInstances') == 'instances'
+
+
+def test_callers_wait_once_the_bucket_is_empty():
+    bucket = TokenBucket(capacity=2, rate=10.0)
+    assert bucket.reserve() == 0.0 and bucket.reserve() == 0.0
+    # each reservation past the capacity waits one more refill interval
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.05)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.05)
+
+
+def test_throttling_cuts_the_rate_multiplicatively():
+    bucket = TokenBucket(capacity=10, rate=8.0, min_rate=1.5)
+    assert bucket.on_throttled() == 8.0 * BACKOFF_FACTOR
+    # nothing left in the bucket after a throttle
+    assert bucket.tokens <= 0
+    bucket.on_throttled()
+    bucket.on_throttled()
+    assert bucket.rate == 1.5 and bucket.throttled == 3
+
+
+def test_successes_win_the_rate_back_additively():
+    bucket = TokenBucket(capacity=10, rate=10.0)
+    bucket.on_throttled()
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(5.0 + 10.0 * RECOVERY_STEP)
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 10.0
+
+
+def test_buckets_per_account_region_and_category():
+    limiter = RateLimiter(scale=0.5)
+    describe = limiter.bucket(operation('DescribeVpcs'), {'client_region': 'us-east-1'})
+    assert limiter.bucket(operation('DescribeSubnets'), {'client_region': 'us-east-1'}) is describe
+    assert limiter.bucket(operation('DescribeVpcs'), {'client_region': 'us-west-1'}) is not describe
+    assert limiter.bucket(operation('DescribeVpcs'), {'client_region': 'us-east-1', 'nsp_account': 'b'}) \
+        is not describe
+    assert limiter.bucket(operation('CreateVpc'), {'client_region': 'us-east-1'}) is not describe
+    assert limiter.bucket(operation('ListBuckets', 's3'), {}) is None
+    # the scale is this process's share of the budget
+    assert describe.nominal_rate == 10.0 and describe.capacity == 50
+
+
+def test_attempt_outcomes_adapt_their_bucket():
+    limiter = RateLimiter()
+    request = {'context': {'client_region': 'us-east-1'}}
+    bucket = limiter.bucket(operation('CreateRoute'), request['context'])
+
+    assert limiter._throttled_bucket(response('RequestLimitExceeded'), operation('CreateRoute'), request) is bucket
+    assert bucket.rate == bucket.nominal_rate * BACKOFF_FACTOR
+    # other errors say nothing about the rate
+    assert limiter._throttled_bucket(response('InvalidVpcID.NotFound'), operation('CreateRoute'), request) is None
+    assert bucket.rate == bucket.nominal_rate * BACKOFF_FACTOR
+    assert limiter._throttled_bucket(response(), operation('CreateRoute'), request) is None
+    assert bucket.rate > bucket.nominal_rate * BACKOFF_FACTOR
@@ -0,0 +1,87 @@
+import pytest
+
+from utils.reachability import BLACKHOLE, INTERNET_GATEWAY, LOCAL, TRANSIT_GATEWAY, NetworkModel, check_topology, \
+    parse_probe
+from utils.rules import Rule
+from utils.topology import load_topology
+from utils.utils import CONFIG_PATH
+
+SSH_AND_PING = (Rule('tcp', 22, 22, '10.0.0.0/8'), Rule('icmp', -1, -1, '10.0.0.0/8'))
+
+
+def two_vpcs() -> NetworkModel:
+    # a and b behind one transit gateway, with an instance each
+    model = NetworkModel('test')
+    model.add_transit_gateway('tgw')
+    for vpc, cidr in (('a', '10.1.0.0/16'), ('b', '10.2.0.0/16')):
+        model.add_vpc(vpc, cidr)
+        model.add_route_table(f'{vpc}_rt', vpc)
+        model.add_subnet(f'{vpc}_subnet', vpc, cidr.replace('0.0/16', '1.0/24'), f'{vpc}_rt')
+        model.add_attachment(f'{vpc}_attachment', 'tgw', vpc=vpc)
+        model.add_tgw_route('tgw', cidr, f'{vpc}_attachment')
+        model.add_endpoint(f'{vpc}_instance', f'{vpc}_subnet', cidr.replace('0.0/16', '1.4'), SSH_AND_PING)
+    model.add_route('a_rt', '10.2.0.0/16', TRANSIT_GATEWAY, 'tgw')
+    model.add_route('b_rt', '10.1.0.0/16', TRANSIT_GATEWAY, 'tgw')
+    return model
+
+
+def test_probes():
+    assert parse_probe('icmp') == ('icmp', -1)
+    assert parse_probe('tcp:22') == ('tcp', 22)
+    assert parse_probe('all') == ('-1', -1)
+
+
+def test_reachable_pair_and_its_hops():
+    verdict = two_vpcs().check('a_instance', 'b_instance', 'tcp', 22)
+    assert verdict.reachable
+    assert [hop.target for hop in verdict.hops] == ['tgw', 'b_attachment', 'b_subnet']
+
+
+def test_security_group_blocks_other_ports():
+    verdict = two_vpcs().check('a_instance', 'b_instance', 'tcp', 443)
+    assert not verdict.reachable
+    assert 'does not let tcp:443 in' in verdict.reason
+
+
+def test_missing_return_route():
+    model = two_vpcs()
+    model.add_route('b_rt', '10.1.0.0/16', BLACKHOLE)
+    verdict = model.check('a_instance', 'b_instance')
+    assert verdict.reason.startswith('no way back: 10.1.0.0/16 is a blackhole in b_rt')
+
+
+def test_routes_that_do_not_deliver():
+    model = two_vpcs()
+    model.add_route('a_rt', '10.2.0.0/16', INTERNET_GATEWAY, 'igw')
+    assert 'internet gateway' in model.check('a_instance', 'b_instance').reason
+
+    model = two_vpcs()
+    model.add_tgw_route('tgw', '10.2.0.0/16', None)
+    assert 'blackhole in tgw' in model.check('a_instance', 'b_instance').reason
+
+    model = two_vpcs()
+    model.add_route('a_rt', '10.2.0.0/16', TRANSIT_GATEWAY, 'other_tgw')
+    assert 'is not attached to it' in model.check('a_instance', 'b_instance').reason
+
+
+def test_the_more_specific_route_wins():
+    model = two_vpcs()
+    model.add_route('a_rt', '10.2.1.0/24', LOCAL, 'a')
+    verdict = model.check('a_instance', 'b_instance')
+    assert not verdict.reachable and 'no subnet of a' in verdict.reason
+
+
+def test_peering_loops_are_detected():
+    model = two_vpcs()
+    model.add_attachment('peering', 'tgw', peer='tgw_2')
+    for tgw in ('tgw', 'tgw_2'):
+        model.add_tgw_route(tgw, '10.2.0.0/16', 'peering')
+    assert 'routing loop' in model.check('a_instance', 'b_instance').reason
+
+
+@pytest.mark.parametrize('probe, reachable', [('icmp', 20), ('tcp:22', 8), ('tcp:8080', 16)])
+def test_hub_and_spoke_from_the_spec(probe, reachable):
+    # spokes accept ping and 8000-8080 from what they can reach, but SSH only from the shared services subnet
+    _, verdicts, _ = check_topology(load_topology(CONFIG_PATH + 'topologies.yaml', 'hub_and_spoke'), probe)
+    assert len(verdicts) == 20
+    assert sum(verdict.reachable for verdict in verdicts) == reachable
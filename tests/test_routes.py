@@ -0,0 +1,82 @@
+from services.routes import TGW_ROUTE_TARGET, Route, RouteChange, diff_routes, parse_route_tables, parse_tgw_routes, \
+    reconcile_vpc_routes, route_state_keys, tgw_change_request, vpc_change_request
+from utils import utils as config
+
+
+def test_diff_creates_replaces_and_prunes():
+    desired = {'0.0.0.0/0': ('GatewayId', 'igw-1'), '10.2.0.0/16': ('TransitGatewayId', 'tgw-1'),
+               '10.3.0.0/16': ('TransitGatewayId', 'tgw-1')}
+    actual = {'0.0.0.0/0': ('GatewayId', 'igw-1'), '10.2.0.0/16': ('TransitGatewayId', 'tgw-old'),
+              '10.9.0.0/16': ('TransitGatewayId', 'tgw-1')}
+
+    assert diff_routes('rtb-1', desired, actual) == [
+        RouteChange('replace', 'rtb-1', '10.2.0.0/16', 'TransitGatewayId', 'tgw-1'),
+        RouteChange('create', 'rtb-1', '10.3.0.0/16', 'TransitGatewayId', 'tgw-1'),
+        RouteChange('delete', 'rtb-1', '10.9.0.0/16'),
+    ]
+    assert [change.action for change in diff_routes('rtb-1', desired, actual, prune=False)] == ['replace', 'create']
+    assert diff_routes('rtb-1', desired, desired) == []
+
+
+def test_blackholes_are_replaced():
+    desired = {'10.2.0.0/16': ('TransitGatewayId', 'tgw-1')}
+    actual = {'10.2.0.0/16': ('TransitGatewayId', None)}
+    assert [change.action for change in diff_routes('rtb-1', desired, actual)] == ['replace']
+
+
+def test_parse_route_tables_skips_what_is_not_ours():
+    route_table = {'RouteTableId': 'rtb-1', 'Routes': [
+        {'DestinationCidrBlock': '10.1.0.0/16', 'GatewayId': 'local', 'Origin': 'CreateRouteTable'},
+        {'DestinationCidrBlock': '0.0.0.0/0', 'GatewayId': 'igw-1', 'Origin': 'CreateRoute', 'State': 'active'},
+        {'DestinationCidrBlock': '10.2.0.0/16', 'TransitGatewayId': 'tgw-1', 'Origin': 'CreateRoute',
+         'State': 'blackhole'},
+        {'DestinationCidrBlock': '10.8.0.0/16', 'GatewayId': 'vgw-1', 'Origin': 'EnableVgwRoutePropagation'},
+        {'DestinationPrefixListId': 'pl-1', 'GatewayId': 'vpce-1', 'Origin': 'CreateRoute'},
+    ]}
+    assert parse_route_tables(['rtb-1', 'rtb-2'], [route_table]) == {
+        'rtb-1': {'0.0.0.0/0': ('GatewayId', 'igw-1'), '10.2.0.0/16': ('TransitGatewayId', None)},
+        'rtb-2': {},
+    }
+
+
+def test_parse_tgw_routes():
+    response = {'Routes': [
+        {'DestinationCidrBlock': '10.1.0.0/16', 'State': 'active',
+         'TransitGatewayAttachments': [{TGW_ROUTE_TARGET: 'tgw-attach-1'}]},
+        {'DestinationCidrBlock': '10.2.0.0/16', 'State': 'blackhole'},
+    ]}
+    assert parse_tgw_routes('tgw-rtb-1', response) == {'10.1.0.0/16': (TGW_ROUTE_TARGET, 'tgw-attach-1'),
+                                                       '10.2.0.0/16': (TGW_ROUTE_TARGET, None)}
+
+
+def test_change_requests():
+    change = RouteChange('replace', 'rtb-1', '10.2.0.0/16', 'TransitGatewayId', 'tgw-1')
+    assert vpc_change_request(change) == ('replace_route', {'RouteTableId': 'rtb-1', 'DestinationCidrBlock':
+                                                            '10.2.0.0/16', 'TransitGatewayId': 'tgw-1'})
+    assert tgw_change_request(RouteChange('delete', 'tgw-rtb-1', '10.2.0.0/16')) == (
+        'delete_transit_gateway_route', {'TransitGatewayRouteTableId': 'tgw-rtb-1',
+                                         'DestinationCidrBlock': '10.2.0.0/16'})
+
+
+def test_state_keys_of_routes():
+    routes = {'rt_a': (Route('10.2.0.0/16', 'tgw'), Route('0.0.0.0/0', 'igw', 'GatewayId')),
+              'rt_b': (Route('10.1.0.0/16', 'tgw'),)}
+    assert route_state_keys(routes) == ('rt_a', 'tgw', 'igw', 'rt_b')
+
+
+def test_reconcile_converges(ec2, state_dir):
+    vpc_id = ec2.create_vpc(CidrBlock='10.1.0.0/16')['Vpc']['VpcId']
+    igw_id = ec2.create_internet_gateway()['InternetGateway']['InternetGatewayId']
+    ec2.attach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+    route_table_id = ec2.create_route_table(VpcId=vpc_id)['RouteTable']['RouteTableId']
+    config.update_config({'rt': route_table_id, 'igw': igw_id}, filename='section')
+    routes = {'rt': (Route('0.0.0.0/0', 'igw', 'GatewayId'),)}
+
+    assert [change.action for change in reconcile_vpc_routes(ec2, routes, 'section')] == ['create']
+    assert reconcile_vpc_routes(ec2, routes, 'section') == []
+
+    ec2.create_route(RouteTableId=route_table_id, DestinationCidrBlock='192.168.0.0/16', GatewayId=igw_id)
+    assert reconcile_vpc_routes(ec2, routes, 'section', prune=False) == []
+    assert reconcile_vpc_routes(ec2, routes, 'section') == [RouteChange('delete', route_table_id, '192.168.0.0/16')]
+    [route_table] = ec2.describe_route_tables(RouteTableIds=[route_table_id])['RouteTables']
+    assert sorted(route['DestinationCidrBlock'] for route in route_table['Routes']) == ['0.0.0.0/0', '10.1.0.0/16']
@@ -0,0 +1,67 @@
+import pytest
+
+from services.security_groups import RuleChange, ip_permissions, parse_security_groups, plan_rule_changes
+from utils.rules import Rule, RuleQuotaError, compile_rules, port_range, protocol_name
+
+
+def test_ports_and_protocols():
+    assert port_range('tcp', 22) == (22, 22)
+    assert port_range('tcp', '8000-8080') == (8000, 8080)
+    assert port_range('udp', (53, 54)) == (53, 54)
+    assert port_range('tcp', None) == (0, 65535)
+    assert port_range('icmp', None) == (-1, -1)
+    assert protocol_name('ALL') == '-1' and protocol_name(6) == '6'
+    assert str(Rule('tcp', 8000, 8080, '10.0.0.0/16')) == 'tcp:8000-8080 from 10.0.0.0/16'
+    assert str(Rule('-1', -1, -1, '0.0.0.0/0')) == 'all from 0.0.0.0/0'
+
+
+def test_cidrs_are_collapsed_per_port_range():
+    rules = [Rule('tcp', 22, 22, '10.2.0.0/16'), Rule('tcp', 22, 22, '10.3.0.0/16'),
+             Rule('tcp', 22, 22, '10.2.5.0/24'), Rule('tcp', 22, 22, '10.2.0.0/16'),
+             Rule('tcp', 443, 443, '10.2.0.0/16'), Rule('icmp', -1, -1, '10.4.0.1/32'),
+             Rule('tcp', 22, 22, '10.2.0.9/8')]
+
+    assert compile_rules(rules) == [Rule('icmp', -1, -1, '10.4.0.1/32'), Rule('tcp', 22, 22, '10.0.0.0/8'),
+                                    Rule('tcp', 443, 443, '10.2.0.0/16')]
+
+
+def test_ipv4_and_ipv6_are_collapsed_apart():
+    rules = [Rule('tcp', 22, 22, '10.0.0.0/9'), Rule('tcp', 22, 22, '10.128.0.0/9'),
+             Rule('tcp', 22, 22, 'fd00::/9'), Rule('tcp', 22, 22, 'fd80::/9')]
+    assert [rule.cidr for rule in compile_rules(rules)] == ['10.0.0.0/8', 'fd00::/8']
+
+
+def test_quota_counts_rules_after_merging():
+    adjacent = [Rule('tcp', 22, 22, f'10.{i}.0.0/16') for i in range(64)]
+    assert compile_rules(adjacent, quota=1) == [Rule('tcp', 22, 22, '10.0.0.0/10')]
+    scattered = [Rule('tcp', 22, 22, f'10.{2 * i}.0.0/16') for i in range(4)]
+    with pytest.raises(RuleQuotaError, match='4 rules after merging'):
+        compile_rules(scattered, quota=3)
+
+
+def test_permissions_group_cidrs_by_port_range():
+    rules = [Rule('tcp', 22, 22, '10.0.0.0/16'), Rule('tcp', 22, 22, 'fd00::/8'), Rule('-1', -1, -1, '10.1.0.0/16')]
+    assert ip_permissions(rules) == [
+        {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '10.1.0.0/16'}]},
+        {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '10.0.0.0/16'}],
+         'Ipv6Ranges': [{'CidrIpv6': 'fd00::/8'}]},
+    ]
+
+
+def test_rule_changes_against_what_a_group_has():
+    described = [{'GroupId': 'sg-1', 'IpPermissions': [
+        {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
+        {'IpProtocol': 'tcp', 'FromPort': 80, 'ToPort': 80, 'IpRanges': [{'CidrIp': '10.0.0.0/8'}],
+         'UserIdGroupPairs': [{'GroupId': 'sg-2'}]},
+    ]}]
+    actual = parse_security_groups(['sg-1'], described)
+    assert actual == {'sg-1': frozenset({Rule('tcp', 22, 22, '0.0.0.0/0'), Rule('tcp', 80, 80, '10.0.0.0/8')})}
+
+    desired = {'sg-1': frozenset({Rule('tcp', 22, 22, '0.0.0.0/0'), Rule('icmp', -1, -1, '0.0.0.0/0')})}
+    assert plan_rule_changes(desired, actual, prune=True) == [
+        RuleChange('authorize', 'sg-1', (Rule('icmp', -1, -1, '0.0.0.0/0'),)),
+        RuleChange('revoke', 'sg-1', (Rule('tcp', 80, 80, '10.0.0.0/8'),)),
+    ]
+    assert plan_rule_changes(desired, actual, prune=False) == [
+        RuleChange('authorize', 'sg-1', (Rule('icmp', -1, -1, '0.0.0.0/0'),))]
+    assert plan_rule_changes(actual, actual, prune=True) == []
@@ -0,0 +1,133 @@
+import json
+import threading
+
+import pytest
+
+from utils.state import StateStore, resource_type_of, step_region
+from utils.state_db import StateDatabase
+
+
+def read(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def test_writes_are_batched_until_the_interval(tmp_path):
+    path = tmp_path / 'section.json'
+    store = StateStore(str(path), flush_interval=60, batch_size=100)
+    store.set('vpc', 'vpc-1')
+    store.update({'subnet': 'subnet-1', 'igw': 'igw-1'})
+
+    assert not path.exists()
+    assert store.get() == {'vpc': 'vpc-1', 'subnet': 'subnet-1', 'igw': 'igw-1'}
+    store.flush()
+    assert read(path) == {'vpc': 'vpc-1', 'subnet': 'subnet-1', 'igw': 'igw-1'}
+
+
+def test_a_full_batch_is_flushed_in_the_background(tmp_path):
+    path = tmp_path / 'section.json'
+    store = StateStore(str(path), flush_interval=60, batch_size=3)
+    flushed = threading.Event()
+    flush = store.flush
+
+    def tracked_flush():
+        flush()
+        flushed.set()
+
+    store.flush = tracked_flush
+    store.update({f'key{i}': i for i in range(3)})
+
+    assert flushed.wait(5)
+    assert read(path) == {'key0': 0, 'key1': 1, 'key2': 2}
+
+
+def test_the_interval_flushes_a_partial_batch(tmp_path):
+    path = tmp_path / 'section.json'
+    store = StateStore(str(path), flush_interval=0.1, batch_size=100)
+    store.set('vpc', 'vpc-1')
+    timer = store._timer
+    assert not path.exists()
+    timer.join(5)
+    assert read(path) == {'vpc': 'vpc-1'}
+
+
+def test_delete_replace_and_reload(tmp_path):
+    path = str(tmp_path / 'section.json')
+    store = StateStore(path)
+    store.replace({'vpc': 'vpc-1', 'subnet': 'subnet-1'})
+    store.delete('subnet', 'absent')
+    store.flush()
+
+    assert StateStore(path).get() == {'vpc': 'vpc-1'}
+    with pytest.raises(KeyError):
+        store.get('subnet')
+
+
+def test_an_unreadable_file_is_treated_as_empty(tmp_path):
+    path = tmp_path / 'section.json'
+    path.write_text('{"vpc": ')
+    assert StateStore(str(path)).get() == {}
+
+
+def test_resource_types_by_id_prefix():
+    assert resource_type_of('tgw-attach-0123') == 'tgw_attachment'
+    assert resource_type_of('tgw-0123') == 'tgw'
+    assert resource_type_of('tgw-rtb-0123') is None
+    assert resource_type_of(['i-1', 'i-2']) == 'instance'
+    assert resource_type_of(42) is None
+
+
+def test_sqlite_sections_have_the_store_interface(tmp_path):
+    database = StateDatabase(str(tmp_path / 'state.db'))
+    intra, inter = database.section('intra'), database.section('inter')
+    intra.update({'vpc': 'vpc-1', 'instances': ['i-1', 'i-2']})
+    inter.set('vpc', 'vpc-2')
+    intra.delete('instances')
+
+    assert intra.get() == {'vpc': 'vpc-1'}
+    assert inter.get('vpc') == 'vpc-2'
+    with pytest.raises(KeyError):
+        intra.get('instances')
+    assert database.sections() == ['inter', 'intra']
+
+    intra.replace({'subnet': 'subnet-1'})
+    assert intra.get() == {'subnet': 'subnet-1'}
+
+
+def test_sqlite_records_type_and_region(tmp_path):
+    database = StateDatabase(str(tmp_path / 'state.db'))
+    section = database.section('intra')
+    token = step_region.set('us-west-1')
+    try:
+        section.set('vpc', 'vpc-1')
+    finally:
+        step_region.reset(token)
+    section.set('subnet', 'subnet-1')
+    # a rewrite without a region keeps the one recorded before
+    section.set('vpc', 'vpc-1')
+
+    [vpc] = database.find(resource_type='vpc')
+    assert (vpc.key, vpc.region) == ('vpc', 'us-west-1')
+    assert [record.key for record in database.find(region='us-west-1')] == ['vpc']
+    assert [record.key for record in database.find(section='intra')] == ['subnet', 'vpc']
+
+
+def test_sqlite_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / 'state.db')
+    StateDatabase(path).section('intra').set('vpc', 'vpc-1')
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(StateDatabase(path).section('intra').get()))
+    thread.start()
+    thread.join()
+    assert seen == [{'vpc': 'vpc-1'}]
+
+
+def test_sqlite_json_export_and_import(tmp_path):
+    database = StateDatabase(str(tmp_path / 'state.db'))
+    database.section('intra').update({'vpc': 'vpc-1', 'subnet': 'subnet-1'})
+    exported = str(tmp_path / 'intra.json')
+    database.export_json('intra', exported)
+    assert read(exported) == {'vpc': 'vpc-1', 'subnet': 'subnet-1'}
+
+    database.import_json('copy', exported)
+    assert database.section('copy').get() == {'vpc': 'vpc-1', 'subnet': 'subnet-1'}
@@ -0,0 +1,188 @@
+import asyncio
+import inspect
+import logging
+import time
+import types
+from contextlib import AsyncExitStack
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from utils.clients import ClientRegistry, OfflineClient, registry
+from utils.engine import ProvisioningEngine, ProvisioningError, RetryStep, Step
+from utils.journal import StepJournal
+from utils.state import step_region
+from utils.utils import flush_config
+
+# aiobotocore is imported on first use, like boto3 in utils.clients, and only the asyncio paths need it
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# a step in flight is a coroutine waiting on the network, not a thread, so far more of them fit per region
+DEFAULT_ASYNC_WORKERS_PER_REGION = 64
+
+
+class AsyncClientRegistry:
+    # The asyncio counterpart of ClientRegistry, on aiobotocore: one session per account and one client per
+    # (service, region, account), shared by every task on the loop. Settings and event handlers come from the
+    # threaded registry. aiobotocore clients hold a connection pool bound to the loop they were created on, so
+    # they are closed with close() before that loop ends.
+    def __init__(self, threaded: ClientRegistry = registry):
+        self.threaded = threaded
+        self._sessions: Dict[Optional[str], object] = {}
+        self._clients: Dict[Tuple[str, str, Optional[str]], object] = {}
+        self._stack: Optional[AsyncExitStack] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def config(self) -> 'aiobotocore.config.AioConfig':
+        from aiobotocore.config import AioConfig
+        return AioConfig(max_pool_connections=self.threaded.max_pool_connections, retries=self.threaded.retries)
+
+    def session(self, account: Optional[str] = None) -> 'aiobotocore.session.AioSession':
+        if account not in self._sessions:
+            from aiobotocore.session import AioSession
+            session = AioSession(profile=account)
+            if self.threaded.model_cache_dir:
+                from utils.startup import install_model_cache
+                install_model_cache(session, self.threaded.model_cache_dir)
+            self.threaded.install_handlers(session, account, asynchronous=True)
+            self._sessions[account] = session
+        return self._sessions[account]
+
+    async def client(self, service: str, region: str, account: Optional[str] = None):
+        key = (service, region, account)
+        client = self._clients.get(key)
+        if client is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+                self._stack = AsyncExitStack()
+            async with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = await self._stack.enter_async_context(
+                        self.session(account).create_client(service, region_name=region, config=self.config()))
+                    self._clients[key] = client
+        return client
+
+    async def close(self):
+        stack, self._stack, self._lock = self._stack, None, None
+        self._clients.clear()
+        if stack is not None:
+            await stack.aclose()
+
+
+class AsyncClient:
+    # Stands in for an aiobotocore client: steps are built before the loop runs, so the client is only created
+    # on the first call. API methods are awaited; get_paginator and the like are passed through.
+    def __init__(self, registry: AsyncClientRegistry, service: str, region: str, account: Optional[str] = None):
+        self._registry = registry
+        self._key = (service, region, account)
+        # what callers read off a botocore client without a call
+        self.meta = types.SimpleNamespace(region_name=region)
+
+    def __getattr__(self, name: str):
+        async def call(*args, **kwargs):
+            result = getattr(await self._registry.client(*self._key), name)(*args, **kwargs)
+            return await result if inspect.isawaitable(result) else result
+
+        call.__name__ = name
+        return call
+
+    def __repr__(self):
+        return f'AsyncClient{self._key}'
+
+
+aio_registry = AsyncClientRegistry()
+
+
+def get_async_client(service: str, region: str, account: Optional[str] = None) -> AsyncClient:
+    if registry.offline:
+        return OfflineClient(service, region, account)
+    return AsyncClient(aio_registry, service, region, account)
+
+
+class AsyncProvisioningEngine(ProvisioningEngine):
+    # Runs the same step graph with async services functions (services.aio) as tasks on one event loop.
+    # A step starts once everything it depends on is done, up to workers_per_region at a time per region;
+    # RetryStep sleeps without holding a slot, and failures skip the dependent steps as in the threaded engine.
+    def __init__(self, filename: str, workers_per_region: int = DEFAULT_ASYNC_WORKERS_PER_REGION,
+                 journal: Optional[StepJournal] = None):
+        super().__init__(filename=filename, workers_per_region=workers_per_region, journal=journal)
+
+    async def _execute_async(self, step: Step):
+        started = time.monotonic()
+        logger.info(f'Step started: {step.name} [{step.region}]')
+        token = step_region.set(step.region)
+        try:
+            result = await step()
+            self._verify_outputs(step)
+            if self.journal is not None:
+                self.journal.record(step)
+        finally:
+            step_region.reset(token)
+        logger.info(f'Step finished: {step.name} [{step.region}] in {time.monotonic() - started:.1f}s')
+        return result
+
+    async def run_async(self) -> Dict[str, object]:
+        deps = self.dependencies()
+        # the journal's checks are blocking describes, made once before any step starts
+        resumed = await asyncio.get_running_loop().run_in_executor(None, self._resume, deps)
+        slots: Dict[str, asyncio.Semaphore] = {}
+        results: Dict[str, object] = {}
+        failed: Dict[str, BaseException] = {}
+        skipped: Set[str] = set()
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_step(name: str):
+            # tasks record their outcome instead of raising, so awaiting a parent never throws
+            if name in resumed:
+                return
+            for parent in deps[name]:
+                await tasks[parent]
+            if any(parent in failed or parent in skipped for parent in deps[name]):
+                skipped.add(name)
+                return
+            step = self.steps[name]
+            slot = slots.setdefault(step.region, asyncio.Semaphore(self.workers_per_region))
+            while True:
+                async with slot:
+                    try:
+                        results[name] = await self._execute_async(step)
+                        return
+                    except RetryStep as e:
+                        logger.info(f'Step re-queued: {name}: {e}')
+                        delay = e.delay
+                    except Exception as e:
+                        logger.exception(f'Step failed: {name}')
+                        failed[name] = e
+                        return
+                await asyncio.sleep(delay)
+
+        try:
+            for name in deps:
+                tasks[name] = asyncio.create_task(run_step(name), name=name)
+            await asyncio.gather(*tasks.values())
+        finally:
+            flush_config(self.filename)
+            if self.journal is not None:
+                self.journal.flush()
+
+        if failed:
+            raise ProvisioningError(failed, skipped)
+        return results
+
+    def run(self) -> Dict[str, object]:
+        return run_concurrently([self])[0]
+
+
+def run_concurrently(engines: Sequence, return_exceptions: bool = False) -> List:
+    # any number of engines (or anything with run_async) on one event loop, so many environments are brought
+    # up or torn down side by side without a thread per step
+    async def main():
+        try:
+            return await asyncio.gather(*(engine.run_async() for engine in engines),
+                                        return_exceptions=return_exceptions)
+        finally:
+            await aio_registry.close()
+
+    return asyncio.run(main())
@@ -0,0 +1,205 @@
+import ipaddress
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class AllocationError(ValueError):
+    pass
+
+
+class IntervalIndex:
+    # Disjoint address ranges kept sorted by start address, so overlap and containment checks are a
+    # binary search plus a look at the neighbours instead of a scan over every range.
+    def __init__(self):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        self._names: List[str] = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, str]]:
+        return iter(zip(self._starts, self._ends, self._names))
+
+    def overlapping(self, start: int, end: int) -> List[str]:
+        # ranges are disjoint, so only the one starting at or before `start` and those starting inside can overlap
+        i = bisect_right(self._starts, start) - 1
+        found = []
+        if i >= 0 and self._ends[i] >= start:
+            found.append(self._names[i])
+        j = i + 1
+        while j < len(self._starts) and self._starts[j] <= end:
+            found.append(self._names[j])
+            j += 1
+        return found
+
+    def is_free(self, start: int, end: int) -> bool:
+        i = bisect_right(self._starts, start) - 1
+        if i >= 0 and self._ends[i] >= start:
+            return False
+        return i + 1 >= len(self._starts) or self._starts[i + 1] > end
+
+    def add(self, start: int, end: int, name: str):
+        if not self.is_free(start, end):
+            raise AllocationError(f'{name} overlaps {", ".join(self.overlapping(start, end))}')
+        i = bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._names.insert(i, name)
+
+    def remove(self, start: int):
+        i = bisect_left(self._starts, start)
+        if i < len(self._starts) and self._starts[i] == start:
+            del self._starts[i], self._ends[i], self._names[i]
+
+
+def _bounds(network: Network) -> Tuple[int, int]:
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class CidrAllocator:
+    # Carves aligned blocks out of a supernet. Free space is kept as buddy free lists (one sorted list of
+    # block start addresses per prefix length), so allocating, reserving and releasing cost a few list
+    # operations per prefix length instead of a walk over every allocation; the interval index answers
+    # "is this range free" in logarithmic time.
+    def __init__(self, supernet: Union[str, Network], allocations: Optional[Dict[str, str]] = None):
+        self.supernet = ipaddress.ip_network(supernet)
+        self.index = IntervalIndex()
+        self.allocations: Dict[str, Network] = {}
+        self._free: Dict[int, List[int]] = {self.supernet.prefixlen: [int(self.supernet.network_address)]}
+        for name, cidr in (allocations or {}).items():
+            self.reserve(name, cidr)
+
+    def _network(self, start: int, prefixlen: int) -> Network:
+        return ipaddress.ip_network((start, prefixlen))
+
+    def _take(self, prefixlen: int, start: int) -> bool:
+        blocks = self._free.get(prefixlen, [])
+        i = bisect_left(blocks, start)
+        if i < len(blocks) and blocks[i] == start:
+            del blocks[i]
+            return True
+        return False
+
+    def _split_down(self, start: int, from_prefixlen: int, to_prefixlen: int, target: int):
+        # split a free block until the aligned block holding `target` has the requested size,
+        # returning every other half to the free lists
+        for prefixlen in range(from_prefixlen + 1, to_prefixlen + 1):
+            half = 1 << (self.supernet.max_prefixlen - prefixlen)
+            upper = start + half
+            if target >= upper:
+                insort(self._free.setdefault(prefixlen, []), start)
+                start = upper
+            else:
+                insort(self._free.setdefault(prefixlen, []), upper)
+
+    def is_free(self, cidr: Union[str, Network]) -> bool:
+        network = ipaddress.ip_network(cidr)
+        return network.subnet_of(self.supernet) and self.index.is_free(*_bounds(network))
+
+    def reserve(self, name: str, cidr: Union[str, Network]) -> Network:
+        network = ipaddress.ip_network(cidr)
+        if name in self.allocations:
+            if self.allocations[name] == network:
+                return network
+            raise AllocationError(f'{name} already holds {self.allocations[name]}')
+        if network.version != self.supernet.version or not network.subnet_of(self.supernet):
+            raise AllocationError(f'{name}: {network} is outside {self.supernet}')
+        start = int(network.network_address)
+        # the smallest free block that contains the range
+        for prefixlen in range(network.prefixlen, self.supernet.prefixlen - 1, -1):
+            block = int(network.supernet(new_prefix=prefixlen).network_address)
+            if self._take(prefixlen, block):
+                self._split_down(block, prefixlen, network.prefixlen, start)
+                break
+        else:
+            raise AllocationError(f'{name}: {network} overlaps {", ".join(self.index.overlapping(*_bounds(network)))}')
+        self.index.add(*_bounds(network), name)
+        self.allocations[name] = network
+        return network
+
+    def allocate(self, name: str, prefixlen: int) -> Network:
+        if name in self.allocations:
+            if self.allocations[name].prefixlen != prefixlen:
+                raise AllocationError(f'{name} already holds {self.allocations[name]}')
+            return self.allocations[name]
+        if not self.supernet.prefixlen <= prefixlen <= self.supernet.max_prefixlen:
+            raise AllocationError(f'{name}: /{prefixlen} does not fit in {self.supernet}')
+        # lowest-addressed free block of the smallest size that fits, so space stays packed
+        for size in range(prefixlen, self.supernet.prefixlen - 1, -1):
+            blocks = self._free.get(size)
+            if blocks:
+                start = blocks.pop(0)
+                self._split_down(start, size, prefixlen, start)
+                network = self._network(start, prefixlen)
+                self.index.add(*_bounds(network), name)
+                self.allocations[name] = network
+                return network
+        raise AllocationError(f'{name}: no free /{prefixlen} left in {self.supernet}')
+
+    def release(self, name: str):
+        network = self.allocations.pop(name)
+        start, prefixlen = int(network.network_address), network.prefixlen
+        self.index.remove(start)
+        # merge with the buddy for as long as it is free too
+        while prefixlen > self.supernet.prefixlen:
+            size = 1 << (self.supernet.max_prefixlen - prefixlen)
+            buddy = start ^ size
+            if not self._take(prefixlen, buddy):
+                break
+            start = min(start, buddy)
+            prefixlen -= 1
+        insort(self._free.setdefault(prefixlen, []), start)
+
+    def state(self) -> Dict[str, str]:
+        return {name: str(network) for name, network in self.allocations.items()}
+
+
+class PrefixTrie:
+    # Longest-prefix match over a route table: a binary trie on the address bits, one level per prefix length,
+    # so a lookup walks at most 32 (or 128) nodes whatever the number of routes. Each node is
+    # [child for bit 0, child for bit 1, (network, value) of the route ending there].
+    def __init__(self, version: int = 4):
+        self.version = version
+        self.max_prefixlen = 32 if version == 4 else 128
+        self._root: list = [None, None, None]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, cidr: Union[str, Network], value):
+        network = ipaddress.ip_network(cidr)
+        if network.version != self.version:
+            raise ValueError(f'{network} is not an IPv{self.version} network')
+        start, node = int(network.network_address), self._root
+        for depth in range(network.prefixlen):
+            bit = (start >> (self.max_prefixlen - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self._size += 1
+        node[2] = (network, value)
+
+    def longest_match(self, address) -> Optional[Tuple[Network, object]]:
+        # (network, value) of the most specific route covering the address, if any
+        address = int(ipaddress.ip_address(address)) if not isinstance(address, int) else address
+        node, match = self._root, self._root[2]
+        for depth in range(self.max_prefixlen):
+            node = node[(address >> (self.max_prefixlen - 1 - depth)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+    def __iter__(self) -> Iterator[Tuple[Network, object]]:
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node[2] is not None:
+                yield node[2]
+            stack.extend(child for child in node[:2] if child is not None)
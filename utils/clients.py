@@ -0,0 +1,189 @@
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+# boto3/botocore are imported on first use: importing them costs more than most short runs spend on API calls
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+DEFAULT_RETRIES = {'max_attempts': 8, 'mode': 'standard'}
+MODEL_CACHE_ENV = 'NSP_MODEL_CACHE_DIR'
+# set in the request context of every call, so event handlers can tell accounts apart
+ACCOUNT_CONTEXT_KEY = 'nsp_account'
+
+
+class ClientRegistry:
+    # Clients are created on first use and cached per (service, region, account); every client of an
+    # account is built from one boto3 session, so the botocore session, credentials and loaded service
+    # models are shared. Clients are thread-safe and shared across threads; resources are not, so those
+    # are cached per thread.
+    def __init__(self, max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS, retries: Optional[dict] = None,
+                 model_cache_dir: Optional[str] = None):
+        self.max_pool_connections = max_pool_connections
+        self.retries = dict(retries or DEFAULT_RETRIES)
+        self.model_cache_dir = model_cache_dir or os.environ.get(MODEL_CACHE_ENV)
+        self._sessions: Dict[Optional[str], 'boto3.session.Session'] = {}
+        self._clients: Dict[Tuple[str, str, Optional[str]], object] = {}
+        # the account of every client built here, its resources' clients included
+        self._accounts: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._event_handlers: List[Tuple[str, Callable, Callable, bool]] = []
+        self.offline = False
+
+    def configure(self, max_pool_connections: Optional[int] = None, retries: Optional[dict] = None,
+                  model_cache_dir: Optional[str] = None):
+        with self._lock:
+            if max_pool_connections is not None:
+                self.max_pool_connections = max_pool_connections
+            if retries is not None:
+                self.retries = dict(retries)
+            if model_cache_dir is not None:
+                self.model_cache_dir = model_cache_dir
+                self._sessions.clear()
+            # clients built with the previous settings are dropped and rebuilt on next use
+            self._clients.clear()
+            self._local = threading.local()
+
+    def config(self) -> 'botocore.config.Config':
+        from botocore.config import Config
+        return Config(max_pool_connections=self.max_pool_connections, retries=self.retries)
+
+    def session(self, account: Optional[str] = None) -> 'boto3.session.Session':
+        # an account is addressed through its named profile; None is the default credential chain
+        with self._lock:
+            if account not in self._sessions:
+                import boto3
+                import botocore.session
+                core = botocore.session.get_session()
+                if self.model_cache_dir:
+                    from utils.startup import install_model_cache
+                    install_model_cache(core, self.model_cache_dir)
+                self.install_handlers(core, account)
+                self._sessions[account] = boto3.session.Session(botocore_session=core, profile_name=account)
+            return self._sessions[account]
+
+    def install_handlers(self, botocore_session, account: Optional[str], asynchronous: bool = False):
+        botocore_session.register('before-parameter-build', partial(_tag_account, account))
+        events = botocore_session.get_component('event_emitter')
+        for event_name, handler, async_handler, first in self._event_handlers:
+            register = events.register_first if first else events.register
+            register(event_name, async_handler if asynchronous else handler)
+
+    def register_event(self, event_name: str, handler: Callable, async_handler: Optional[Callable] = None,
+                       first: bool = False):
+        # a botocore event handler for every client of every account, e.g. 'before-call' or 'after-call.ec2';
+        # asyncio clients (utils.aio) await async_handler instead, if given, for handlers that would block the loop.
+        # first handlers run ahead of the others, e.g. a before-call that answers calls without a request
+        with self._lock:
+            self._event_handlers.append((event_name, handler, async_handler or handler, first))
+            for session in self._sessions.values():
+                (session.events.register_first if first else session.events.register)(event_name, handler)
+            # clients copy the session's handlers when they are built, so the ones built so far are rebuilt
+            self._clients.clear()
+            self._local = threading.local()
+
+    def client(self, service: str, region: str, account: Optional[str] = None):
+        if self.offline:
+            return OfflineClient(service, region, account)
+        key = (service, region, account)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self.session(account).client(service, region_name=region, config=self.config())
+                    self._clients[key] = client
+                    self._accounts[client] = account
+        return client
+
+    def thread_resource(self, service: str, region: str, account: Optional[str] = None):
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+        key = (service, region, account)
+        if key not in resources:
+            # boto3 sessions are not safe to build clients from concurrently
+            with self._lock:
+                resources[key] = self.session(account).resource(service, region_name=region, config=self.config())
+                self._accounts[resources[key].meta.client] = account
+        return resources[key]
+
+    def account_of(self, client) -> Optional[str]:
+        # None for the default credential chain, and for clients built elsewhere
+        return self._accounts.get(client)
+
+    def resource(self, service: str, region: str, account: Optional[str] = None) -> 'ResourceProxy':
+        if self.offline:
+            return OfflineClient(service, region, account)
+        return ResourceProxy(self, service, region, account)
+
+
+def _tag_account(account: Optional[str], context: dict, **kwargs):
+    context[ACCOUNT_CONTEXT_KEY] = account
+
+
+class ResourceProxy:
+    # Stands in for a boto3 service resource and forwards to the calling thread's own instance,
+    # so one handle can be passed to steps that run on any worker thread.
+    def __init__(self, registry: ClientRegistry, service: str, region: str, account: Optional[str] = None):
+        self._registry = registry
+        self._key = (service, region, account)
+
+    def __getattr__(self, name: str):
+        return getattr(self._registry.thread_resource(*self._key), name)
+
+    def __repr__(self):
+        return f'ResourceProxy{self._key}'
+
+
+class OfflineClient:
+    # Handed out instead of clients and resources while plans are built: planning works from the step
+    # graph and the state file alone, so any use of one is a bug rather than an AWS call.
+    def __init__(self, service: str, region: str, account: Optional[str] = None):
+        self._key = (service, region, account)
+
+    def __getattr__(self, name: str):
+        raise RuntimeError(f'{name} called on {self} while planning offline')
+
+    def __repr__(self):
+        return f'OfflineClient{self._key}'
+
+
+registry = ClientRegistry()
+
+
+def configure_clients(max_pool_connections: Optional[int] = None, retries: Optional[dict] = None,
+                      model_cache_dir: Optional[str] = None):
+    registry.configure(max_pool_connections=max_pool_connections, retries=retries, model_cache_dir=model_cache_dir)
+
+
+@contextmanager
+def offline_clients():
+    # no boto3 import, no client construction and no AWS calls inside the block
+    registry.offline = True
+    try:
+        yield
+    finally:
+        registry.offline = False
+
+
+def register_client_event(event_name: str, handler: Callable, async_handler: Optional[Callable] = None,
+                          first: bool = False):
+    registry.register_event(event_name, handler, async_handler, first)
+
+
+def get_client(service: str, region: str, account: Optional[str] = None):
+    return registry.client(service, region, account)
+
+
+def get_resource(service: str, region: str, account: Optional[str] = None) -> ResourceProxy:
+    return registry.resource(service, region, account)
+
+
+def client_account(client) -> Optional[str]:
+    # proxies (asyncio clients included) carry their (service, region, account) key
+    key = getattr(client, '_key', None)
+    return key[2] if key is not None else registry.account_of(client)
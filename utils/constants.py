@@ -0,0 +1,240 @@
+import ipaddress
+import logging
+import os
+import pickle
+import re
+import tempfile
+import threading
+from dataclasses import MISSING, dataclass, fields
+from typing import Dict, List, Tuple, Type
+
+logger = logging.getLogger()
+
+# bump whenever a section class changes so stale compiled caches are ignored
+SCHEMA_VERSION = 2
+
+KNOWN_REGIONS = frozenset([
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2',
+    'ca-central-1', 'sa-east-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1', 'eu-south-1',
+    'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2',
+    'ap-east-1', 'me-south-1', 'af-south-1',
+])
+
+_AMI = re.compile(r'^ami-[0-9a-f]{8,17}$')
+_REGION_KEY = re.compile(r'^REGION(\d)$')
+_INSTANCE_TYPE = re.compile(r'^[a-z][a-z0-9-]*\.[a-z0-9]+$')
+
+
+class ConfigError(ValueError):
+    def __init__(self, section: str, problems: List[str]):
+        self.section = section
+        self.problems = problems
+        super().__init__(f'Invalid constants for section {section}:\n  ' + '\n  '.join(problems))
+
+
+class _Section:
+    # fields are the YAML keys in lower case; item access keeps constants['VPC1'] working
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key.lower())
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str):
+        return hasattr(self, key.lower())
+
+    def keys(self) -> List[str]:
+        return [f.name.upper() for f in fields(self)]
+
+    def items(self) -> List[Tuple[str, object]]:
+        return [(f.name.upper(), getattr(self, f.name)) for f in fields(self)]
+
+
+@dataclass(frozen=True)
+class _VpcPairSection(_Section):
+    ip_cidr1: str
+    ip_cidr2: str
+    vpc1: str
+    vpc2: str
+    subnet_cidr11: str
+    subnet_cidr12: str
+    subnet_cidr21: str
+    subnet1_vpc1: str
+    subnet2_vpc1: str
+    subnet1_vpc2: str
+    region1: str
+    region1_az: str
+    igw: str
+    vpc1_pub_route_table: str
+    vpc1_pri_route_table: str
+    vpc2_pri_route_table: str
+    tgw_attach_vpc1: str
+    tgw_attach_vpc2: str
+    tgw_1_route_table: str
+    us_east_1_image: str
+    ec2_pub_1_vpc1: str
+    ec2_pri_2_vpc1: str
+    ec2_pri_1_vpc2: str
+    sg_pub_1_vpc1: str
+    sg_pri_2_vpc1: str
+    sg_pri_1_vpc2: str
+
+    # (subnet CIDR key, VPC CIDR key) pairs that have to nest
+    subnets = (('SUBNET_CIDR11', 'IP_CIDR1'), ('SUBNET_CIDR12', 'IP_CIDR1'), ('SUBNET_CIDR21', 'IP_CIDR2'))
+    # (AZ key, region key) pairs that have to match
+    zones = (('REGION1_AZ', 'REGION1'),)
+
+
+@dataclass(frozen=True)
+class IntraRegionConstants(_VpcPairSection):
+    tgw: str
+    # optional fleet settings, applied to every instance of the scenario
+    instance_type: str = 't2.micro'
+    instance_count: int = 1
+
+
+@dataclass(frozen=True)
+class InterRegionConstants(_VpcPairSection):
+    region2: str
+    region2_az: str
+    tgw_1: str
+    tgw_2: str
+    tgw_peer_connect: str
+    tgw_2_route_table: str
+    us_west_1_image: str
+    instance_type: str = 't2.micro'
+    instance_count: int = 1
+
+    zones = (('REGION1_AZ', 'REGION1'), ('REGION2_AZ', 'REGION2'))
+
+
+SECTIONS: Dict[str, Type[_Section]] = {
+    'intra_region': IntraRegionConstants,
+    'inter_region': InterRegionConstants,
+}
+
+
+def _validate(section: str, schema: Type[_Section], raw) -> List[str]:
+    if not isinstance(raw, dict):
+        return [f'expected a mapping, got {type(raw).__name__}']
+    problems = []
+    expected = {f.name.upper() for f in fields(schema)}
+    optional = {f.name.upper() for f in fields(schema) if f.default is not MISSING}
+    integers = {f.name.upper() for f in fields(schema) if f.type is int}
+    missing = sorted(expected - optional - raw.keys())
+    unknown = sorted(raw.keys() - expected)
+    if missing:
+        problems.append(f'missing keys: {", ".join(missing)}')
+    if unknown:
+        problems.append(f'unknown keys: {", ".join(unknown)}')
+
+    networks = {}
+    for key, value in raw.items():
+        if key in integers:
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                problems.append(f'{key}: expected a positive integer, got {value!r}')
+            continue
+        if not isinstance(value, str) or not value:
+            problems.append(f'{key}: expected a non-empty string, got {value!r}')
+            continue
+        if 'CIDR' in key:
+            try:
+                networks[key] = ipaddress.ip_network(value)
+            except ValueError as e:
+                problems.append(f'{key}: {e}')
+        elif _REGION_KEY.match(key) and value not in KNOWN_REGIONS:
+            problems.append(f'{key}: unknown region {value}')
+        elif key.endswith('_IMAGE') and not _AMI.match(value):
+            problems.append(f'{key}: {value} is not an AMI id')
+        elif key == 'INSTANCE_TYPE' and not _INSTANCE_TYPE.match(value):
+            problems.append(f'{key}: {value} is not an instance type')
+
+    for az_key, region_key in schema.zones:
+        az, region = raw.get(az_key), raw.get(region_key)
+        if isinstance(az, str) and isinstance(region, str) and not re.fullmatch(re.escape(region) + '[a-z]', az):
+            problems.append(f'{az_key}: {az} is not an availability zone of {region}')
+
+    for subnet_key, vpc_key in schema.subnets:
+        subnet, vpc = networks.get(subnet_key), networks.get(vpc_key)
+        if subnet and vpc and not subnet.subnet_of(vpc):
+            problems.append(f'{subnet_key}: {subnet} is outside {vpc_key} {vpc}')
+    subnet_keys = [key for key, _ in schema.subnets]
+    for vpc_or_subnets in (['IP_CIDR1', 'IP_CIDR2'], subnet_keys):
+        present = [key for key in vpc_or_subnets if key in networks]
+        for i, first in enumerate(present):
+            for second in present[i + 1:]:
+                if networks[first].overlaps(networks[second]):
+                    problems.append(f'{first} {networks[first]} overlaps {second} {networks[second]}')
+
+    # every name becomes a key in the section state file, so they must not collide
+    names: Dict[str, str] = {}
+    for key, value in raw.items():
+        if not isinstance(value, str) or 'CIDR' in key or key.startswith('REGION') or key.endswith('_IMAGE') \
+                or key == 'INSTANCE_TYPE':
+            continue
+        if value in names:
+            problems.append(f'{key} and {names[value]} share the name {value}')
+        names[value] = key
+    return problems
+
+
+def compile_constants(raw: dict) -> Dict[str, _Section]:
+    compiled = {}
+    for section, schema in SECTIONS.items():
+        if section not in raw:
+            continue
+        problems = _validate(section, schema, raw[section])
+        if problems:
+            raise ConfigError(section, problems)
+        compiled[section] = schema(**{key.lower(): value for key, value in raw[section].items()})
+    return compiled
+
+
+def _cache_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.cache')
+
+
+def _read_cache(path: str, stamp: tuple):
+    try:
+        with open(_cache_path(path), 'rb') as file:
+            cached_stamp, compiled = pickle.load(file)
+    except Exception:
+        # a cache pickled by another version of this module can fail in any number of ways (a class moved or
+        # renamed, a changed signature); it is only a cache, so rebuild it from the YAML
+        return None
+    return compiled if cached_stamp == stamp else None
+
+
+def _write_cache(path: str, stamp: tuple, compiled: Dict[str, _Section]):
+    directory = os.path.dirname(path) or '.'
+    try:
+        fd, temp_path = tempfile.mkstemp(prefix='.constants', suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((stamp, compiled), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, _cache_path(path))
+    except OSError:
+        logger.warning(f'Could not write compiled constants cache for {path}')
+
+
+_compiled: Dict[str, Tuple[tuple, Dict[str, _Section]]] = {}
+_compiled_lock = threading.Lock()
+
+
+def load_constants(path: str) -> Dict[str, _Section]:
+    st = os.stat(path)
+    stamp = (SCHEMA_VERSION, st.st_mtime_ns, st.st_size)
+    with _compiled_lock:
+        if path in _compiled and _compiled[path][0] == stamp:
+            return _compiled[path][1]
+        compiled = _read_cache(path, stamp)
+        if compiled is None:
+            # only a cache miss pays for importing and running the YAML parser
+            import yaml
+            with open(path, 'r') as file:
+                raw = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            compiled = compile_constants(raw or {})
+            _write_cache(path, stamp, compiled)
+        _compiled[path] = (stamp, compiled)
+        return compiled
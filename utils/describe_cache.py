@@ -0,0 +1,240 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional, Tuple
+
+from utils.clients import ACCOUNT_CONTEXT_KEY, register_client_event
+from utils.ratelimit import NON_MUTATING_PREFIXES
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# seconds a describe result is served from memory, per resource type. What changes on AWS's side by itself
+# (gateways and attachments coming up, instances booting) expires sooner; nothing we mutate outlives its next change.
+DEFAULT_TTLS: Dict[str, float] = {
+    'vpc': 60.0, 'subnet': 60.0, 'igw': 60.0, 'route_table': 30.0, 'security_group': 30.0,
+    'tgw': 15.0, 'tgw_attachment': 10.0, 'tgw_route': 10.0, 'instance': 5.0,
+}
+
+# the EC2 reads that are cached, by the resource type they describe
+CACHED_OPERATIONS: Dict[str, str] = {
+    'DescribeVpcs': 'vpc', 'DescribeSubnets': 'subnet', 'DescribeInternetGateways': 'igw',
+    'DescribeRouteTables': 'route_table', 'DescribeSecurityGroups': 'security_group',
+    'DescribeTransitGateways': 'tgw', 'DescribeTransitGatewayAttachments': 'tgw_attachment',
+    'DescribeTransitGatewayVpcAttachments': 'tgw_attachment',
+    'DescribeTransitGatewayPeeringAttachments': 'tgw_attachment',
+    'DescribeTransitGatewayRouteTables': 'tgw_route', 'SearchTransitGatewayRoutes': 'tgw_route',
+    'DescribeInstances': 'instance',
+}
+
+# what a mutating call makes stale, by the first part of its name that matches; calls that match none (tags
+# included, which every tag filter reads) make everything stale
+INVALIDATES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ('TransitGatewayRoute', ('tgw_route', 'tgw_attachment')),
+    ('Attachment', ('tgw_attachment', 'tgw_route', 'tgw')),
+    ('TransitGateway', ('tgw', 'tgw_attachment', 'tgw_route')),
+    # routes, route tables and their associations
+    ('Route', ('route_table',)),
+    ('InternetGateway', ('igw',)),
+    ('SecurityGroup', ('security_group',)),
+    ('Subnet', ('subnet', 'route_table')),
+    ('Instances', ('instance',)),
+    # a VPC comes with its main route table and default security group
+    ('Vpc', ('vpc', 'route_table', 'security_group')),
+)
+# mutations that show in other regions too: a peering attachment is described on both sides
+CROSS_REGION_PARTS = ('PeeringAttachment',)
+
+MAX_ENTRIES = 4096
+
+_PENDING = 'nsp_describe_cache'
+_MUTATION = 'nsp_describe_cache_mutation'
+
+# set while a caller needs what AWS says now, e.g. a waiter polling for a state change
+_uncached: contextvars.ContextVar = contextvars.ContextVar('uncached', default=False)
+
+# (account, region, operation, request)
+CacheKey = Tuple[Optional[str], str, str, str]
+
+
+@contextmanager
+def uncached():
+    # reads in the block go to AWS; what they return still refreshes the cache
+    token = _uncached.set(True)
+    try:
+        yield
+    finally:
+        _uncached.reset(token)
+
+
+def invalidated_types(operation: str) -> Tuple[str, ...]:
+    return next((types for part, types in INVALIDATES if part in operation), tuple(DEFAULT_TTLS))
+
+
+class _CachedResponse:
+    # handed to botocore in place of the HTTP response of a call that was not made
+    status_code = 200
+    headers: Dict[str, str] = {}
+    content = b''
+
+
+@dataclass
+class _Entry:
+    parsed: dict
+    expires: float
+    resource_type: str
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
+
+
+class DescribeCache:
+    # A read-through cache of EC2 describe results, on botocore's event hooks of every client the registry builds:
+    # a call that was answered before, with the same parameters, in the same account and region, is answered
+    # from memory until its resource type's TTL runs out, without a request, a rate limiter token or a metric.
+    # Any mutating call makes the types it touches stale in its account and region, and a describe that was in
+    # flight while one ran is not stored, so a read never returns what the process itself has since changed.
+    def __init__(self, ttls: Optional[Mapping[str, float]] = None, max_entries: int = MAX_ENTRIES):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.entries: Dict[CacheKey, _Entry] = {}
+        self.stats_by_type: Dict[str, CacheStats] = {}
+        # bumped by every mutation of (account, region, resource type)
+        self._generations: Dict[Tuple[Optional[str], str, str], int] = {}
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def install(self) -> 'DescribeCache':
+        with self._lock:
+            if not self._installed:
+                # ahead of the rate limiter and metrics, which a call answered from memory never reaches
+                register_client_event('before-call.ec2', self._before_call, first=True)
+                register_client_event('after-call.ec2', self._after_call)
+                self._installed = True
+        return self
+
+    def _stats(self, resource_type: str) -> CacheStats:
+        stats = self.stats_by_type.get(resource_type)
+        if stats is None:
+            stats = self.stats_by_type[resource_type] = CacheStats()
+        return stats
+
+    def invalidate(self, account: Optional[str], region: Optional[str], resource_types: Tuple[str, ...]):
+        # region None is every region of the account
+        with self._lock:
+            for resource_type in resource_types:
+                self._stats(resource_type).invalidations += 1
+            self._drop(account, region, resource_types)
+
+    def _drop(self, account: Optional[str], region: Optional[str], resource_types: Tuple[str, ...]):
+        regions = {key[1] for key in self._generations if key[0] == account} | {key[1] for key in self.entries} \
+            if region is None else {region}
+        for generation in ((account, each, resource_type) for each in regions for resource_type in resource_types):
+            self._generations[generation] = self._generations.get(generation, 0) + 1
+        stale = [key for key, entry in self.entries.items()
+                 if key[0] == account and key[1] in regions and entry.resource_type in resource_types]
+        for key in stale:
+            del self.entries[key]
+
+    @staticmethod
+    def _scope(operation: str, context: dict) -> Tuple[Optional[str], Optional[str]]:
+        # (account, region) a mutation makes reads stale in
+        if any(part in operation for part in CROSS_REGION_PARTS):
+            return context.get(ACCOUNT_CONTEXT_KEY), None
+        return context.get(ACCOUNT_CONTEXT_KEY), context.get('client_region') or 'unknown'
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    @staticmethod
+    def _key(model, params: dict, context: dict) -> CacheKey:
+        # the serialized request, so two calls that send the same thing share an entry
+        body = params.get('body')
+        request = json.dumps(body, sort_keys=True, default=str) if isinstance(body, dict) else repr(body)
+        return context.get(ACCOUNT_CONTEXT_KEY), context.get('client_region') or 'unknown', model.name, request
+
+    def _before_call(self, model, params, context, **kwargs):
+        operation = model.name
+        resource_type = CACHED_OPERATIONS.get(operation)
+        if resource_type is None:
+            if not operation.startswith(NON_MUTATING_PREFIXES):
+                types = invalidated_types(operation)
+                context[_MUTATION] = types
+                self.invalidate(*self._scope(operation, context), types)
+            return None
+        if resource_type not in self.ttls:
+            return None
+        key = self._key(model, params, context)
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats(resource_type)
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires > now and not _uncached.get():
+                stats.hits += 1
+                return _CachedResponse(), copy.deepcopy(entry.parsed)
+            stats.misses += 1
+            context[_PENDING] = key, resource_type, self._generations.get((key[0], key[1], resource_type), 0)
+        return None
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        types = context.pop(_MUTATION, None)
+        if types:
+            # whatever was read while the call ran may predate it
+            with self._lock:
+                self._drop(*self._scope(model.name, context), types)
+            return
+        pending = context.pop(_PENDING, None)
+        if pending is None or http_response.status_code >= 300:
+            return
+        key, resource_type, generation = pending
+        with self._lock:
+            if self._generations.get((key[0], key[1], resource_type), 0) != generation:
+                return
+            now = time.monotonic()
+            if len(self.entries) >= self.max_entries:
+                self.entries = {k: entry for k, entry in self.entries.items() if entry.expires > now}
+            if len(self.entries) < self.max_entries:
+                self.entries[key] = _Entry(copy.deepcopy(parsed), now + self.ttls[resource_type], resource_type)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {resource_type: stats.to_dict() for resource_type, stats in sorted(self.stats_by_type.items())}
+
+    def totals(self) -> Dict[str, object]:
+        with self._lock:
+            stats = list(self.stats_by_type.values())
+        hits, misses = sum(x.hits for x in stats), sum(x.misses for x in stats)
+        return {'hits': hits, 'misses': misses, 'invalidations': sum(x.invalidations for x in stats),
+                'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None}
+
+
+describe_cache = DescribeCache()
+
+
+def enable_describe_cache(ttl_scale: float = 1.0) -> DescribeCache:
+    # ttl_scale stretches or shrinks every TTL, e.g. 0.5 in an account where other tools change the same resources
+    describe_cache.ttls = {resource_type: ttl * ttl_scale for resource_type, ttl in DEFAULT_TTLS.items()}
+    describe_cache.install()
+    atexit.register(_log_totals)
+    return describe_cache
+
+
+def _log_totals():
+    totals = describe_cache.totals()
+    if totals['hits'] or totals['misses']:
+        logger.info(f'Describe cache: {totals}')
@@ -0,0 +1,286 @@
+import heapq
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from utils.journal import StepJournal
+from utils.plan import Plan, PlannedStep, plan_phases
+from utils.state import step_region
+from utils.utils import load_config, flush_config
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+DEFAULT_WORKERS_PER_REGION = 4
+
+
+class ProvisioningError(Exception):
+    def __init__(self, failed: Dict[str, BaseException], skipped: Set[str]):
+        self.failed = failed
+        self.skipped = skipped
+        super().__init__(f'{len(failed)} step(s) failed: {sorted(failed)}; '
+                         f'{len(skipped)} dependent step(s) skipped: {sorted(skipped)}')
+
+
+class RetryStep(Exception):
+    # Raised by a step that cannot make progress yet: the engine frees the worker and runs the step again
+    # after `delay` seconds, without holding back any other step.
+    def __init__(self, delay: float, reason: str = ''):
+        self.delay = delay
+        self.reason = reason
+        super().__init__(f'retry in {delay:.1f}s: {reason}' if reason else f'retry in {delay:.1f}s')
+
+
+def state_keys(inputs: Sequence[str] = (), outputs: Sequence[str] = (),
+               api_calls: Union[int, Callable[[dict], int]] = 1, get_or_create: bool = False):
+    # Names the keyword arguments of a services function that are passed to load_config (inputs)
+    # and store_config (outputs), so the engine can wire steps together from their kwargs alone.
+    # api_calls is how many AWS calls one run makes at least (waiters count one poll), or a function
+    # of the step kwargs returning it; plans add these up. get_or_create marks functions that reuse the
+    # resource carrying their Name tag, which plans count as reused rather than created again.
+    def decorator(func):
+        func.state_inputs = tuple(inputs)
+        func.state_outputs = tuple(outputs)
+        func.api_calls = api_calls
+        func.get_or_create = get_or_create
+        return func
+
+    return decorator
+
+
+@dataclass
+class Step:
+    name: str
+    func: Callable
+    region: str
+    kwargs: dict = field(default_factory=dict)
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    after: Tuple[str, ...] = ()
+
+    def __call__(self):
+        return self.func(**self.kwargs)
+
+    @property
+    def api_calls(self) -> int:
+        api_calls = getattr(self.func, 'api_calls', 1)
+        return api_calls(self.kwargs) if callable(api_calls) else api_calls
+
+
+def _resolve_keys(func: Callable, attribute: str, kwargs: dict) -> Tuple[str, ...]:
+    keys = []
+    for argument in getattr(func, attribute, ()):
+        value = kwargs.get(argument)
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            keys.extend(value)
+        else:
+            keys.append(value)
+    return tuple(keys)
+
+
+class ProvisioningEngine:
+    # with a journal, completed steps are recorded, and a run skips those an earlier run already completed
+    def __init__(self, filename: str, workers_per_region: int = DEFAULT_WORKERS_PER_REGION,
+                 journal: Optional[StepJournal] = None):
+        self.filename = filename
+        self.workers_per_region = workers_per_region
+        self.journal = journal
+        self.steps: Dict[str, Step] = {}
+
+    def add(self, func: Callable, region: str, label: Optional[str] = None, inputs: Sequence[str] = (),
+            outputs: Sequence[str] = (), after: Sequence = (), **kwargs) -> Step:
+        inputs = tuple(inputs) + _resolve_keys(func, 'state_inputs', kwargs)
+        if kwargs.get('persist', True):
+            outputs = tuple(outputs) + _resolve_keys(func, 'state_outputs', kwargs)
+        name = label or f'{func.__name__}({", ".join(outputs or inputs)})'
+        if name in self.steps:
+            raise ValueError(f'Duplicate step {name}')
+        after = tuple(x.name if isinstance(x, Step) else x for x in after)
+        step = Step(name=name, func=func, region=region, kwargs=kwargs, inputs=inputs, outputs=outputs, after=after)
+        self.steps[name] = step
+        return step
+
+    def dependencies(self) -> Dict[str, Set[str]]:
+        producers: Dict[str, str] = {}
+        for step in self.steps.values():
+            for key in step.outputs:
+                if key in producers:
+                    raise ValueError(f'{key} is produced by both {producers[key]} and {step.name}')
+                producers[key] = step.name
+
+        deps: Dict[str, Set[str]] = {}
+        for step in self.steps.values():
+            unknown = [x for x in step.after if x not in self.steps]
+            if unknown:
+                raise ValueError(f'{step.name} runs after unknown step(s) {unknown}')
+            # Inputs nobody produces are expected to already be in the state file.
+            deps[step.name] = set(step.after) | {producers[key] for key in step.inputs if key in producers}
+            deps[step.name].discard(step.name)
+        self._check_acyclic(deps)
+        return deps
+
+    @staticmethod
+    def _check_acyclic(deps: Dict[str, Set[str]]) -> List[str]:
+        # the steps in an order they can run in
+        order = []
+        remaining = {name: set(d) for name, d in deps.items()}
+        while remaining:
+            ready = [name for name, d in remaining.items() if not d]
+            if not ready:
+                raise ValueError(f'Dependency cycle between steps {sorted(remaining)}')
+            order.extend(ready)
+            for name in ready:
+                del remaining[name]
+            for d in remaining.values():
+                d.difference_update(ready)
+        return order
+
+    def _resume(self, deps: Dict[str, Set[str]]) -> Set[str]:
+        if self.journal is None:
+            return set()
+        skipped = self.journal.resume(self.steps, deps, self._check_acyclic(deps))
+        for name in sorted(skipped):
+            logger.info(f'Step skipped: {name} [{self.steps[name].region}] completed in an earlier run')
+        return skipped
+
+    def plan_steps(self, state: dict, produced: Set[str] = frozenset(), offset: int = 0) -> List[PlannedStep]:
+        # the steps in an order they can run in, with what each would create, reuse or delete;
+        # `produced` holds the keys earlier phases create, which this one may read
+        deps = self.dependencies()
+        own = {key for step in self.steps.values() for key in step.outputs}
+        # a run skips these if what they recorded is still there, which a plan cannot ask AWS about
+        completed = self.journal.completed(self.steps, deps, self._check_acyclic(deps), state) \
+            if self.journal is not None else set()
+        depth: Dict[str, int] = {}
+        remaining = {name: set(d) for name, d in deps.items()}
+        planned = []
+        while remaining:
+            ready = sorted(name for name, d in remaining.items() if not d)
+            for name in ready:
+                del remaining[name]
+                step = self.steps[name]
+                depth[name] = 1 + max((depth[x] for x in deps[name]), default=offset)
+                external = [key for key in step.inputs if key not in own]
+                if name in completed:
+                    kept = step.outputs
+                elif getattr(step.func, 'get_or_create', False):
+                    kept = tuple(key for key in step.outputs if key in state)
+                else:
+                    kept = ()
+                planned.append(PlannedStep(
+                    name=name, region=step.region, after=tuple(sorted(deps[name])),
+                    api_calls=0 if name in completed else step.api_calls, depth=depth[name],
+                    creates=tuple(key for key in step.outputs if key not in kept),
+                    recreates=tuple(key for key in step.outputs if key in state and key not in kept),
+                    reuses=kept + tuple(key for key in external if key in state and key not in produced),
+                    missing=tuple(key for key in external if key not in state and key not in produced),
+                    deletes=tuple(getattr(step.func, 'deletes', ())), completed=name in completed))
+            for d in remaining.values():
+                d.difference_update(ready)
+        return planned
+
+    def plan(self, state: Optional[dict] = None) -> Plan:
+        return plan_phases(self.filename, [self], state)
+
+    def _verify_outputs(self, step: Step):
+        # services functions log and swallow ClientError, so a missing output is the only sign of failure
+        state = load_config(filename=self.filename)
+        missing = [key for key in step.outputs if key not in state]
+        if missing:
+            raise RuntimeError(f'{step.name} did not store {missing}')
+
+    def _execute(self, step: Step):
+        started = time.monotonic()
+        logger.info(f'Step started: {step.name} [{step.region}]')
+        # backends that index by region (utils.state_db) learn it from here
+        token = step_region.set(step.region)
+        try:
+            result = step()
+            self._verify_outputs(step)
+            if self.journal is not None:
+                self.journal.record(step)
+        finally:
+            step_region.reset(token)
+        logger.info(f'Step finished: {step.name} [{step.region}] in {time.monotonic() - started:.1f}s')
+        return result
+
+    def run(self) -> Dict[str, object]:
+        deps = self.dependencies()
+        dependents: Dict[str, Set[str]] = defaultdict(set)
+        for name, d in deps.items():
+            for parent in d:
+                dependents[parent].add(name)
+
+        resumed = self._resume(deps)
+        waiting = {name: len(d - resumed) for name, d in deps.items()}
+        ready: List[str] = [name for name, count in waiting.items() if count == 0 and name not in resumed]
+        pools: Dict[str, ThreadPoolExecutor] = {}
+        running = {}
+        # (due time, name) of steps that asked to be run again later
+        delayed: List[Tuple[float, str]] = []
+        results: Dict[str, object] = {}
+        failed: Dict[str, BaseException] = {}
+        skipped: Set[str] = set()
+
+        try:
+            while ready or running or delayed:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    ready.append(heapq.heappop(delayed)[1])
+                for name in ready:
+                    step = self.steps[name]
+                    if step.region not in pools:
+                        pools[step.region] = ThreadPoolExecutor(max_workers=self.workers_per_region,
+                                                                thread_name_prefix=f'engine-{step.region}')
+                    running[pools[step.region].submit(self._execute, step)] = name
+                ready = []
+
+                timeout = max(0.0, delayed[0][0] - time.monotonic()) if delayed else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except RetryStep as e:
+                        logger.info(f'Step re-queued: {name}: {e}')
+                        heapq.heappush(delayed, (time.monotonic() + e.delay, name))
+                        continue
+                    except Exception as e:
+                        logger.exception(f'Step failed: {name}')
+                        failed[name] = e
+                        skipped |= self._descendants(name, dependents)
+                        continue
+                    for child in dependents[name]:
+                        waiting[child] -= 1
+                        if waiting[child] == 0 and child not in skipped:
+                            ready.append(child)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+            flush_config(self.filename)
+            if self.journal is not None:
+                self.journal.flush()
+
+        if failed:
+            raise ProvisioningError(failed, skipped)
+        return results
+
+    @staticmethod
+    def _descendants(name: str, dependents: Dict[str, Set[str]]) -> Set[str]:
+        found: Set[str] = set()
+        stack = list(dependents[name])
+        while stack:
+            child = stack.pop()
+            if child not in found:
+                found.add(child)
+                stack.extend(dependents[child])
+        return found
@@ -0,0 +1,127 @@
+import dataclasses
+import hashlib
+import json
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from utils import utils as config
+from utils.state import StateStore
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# region -> resource ids in, the ids that no longer exist out
+Verify = Callable[[Dict[str, Set[str]]], Set[str]]
+
+
+def _canonical(value):
+    # the part of a step argument that says what the step does; clients, streams and the like are left out
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return _canonical(dataclasses.asdict(value))
+    return None
+
+
+def _ids(value) -> List[str]:
+    # state values are ids, or lists of them for instance fleets
+    return [value] if isinstance(value, str) else [item for item in value if isinstance(item, str)]
+
+
+class StepJournal:
+    # Which steps of a section have completed, in config/<section>.journal.json next to the state file (or in
+    # the <section>.journal section of the state database), with the state keys each stored and a fingerprint
+    # of its arguments and inputs. A run started on an existing journal checks the resources of completed steps
+    # with `verify` and skips the steps that still hold: unchanged, everything they depend on skipped too, and
+    # all of their resources still there. Everything else runs again, so a bring-up that died partway resumes
+    # where it stopped instead of creating a second set.
+    def __init__(self, filename: str, verify: Optional[Verify] = None):
+        self.filename = filename
+        self.verify = verify
+
+    @property
+    def store(self) -> StateStore:
+        return config.state_store(self.filename + '.journal')
+
+    def fingerprint(self, step, state: dict) -> str:
+        arguments = {name: _canonical(value) for name, value in step.kwargs.items()}
+        inputs = {key: state.get(key) for key in step.inputs}
+        payload = json.dumps({'arguments': arguments, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def record(self, step):
+        state = config.load_config(filename=self.filename)
+        self.store.set(step.name, {'fingerprint': self.fingerprint(step, state),
+                                   'outputs': {key: state[key] for key in step.outputs}})
+
+    def forget(self, *names: str):
+        self.store.delete(*names)
+
+    def forget_outputs(self, *keys: str):
+        # steps that stored any of the keys, e.g. once teardown has deleted what they created
+        keys = set(keys)
+        self.forget(*(name for name, entry in self.store.get().items() if keys & set(entry['outputs'])))
+
+    def flush(self):
+        self.store.flush()
+
+    def _candidates(self, steps: Dict[str, object], state: dict) -> Dict[str, dict]:
+        # the journal entries of steps that are unchanged since they completed
+        entries = self.store.get()
+        # the state as the journal has it, which is what the recorded fingerprints were taken against
+        recorded = dict(state)
+        for name, entry in entries.items():
+            if name in steps:
+                recorded.update(entry['outputs'])
+        candidates = {}
+        for name, step in steps.items():
+            entry = entries.get(name)
+            if entry and set(entry['outputs']) == set(step.outputs) and \
+                    entry['fingerprint'] == self.fingerprint(step, recorded):
+                candidates[name] = entry
+        return candidates
+
+    @staticmethod
+    def _skippable(candidates: Dict[str, dict], deps: Dict[str, Set[str]], order: Iterable[str],
+                   missing: Set[str]) -> Set[str]:
+        skipped: Set[str] = set()
+        for name in order:
+            entry = candidates.get(name)
+            if entry and deps[name] <= skipped and \
+                    not any(set(_ids(value)) & missing for value in entry['outputs'].values()):
+                skipped.add(name)
+        return skipped
+
+    def completed(self, steps: Dict[str, object], deps: Dict[str, Set[str]], order: Iterable[str],
+                  state: dict) -> Set[str]:
+        # the steps a run would skip if their resources are still there, without asking AWS; for plans
+        return self._skippable(self._candidates(steps, state), deps, order, set())
+
+    def resume(self, steps: Dict[str, object], deps: Dict[str, Set[str]], order: Iterable[str]) -> Set[str]:
+        # the steps to skip, taken in dependency order; their outputs are put back into the state file
+        entries = self.store.get()
+        state = config.load_config(filename=self.filename)
+        candidates = self._candidates(steps, state)
+        ids: Dict[str, Set[str]] = {}
+        for name, entry in candidates.items():
+            for value in entry['outputs'].values():
+                ids.setdefault(steps[name].region, set()).update(_ids(value))
+        missing = self.verify(ids) if self.verify and ids else set()
+
+        skipped = self._skippable(candidates, deps, order, missing)
+        stale = [name for name in entries if name in steps and name not in skipped]
+        if stale:
+            self.forget(*stale)
+        restored = {key: value for name in skipped for key, value in candidates[name]['outputs'].items()
+                    if state.get(key) != value}
+        if restored:
+            config.update_config(dict(state, **restored), filename=self.filename)
+        if skipped:
+            logger.info(f'Resuming {self.filename}: {len(skipped)} step(s) completed earlier and verified, '
+                        f'{len(missing)} recorded resource(s) gone, {len(steps) - len(skipped)} step(s) to run')
+        return skipped
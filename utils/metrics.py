@@ -0,0 +1,266 @@
+import atexit
+import json
+import logging
+import signal
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+
+from utils.clients import register_client_event
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+THROTTLING_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                    'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+                    'EC2ThrottledException', 'BandwidthLimitExceeded', 'PriorRequestNotComplete')
+_STARTED = 'nsp_metrics_started'
+_MODEL = 'nsp_metrics_model'
+
+# (service, operation, region)
+OperationKey = Tuple[str, str, str]
+
+
+class Histogram:
+    # Fixed buckets as Prometheus has them: counts per upper bound, plus the sum and count of observations.
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append(('+Inf' if bound == float('inf') else f'{bound:g}', total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        # linear interpolation inside the bucket the quantile falls in, as histogram_quantile does
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if seen + count >= rank and count:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 6), 'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99), 'buckets': dict(self.cumulative())}
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors: Counter = Counter()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'retries': self.retries, 'throttled': self.throttled, 'errors': dict(self.errors),
+                'latency_seconds': self.latency.to_dict(), 'request_bytes': self.request_bytes.to_dict(),
+                'response_bytes': self.response_bytes.to_dict()}
+
+
+def _body_size(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, dict):
+        # query protocol bodies (EC2) are still a dict at before-call and are form encoded afterwards
+        return len(urlencode(body, doseq=True))
+    if isinstance(body, str):
+        return len(body.encode())
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+def _error_code(parsed: Optional[dict]) -> Optional[str]:
+    return (parsed or {}).get('Error', {}).get('Code')
+
+
+class ApiMetrics:
+    # Per-call AWS API metrics from botocore's event hooks on every client the registry builds: calls, latency
+    # (retries and backoff included), retries, throttled attempts, errors and payload sizes, per operation and
+    # region. Export is JSON or Prometheus text.
+    def __init__(self):
+        self.operations: Dict[OperationKey, OperationStats] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def install(self) -> 'ApiMetrics':
+        with self._lock:
+            if not self._installed:
+                register_client_event('before-call', self._before_call)
+                register_client_event('after-call', self._after_call, self._after_call_async)
+                register_client_event('after-call-error', self._after_call_error)
+                register_client_event('needs-retry', self._needs_retry)
+                self._installed = True
+        return self
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.started = time.time()
+
+    def _stats(self, model, context: dict) -> OperationStats:
+        key = (model.service_model.service_name, model.name, context.get('client_region') or 'unknown')
+        stats = self.operations.get(key)
+        if stats is None:
+            stats = self.operations.setdefault(key, OperationStats())
+        return stats
+
+    def _before_call(self, model, params, context, **kwargs):
+        context[_STARTED] = time.perf_counter()
+        context[_MODEL] = model
+        size = _body_size(params.get('body'))
+        with self._lock:
+            stats = self._stats(model, context)
+            stats.calls += 1
+            stats.request_bytes.observe(size)
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        # calls answered without a request (utils.describe_cache) never reached before-call
+        if _STARTED not in context:
+            return
+        self._record_response(len(getattr(http_response, 'content', b'') or b''), parsed, model, context)
+
+    async def _after_call_async(self, http_response, parsed, model, context, **kwargs):
+        # aiobotocore responses read their body through a coroutine
+        if _STARTED not in context:
+            return
+        self._record_response(len(await http_response.content or b''), parsed, model, context)
+
+    def _record_response(self, size: int, parsed: Optional[dict], model, context: dict):
+        latency = time.perf_counter() - context.get(_STARTED, time.perf_counter())
+        code = _error_code(parsed)
+        with self._lock:
+            stats = self._stats(model, context)
+            stats.latency.observe(latency)
+            stats.response_bytes.observe(size)
+            stats.retries += (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if code:
+                stats.errors[code] += 1
+
+    def _after_call_error(self, exception, context, **kwargs):
+        # connection errors and the like never produce a response; the operation is not passed along
+        model = context.get(_MODEL)
+        if model is None:
+            return
+        latency = time.perf_counter() - context.get(_STARTED, time.perf_counter())
+        with self._lock:
+            stats = self._stats(model, context)
+            stats.latency.observe(latency)
+            stats.errors[type(exception).__name__] += 1
+
+    def _needs_retry(self, response=None, operation=None, request_dict=None, **kwargs):
+        # one event per attempt; throttled attempts count even when a retry then succeeds
+        if response is None or operation is None:
+            return None
+        if _error_code(response[1]) in THROTTLING_CODES:
+            context = (request_dict or {}).get('context', {})
+            with self._lock:
+                self._stats(operation, context).throttled += 1
+        return None
+
+    def totals(self) -> Dict[str, object]:
+        with self._lock:
+            stats = list(self.operations.values())
+        latency = Histogram(LATENCY_BUCKETS)
+        for item in stats:
+            latency.counts = [a + b for a, b in zip(latency.counts, item.latency.counts)]
+            latency.sum += item.latency.sum
+            latency.count += item.latency.count
+        return {'calls': sum(x.calls for x in stats), 'retries': sum(x.retries for x in stats),
+                'throttled': sum(x.throttled for x in stats), 'errors': sum(sum(x.errors.values()) for x in stats),
+                'latency_p50': latency.quantile(0.5), 'latency_p95': latency.quantile(0.95)}
+
+    def to_json(self) -> str:
+        with self._lock:
+            operations = [dict(service=service, operation=operation, region=region, **stats.to_dict())
+                          for (service, operation, region), stats in sorted(self.operations.items())]
+        return json.dumps({'started': self.started, 'elapsed_seconds': round(time.time() - self.started, 3),
+                           'totals': self.totals(), 'operations': operations}, indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        def family(name: str, kind: str, help_text: str):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+
+        with self._lock:
+            operations = sorted(self.operations.items())
+        labels = {key: f'service="{key[0]}",operation="{key[1]}",region="{key[2]}"' for key, _ in operations}
+        for name, attribute, help_text in (
+                ('nsp_aws_api_calls_total', 'calls', 'AWS API calls made'),
+                ('nsp_aws_api_retries_total', 'retries', 'Retried attempts of AWS API calls'),
+                ('nsp_aws_api_throttled_total', 'throttled', 'AWS API attempts rejected by throttling')):
+            family(name, 'counter', help_text)
+            lines.extend(f'{name}{{{labels[key]}}} {getattr(stats, attribute)}' for key, stats in operations)
+        family('nsp_aws_api_errors_total', 'counter', 'AWS API calls that failed, by error code')
+        for key, stats in operations:
+            lines.extend(f'nsp_aws_api_errors_total{{{labels[key]},code="{code}"}} {count}'
+                         for code, count in sorted(stats.errors.items()))
+        for name, attribute, help_text in (
+                ('nsp_aws_api_latency_seconds', 'latency', 'AWS API call latency, retries included'),
+                ('nsp_aws_api_request_bytes', 'request_bytes', 'AWS API request body size'),
+                ('nsp_aws_api_response_bytes', 'response_bytes', 'AWS API response body size')):
+            family(name, 'histogram', help_text)
+            for key, stats in operations:
+                histogram = getattr(stats, attribute)
+                lines.extend(f'{name}_bucket{{{labels[key]},le="{bound}"}} {count}'
+                             for bound, count in histogram.cumulative())
+                lines.append(f'{name}_sum{{{labels[key]}}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{{labels[key]}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+        if json_path:
+            text = self.to_json()
+            with open(json_path, 'w') as f:
+                f.write(text)
+        if prometheus_path:
+            text = self.to_prometheus()
+            with open(prometheus_path, 'w') as f:
+                f.write(text)
+        logger.info(f'AWS API calls: {self.totals()}')
+
+
+metrics = ApiMetrics()
+
+
+def enable_metrics(json_path: Optional[str] = None, prometheus_path: Optional[str] = None) -> ApiMetrics:
+    # exported when the process exits, and on SIGUSR1 while a long bring-up is still running
+    metrics.install()
+    if json_path or prometheus_path:
+        atexit.register(metrics.export, json_path, prometheus_path)
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *_: _export_in_background(json_path, prometheus_path))
+    return metrics
+
+
+def _export_in_background(json_path: Optional[str], prometheus_path: Optional[str]):
+    # the handler runs on the main thread, which may be holding the metrics lock when the signal arrives
+    threading.Thread(target=metrics.export, args=(json_path, prometheus_path), name='metrics-export',
+                     daemon=True).start()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from utils.utils import load_config
+
+
+@dataclass(frozen=True)
+class PlannedStep:
+    name: str
+    region: str
+    after: Tuple[str, ...]
+    api_calls: int
+    # length of the longest chain of steps ending with this one, counting earlier phases
+    depth: int
+    creates: Tuple[str, ...] = ()
+    # already recorded: running the step creates another resource and overwrites the recorded id
+    recreates: Tuple[str, ...] = ()
+    reuses: Tuple[str, ...] = ()
+    # neither recorded nor created by any earlier step, so the step would fail
+    missing: Tuple[str, ...] = ()
+    deletes: Tuple[str, ...] = ()
+    # in the step journal, so a run skips it
+    completed: bool = False
+
+
+@dataclass
+class Plan:
+    # What a run would do, worked out from the step graph and the state file alone.
+    section: str
+    steps: List[PlannedStep] = field(default_factory=list)
+    # resources a teardown would skip because nothing is recorded for them
+    absent: Tuple[str, ...] = ()
+    elapsed: float = 0.0
+
+    @property
+    def api_calls(self) -> int:
+        return sum(step.api_calls for step in self.steps)
+
+    @property
+    def depth(self) -> int:
+        return max((step.depth for step in self.steps), default=0)
+
+    def _keys(self, attribute: str) -> List[str]:
+        return list(dict.fromkeys(key for step in self.steps for key in getattr(step, attribute)))
+
+    def critical_path(self) -> List[PlannedStep]:
+        by_name = {step.name: step for step in self.steps}
+        path = []
+        step = max(self.steps, key=lambda x: x.depth, default=None)
+        while step is not None:
+            path.append(step)
+            parents = [by_name[name] for name in step.after if name in by_name]
+            if not parents and step.depth > 1:
+                # the first steps of a phase wait for the whole phase before it
+                parents = [x for x in self.steps if x.depth == step.depth - 1]
+            step = max(parents, key=lambda x: x.depth, default=None)
+        return path[::-1]
+
+    def summary(self) -> Dict[str, object]:
+        critical_path = self.critical_path()
+        return {
+            'section': self.section,
+            'steps': len(self.steps),
+            'api_calls': self.api_calls,
+            'depth': self.depth,
+            'critical_path_api_calls': sum(step.api_calls for step in critical_path),
+            'create': len(self._keys('creates')),
+            'recreate': len(self._keys('recreates')),
+            'reuse': len(self._keys('reuses')),
+            'delete': len(self._keys('deletes')),
+            'missing': len(self._keys('missing')),
+            'planning_ms': round(self.elapsed * 1000, 2),
+        }
+
+    def to_dict(self) -> Dict[str, object]:
+        return dict(self.summary(), absent=list(self.absent), plan=[asdict(step) for step in self.steps])
+
+    def report(self) -> str:
+        lines = [f'Plan for {self.section}:']
+        for step in self.steps:
+            done = ', completed in an earlier run' if step.completed else ''
+            lines.append(f'  [{step.depth:>3}] {step.name} [{step.region}], ~{step.api_calls} call(s){done}')
+        for title, attribute in (('Would create', 'creates'),
+                                 ('Would create again, replacing the recorded id', 'recreates'),
+                                 ('Would reuse', 'reuses'), ('Would delete', 'deletes'),
+                                 ('MISSING from state', 'missing')):
+            keys = self._keys(attribute)
+            if keys:
+                lines.append(f'{title} ({len(keys)}): {", ".join(keys)}')
+        if self.absent:
+            lines.append(f'Nothing recorded, skipped ({len(self.absent)}): {", ".join(self.absent)}')
+        lines.append('Critical path: ' + ' -> '.join(step.name for step in self.critical_path()))
+        lines.append('Summary: ' + json.dumps(self.summary()))
+        return '\n'.join(lines)
+
+
+def plan_phases(section: str, engines: Sequence, state: Optional[dict] = None) -> Plan:
+    # engines run one after the other, each seeing what the ones before it recorded
+    started = time.perf_counter()
+    state = dict(load_config(filename=section) if state is None else state)
+    plan = Plan(section)
+    produced: Set[str] = set()
+    for engine in engines:
+        steps = engine.plan_steps(state, produced, offset=plan.depth)
+        plan.steps.extend(steps)
+        produced.update(key for step in steps for key in step.creates)
+        absent = getattr(engine, 'absent', None)
+        if absent is not None:
+            plan.absent += tuple(absent(state))
+    plan.elapsed = time.perf_counter() - started
+    return plan
+
+
+def add_plan_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--plan', action='store_true',
+                        help='print what a run would create, reuse or delete, without calling AWS, and exit')
+    parser.add_argument('--plan-json', metavar='FILE',
+                        help='with --plan, also write the plan(s) as a JSON list to FILE')
+
+
+def print_plans(plans: Sequence[Plan], json_path: Optional[str] = None):
+    print('\n\n'.join(plan.report() for plan in plans))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump([plan.to_dict() for plan in plans], f, indent=2)
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+from utils.clients import ACCOUNT_CONTEXT_KEY, register_client_event
+from utils.metrics import THROTTLING_CODES
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# EC2 meters API calls per account and region in separate token buckets: non-mutating calls have a large bucket
+# that refills quickly, mutating calls a much slower one and the calls that launch or stop capacity the slowest.
+# (capacity, tokens refilled per second); the account budget is shared with every other tool, so these sit below
+# the documented defaults.
+EC2_BUCKETS: Dict[str, Tuple[float, float]] = {
+    'describe': (100, 20.0),
+    'mutating': (50, 5.0),
+    'instances': (20, 2.0),
+}
+EC2_INSTANCE_OPERATIONS = frozenset({'RunInstances', 'StartInstances', 'StopInstances', 'TerminateInstances',
+                                     'RebootInstances', 'CreateVolume', 'AttachVolume', 'DetachVolume',
+                                     'DeleteVolume', 'CreateSnapshot'})
+NON_MUTATING_PREFIXES = ('Describe', 'Get', 'List', 'Search')
+# after a throttled attempt the rate is cut by this factor, then every successful call wins back
+# RECOVERY_STEP of the nominal rate
+BACKOFF_FACTOR = 0.5
+RECOVERY_STEP = 0.05
+MIN_RATE_SHARE = 0.05
+
+# (account, region, service, category)
+BucketKey = Tuple[Optional[str], str, str, str]
+
+
+def ec2_category(operation: str) -> str:
+    if operation in EC2_INSTANCE_OPERATIONS:
+        return 'instances'
+    if operation.startswith(NON_MUTATING_PREFIXES):
+        return 'describe'
+    return 'mutating'
+
+
+class TokenBucket:
+    # Shared by every thread that calls into one bucket. Callers reserve a token and sleep until it is due,
+    # outside the lock, so waiters are served in arrival order. The rate adapts: halved when AWS throttles
+    # (multiplicative decrease), and recovered step by step while calls succeed (additive increase).
+    def __init__(self, capacity: float, rate: float, min_rate: Optional[float] = None):
+        self.capacity = capacity
+        self.nominal_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate * MIN_RATE_SHARE
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # seconds the caller has to wait before its call may go out
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        import asyncio
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_throttled(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * BACKOFF_FACTOR)
+            # what is left in the bucket is evidently not there on AWS's side
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled += 1
+            return self.rate
+
+    def on_success(self):
+        if self.rate < self.nominal_rate:
+            with self._lock:
+                self._refill(time.monotonic())
+                self.rate = min(self.nominal_rate, self.rate + self.nominal_rate * RECOVERY_STEP)
+
+
+class RateLimiter:
+    # Paces AWS API calls through one token bucket per (account, region, service, category), shared by all
+    # clients and threads of the process. Every attempt takes a token, retries included: the first one in
+    # before-call, the retry of a throttled attempt in needs-retry, ahead of botocore's own backoff.
+    def __init__(self, buckets: Optional[Mapping[str, Mapping[str, Tuple[float, float]]]] = None,
+                 scale: float = 1.0):
+        # service -> category -> (capacity, rate); services without buckets are not paced
+        self.limits = {service: dict(categories) for service, categories in (buckets or {'ec2': EC2_BUCKETS}).items()}
+        self.scale = scale
+        self.buckets: Dict[BucketKey, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def install(self) -> 'RateLimiter':
+        with self._lock:
+            if not self._installed:
+                register_client_event('before-call', self._before_call, self._before_call_async)
+                register_client_event('needs-retry', self._needs_retry, self._needs_retry_async)
+                self._installed = True
+        return self
+
+    def bucket(self, model, context: dict) -> Optional[TokenBucket]:
+        service = model.service_model.service_name
+        limits = self.limits.get(service)
+        if limits is None:
+            return None
+        category = ec2_category(model.name) if service == 'ec2' else 'default'
+        capacity, rate = limits.get(category) or limits.get('default') or (None, None)
+        if rate is None:
+            return None
+        key = (context.get(ACCOUNT_CONTEXT_KEY), context.get('client_region') or 'unknown', service, category)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self.buckets.setdefault(key, TokenBucket(max(1.0, capacity * self.scale), rate * self.scale))
+        return bucket
+
+    def _before_call(self, model, context, **kwargs):
+        bucket = self.bucket(model, context)
+        if bucket is not None:
+            bucket.acquire()
+
+    async def _before_call_async(self, model, context, **kwargs):
+        bucket = self.bucket(model, context)
+        if bucket is not None:
+            await bucket.acquire_async()
+
+    def _throttled_bucket(self, response, operation, request_dict) -> Optional[TokenBucket]:
+        # adapts the attempt's bucket to its outcome; the bucket is returned when the attempt was throttled
+        if response is None or operation is None:
+            return None
+        bucket = self.bucket(operation, (request_dict or {}).get('context', {}))
+        if bucket is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_CODES:
+            rate = bucket.on_throttled()
+            logger.info(f'{operation.name} throttled ({code}), pacing at {rate:.2f} calls/s')
+            return bucket
+        if code is None:
+            bucket.on_success()
+        return None
+
+    def _needs_retry(self, response=None, operation=None, request_dict=None, **kwargs):
+        bucket = self._throttled_bucket(response, operation, request_dict)
+        if bucket is not None:
+            bucket.acquire()
+        return None
+
+    async def _needs_retry_async(self, response=None, operation=None, request_dict=None, **kwargs):
+        bucket = self._throttled_bucket(response, operation, request_dict)
+        if bucket is not None:
+            await bucket.acquire_async()
+        return None
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {'/'.join(str(part) for part in key): {'rate': round(bucket.rate, 3), 'throttled': bucket.throttled,
+                                                      'waited_s': round(bucket.waited, 3)}
+                for key, bucket in sorted(self.buckets.items(), key=lambda item: str(item[0]))}
+
+
+limiter = RateLimiter()
+
+
+def enable_rate_limits(scale: float = 1.0) -> RateLimiter:
+    # scale is the share of the default budget this process may use, e.g. 0.25 with four runs in one account
+    limiter.scale = scale
+    return limiter.install()
@@ -0,0 +1,320 @@
+import ipaddress
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from utils.cidr import PrefixTrie
+from utils.rules import PORTLESS, Rule, port_range, protocol_name
+from utils.topology import INTERNET, Topology
+
+# what a route sends traffic to; anything else a route table can hold (NAT gateways, peering connections,
+# network interfaces) is reported as not modelled
+LOCAL = 'local'
+INTERNET_GATEWAY = 'igw'
+TRANSIT_GATEWAY = 'tgw'
+BLACKHOLE = 'blackhole'
+# how many transit gateways a packet may cross before it is taken for a routing loop
+MAX_TRANSIT_HOPS = 16
+
+
+@dataclass(frozen=True)
+class Subnet:
+    name: str
+    vpc: str
+    cidr: str
+    route_table: str
+
+
+@dataclass(frozen=True)
+class Attachment:
+    name: str
+    tgw: str
+    vpc: Optional[str] = None
+    # the gateway at the other end of a peering
+    peer: Optional[str] = None
+
+    def far_side(self, tgw: str) -> str:
+        return self.peer if tgw == self.tgw else self.tgw
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    # an instance, or an instance group with the first address of its subnet
+    name: str
+    subnet: str
+    address: str
+    rules: Tuple[Rule, ...] = ()
+
+
+@dataclass(frozen=True)
+class Hop:
+    node: str
+    route: str
+    target: str
+
+    def __str__(self):
+        return f'{self.node}: {self.route} -> {self.target}'
+
+
+@dataclass(frozen=True)
+class Verdict:
+    source: str
+    destination: str
+    reachable: bool
+    hops: Tuple[Hop, ...] = ()
+    reason: Optional[str] = None
+
+    def __str__(self):
+        if self.reachable:
+            return f'{self.source} -> {self.destination}: reachable via {", ".join(map(str, self.hops))}'
+        return f'{self.source} -> {self.destination}: unreachable, {self.reason}'
+
+
+def parse_probe(probe: str) -> Tuple[str, int]:
+    # 'icmp', 'tcp:22' or 'udp:53'
+    protocol, _, port = probe.partition(':')
+    protocol = protocol_name(protocol)
+    return protocol, port_range(protocol, port or None)[0]
+
+
+# (hops, subnet the packet lands in, reason it does not land)
+Path = Tuple[Tuple[Hop, ...], Optional[str], Optional[str]]
+
+
+class NetworkModel:
+    # What the route tables, transit gateways and security groups of one topology do to a packet, evaluated in
+    # process. Every route table (VPC or transit gateway) is a longest-prefix-match trie, so following a packet
+    # costs a few trie walks; a path runs subnet route table -> transit gateways -> the VPC holding the address,
+    # and a pair is reachable when the reply finds its way back and the destination's security group lets the
+    # probe in. Egress rules and network ACLs are left at the defaults these tools keep (allow everything).
+    # Paths are memoized per route table and per transit gateway, so an all-pairs check follows each leg once.
+    def __init__(self, name: str):
+        self.name = name
+        self.vpcs: Dict[str, ipaddress.IPv4Network] = {}
+        self.subnets: Dict[str, Subnet] = {}
+        # route table -> trie of (destination, kind, target)
+        self.route_tables: Dict[str, PrefixTrie] = {}
+        # each transit gateway routes everything through its default route table: trie of (destination, attachment)
+        self.tgw_routes: Dict[str, PrefixTrie] = {}
+        self.attachments: Dict[str, Attachment] = {}
+        self.endpoints: Dict[str, Endpoint] = {}
+        self._vpc_of: Dict[str, str] = {}
+        self._subnets_of: Dict[str, PrefixTrie] = {}
+        self._attached: Dict[Tuple[str, str], str] = {}
+        self._addresses: Dict[str, int] = {}
+        self._ingress: Dict[str, List[Tuple[str, int, int, int, int]]] = {}
+        self._paths: Dict[Tuple[str, int], Path] = {}
+        self._transits: Dict[Tuple[str, int], Path] = {}
+
+    def _changed(self):
+        self._paths.clear()
+        self._transits.clear()
+
+    def add_vpc(self, name: str, cidr: str):
+        self.vpcs[name] = ipaddress.ip_network(cidr)
+        self._subnets_of.setdefault(name, PrefixTrie())
+        self._changed()
+
+    def add_route_table(self, name: str, vpc: str):
+        if name not in self.route_tables:
+            self.route_tables[name] = PrefixTrie()
+            self._vpc_of[name] = vpc
+            self.add_route(name, str(self.vpcs[vpc]), LOCAL, vpc)
+
+    def add_route(self, route_table: str, destination: str, kind: str, target: Optional[str] = None):
+        self.route_tables[route_table].insert(destination, (str(ipaddress.ip_network(destination)), kind, target))
+        self._changed()
+
+    def add_subnet(self, name: str, vpc: str, cidr: str, route_table: str):
+        self.subnets[name] = Subnet(name, vpc, cidr, route_table)
+        self._subnets_of[vpc].insert(cidr, (str(ipaddress.ip_network(cidr)), name))
+        self._changed()
+
+    def add_transit_gateway(self, name: str):
+        self.tgw_routes.setdefault(name, PrefixTrie())
+
+    def add_tgw_route(self, tgw: str, destination: str, attachment: Optional[str]):
+        # a route without an attachment is a blackhole
+        self.add_transit_gateway(tgw)
+        self.tgw_routes[tgw].insert(destination, (str(ipaddress.ip_network(destination)), attachment))
+        self._changed()
+
+    def add_attachment(self, name: str, tgw: str, vpc: Optional[str] = None, peer: Optional[str] = None):
+        self.attachments[name] = Attachment(name, tgw, vpc, peer)
+        if vpc:
+            self._attached[(vpc, tgw)] = name
+        self._changed()
+
+    def add_endpoint(self, name: str, subnet: str, address: str, rules: Iterable[Rule] = ()):
+        endpoint = self.endpoints[name] = Endpoint(name, subnet, address, tuple(rules))
+        self._addresses[name] = int(ipaddress.ip_address(address))
+        ingress = []
+        for rule in endpoint.rules:
+            network = ipaddress.ip_network(rule.cidr, strict=False)
+            if network.version == 4:
+                ingress.append((rule.protocol, rule.from_port, rule.to_port, int(network.network_address),
+                                int(network.broadcast_address)))
+        self._ingress[name] = ingress
+
+    def _deliver(self, vpc: str, address: int) -> Path:
+        match = self._subnets_of[vpc].longest_match(address)
+        if match is None or address not in self._vpc_range(vpc):
+            return (), None, f'no subnet of {vpc} {self.vpcs[vpc]} holds {ipaddress.ip_address(address)}'
+        _, (network, subnet) = match
+        return (Hop(f'vpc {vpc}', network, subnet), ), subnet, None
+
+    def _vpc_range(self, vpc: str) -> range:
+        network = self.vpcs[vpc]
+        return range(int(network.network_address), int(network.broadcast_address) + 1)
+
+    def _transit(self, tgw: str, address: int, visited: Tuple[str, ...] = ()) -> Path:
+        # from a transit gateway on: its route table, then a VPC attachment or a peering to the next gateway
+        key = (tgw, address)
+        if key in self._transits:
+            return self._transits[key]
+        match = self.tgw_routes.get(tgw, PrefixTrie()).longest_match(address)
+        if match is None:
+            path = (), None, f'no route to {ipaddress.ip_address(address)} in the route table of {tgw}'
+        else:
+            _, (network, attachment_name) = match
+            hop = Hop(f'transit gateway {tgw}', network, attachment_name or BLACKHOLE)
+            attachment = self.attachments.get(attachment_name)
+            if attachment_name is None:
+                hops, landed, reason = (), None, f'{network} is a blackhole in {tgw}'
+            elif attachment is None:
+                hops, landed, reason = (), None, f'{tgw} routes {network} to {attachment_name}, which is not attached'
+            elif attachment.vpc:
+                hops, landed, reason = self._deliver(attachment.vpc, address)
+            elif tgw in visited or len(visited) >= MAX_TRANSIT_HOPS:
+                hops, landed, reason = (), None, f'routing loop between transit gateways at {tgw}'
+            else:
+                hops, landed, reason = self._transit(attachment.far_side(tgw), address, visited + (tgw, ))
+            path = (hop, ) + hops, landed, reason
+        if not visited:
+            # a path found partway through a loop check depends on where it started
+            self._transits[key] = path
+        return path
+
+    def _route(self, route_table: str, address: int) -> Path:
+        key = (route_table, address)
+        if key in self._paths:
+            return self._paths[key]
+        vpc = self._vpc_of[route_table]
+        match = self.route_tables[route_table].longest_match(address)
+        if match is None:
+            path = (), None, f'no route to {ipaddress.ip_address(address)} in {route_table}'
+        else:
+            _, (network, kind, target) = match
+            hop = Hop(f'route table {route_table}', network, target or kind)
+            if kind == LOCAL:
+                hops, landed, reason = self._deliver(vpc, address)
+            elif kind == TRANSIT_GATEWAY and (vpc, target) not in self._attached:
+                hops, landed, reason = (), None, f'{vpc} routes {network} to {target} but is not attached to it'
+            elif kind == TRANSIT_GATEWAY:
+                hops, landed, reason = self._transit(target, address)
+            elif kind == INTERNET_GATEWAY:
+                hops, landed, reason = (), None, f'{route_table} sends {network} to the internet gateway {target}'
+            elif kind == BLACKHOLE:
+                hops, landed, reason = (), None, f'{network} is a blackhole in {route_table}'
+            else:
+                hops, landed, reason = (), None, f'{route_table} sends {network} to {kind} {target}, ' \
+                                                 f'which is not modelled'
+            path = (hop, ) + hops, landed, reason
+        self._paths[key] = path
+        return path
+
+    def path(self, subnet: str, address) -> Path:
+        # for a packet from a subnet to an address
+        return self._route(self.subnets[subnet].route_table, int(ipaddress.ip_address(address)))
+
+    def admits(self, endpoint: str, protocol: str, port: int, address) -> bool:
+        address = int(ipaddress.ip_address(address))
+        for rule_protocol, from_port, to_port, start, end in self._ingress[endpoint]:
+            if not start <= address <= end:
+                continue
+            if rule_protocol == '-1':
+                return True
+            if rule_protocol == protocol and (from_port in (-1, port) if protocol in PORTLESS
+                                              else from_port <= port <= to_port):
+                return True
+        return False
+
+    def check(self, source: str, destination: str, protocol: str = 'icmp', port: int = -1) -> Verdict:
+        src, dst = self.endpoints[source], self.endpoints[destination]
+        src_address, dst_address = self._addresses[source], self._addresses[destination]
+        hops, landed, reason = self._route(self.subnets[src.subnet].route_table, dst_address)
+        if reason is None and landed != dst.subnet:
+            reason = f'delivered to {landed} instead of {dst.subnet}'
+        if reason is None:
+            _, back, back_reason = self._route(self.subnets[dst.subnet].route_table, src_address)
+            if back_reason:
+                reason = f'no way back: {back_reason}'
+            elif back != src.subnet:
+                reason = f'no way back: replies land in {back} instead of {src.subnet}'
+        if reason is None and not self.admits(destination, protocol, port, src_address):
+            probe = protocol if protocol in PORTLESS else f'{protocol}:{port}'
+            reason = f'the security group of {destination} does not let {probe} in from {src.address}'
+        return Verdict(source, destination, reason is None, hops, reason)
+
+    def matrix(self, protocol: str = 'icmp', port: int = -1, sources: Optional[Sequence[str]] = None,
+               destinations: Optional[Sequence[str]] = None) -> List[Verdict]:
+        # every ordered pair in one pass
+        sources = list(sources or self.endpoints)
+        destinations = list(destinations or self.endpoints)
+        return [self.check(source, destination, protocol, port)
+                for source in sources for destination in destinations if source != destination]
+
+
+def first_host(cidr: str) -> str:
+    # the first address EC2 hands out in a subnet; the four below it are reserved
+    return str(ipaddress.ip_network(cidr).network_address + 4)
+
+
+def model_from_topology(topology: Topology) -> NetworkModel:
+    # the network the topology's plan builds (services.topology), before anything exists: the same routes in the
+    # same tables, transit gateway routes as attachment propagation and the peering routes leave them, and the
+    # compiled rules of every security group
+    model = NetworkModel(topology.name)
+    for tgw in topology.transit_gateways:
+        model.add_transit_gateway(tgw.name)
+    for vpc in topology.vpcs:
+        model.add_vpc(vpc.name, vpc.cidr)
+        model.add_route_table(vpc.main_route_table, vpc.name)
+        if vpc.internet_gateway:
+            model.add_route(vpc.main_route_table, INTERNET, INTERNET_GATEWAY, vpc.igw)
+        for subnet in vpc.subnets:
+            model.add_route_table(vpc.route_table_of(subnet), vpc.name)
+            model.add_subnet(subnet.name, vpc.name, subnet.cidr, vpc.route_table_of(subnet))
+        if vpc.transit_gateway:
+            model.add_attachment(vpc.attachment, vpc.transit_gateway, vpc=vpc.name)
+            # VPC attachments propagate their range into the gateway's default route table
+            model.add_tgw_route(vpc.transit_gateway, vpc.cidr, vpc.attachment)
+            for route_table in vpc.transit_route_tables():
+                for destination in topology.transit_destinations(vpc):
+                    model.add_route(route_table, destination, TRANSIT_GATEWAY, vpc.transit_gateway)
+        for subnet in vpc.subnets:
+            if subnet.instances:
+                model.add_endpoint(subnet.instances.name, subnet.name, first_host(subnet.cidr),
+                                   topology.ingress_rules(vpc, subnet.instances))
+    for peering in topology.peerings:
+        model.add_attachment(peering.name, peering.requester, peer=peering.accepter)
+        for local, remote in ((peering.requester, peering.accepter), (peering.accepter, peering.requester)):
+            for vpc in topology.attached(remote):
+                model.add_tgw_route(local, vpc.cidr, peering.name)
+    return model
+
+
+def report(model: NetworkModel, verdicts: List[Verdict], probe: str, elapsed: float, verbose: bool = False) -> str:
+    reachable = sum(verdict.reachable for verdict in verdicts)
+    lines = [f'{model.name}: {reachable} of {len(verdicts)} pair(s) reachable for {probe} '
+             f'({len(model.endpoints)} endpoint(s), {len(model.route_tables)} route table(s), '
+             f'{len(model.tgw_routes)} transit gateway(s), {elapsed * 1000:.1f} ms)']
+    lines.extend(f'  {verdict}' for verdict in verdicts if verbose or not verdict.reachable)
+    return '\n'.join(lines)
+
+
+def check_topology(topology: Topology, probe: str = 'icmp') -> Tuple[NetworkModel, List[Verdict], float]:
+    started = time.perf_counter()
+    model = model_from_topology(topology)
+    verdicts = model.matrix(*parse_probe(probe))
+    return model, verdicts, time.perf_counter() - started
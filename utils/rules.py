@@ -0,0 +1,66 @@
+import ipaddress
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple, Union
+
+# inbound rules a security group may have by default; every CIDR of a permission counts as one rule
+DEFAULT_RULES_PER_GROUP = 60
+ALL_PORTS = (0, 65535)
+# protocols without ports; for ICMP the "ports" are type and code, -1 for all of them
+PORTLESS = ('icmp', '-1')
+PROTOCOL_ALIASES = {'all': '-1', 'any': '-1'}
+
+
+class RuleQuotaError(ValueError):
+    pass
+
+
+@dataclass(frozen=True, order=True)
+class Rule:
+    protocol: str
+    from_port: int
+    to_port: int
+    cidr: str
+
+    def __str__(self):
+        ports = '' if self.protocol in PORTLESS else f':{self.from_port}' if self.from_port == self.to_port \
+            else f':{self.from_port}-{self.to_port}'
+        return f'{"all" if self.protocol == "-1" else self.protocol}{ports} from {self.cidr}'
+
+
+def protocol_name(protocol: Union[str, int]) -> str:
+    protocol = str(protocol).lower()
+    return PROTOCOL_ALIASES.get(protocol, protocol)
+
+
+def port_range(protocol: str, ports: Union[None, int, str, Tuple[int, int]]) -> Tuple[int, int]:
+    # 22, '8000-8080' or (8000, 8080); no ports means all of them
+    if protocol in PORTLESS:
+        return (-1, -1) if ports is None else (int(ports), int(ports))
+    if ports is None:
+        return ALL_PORTS
+    if isinstance(ports, str) and '-' in ports:
+        low, high = ports.split('-', 1)
+        return int(low), int(high)
+    if isinstance(ports, (tuple, list)):
+        return int(ports[0]), int(ports[1])
+    return int(ports), int(ports)
+
+
+def compile_rules(rules: Iterable[Rule], quota: int = DEFAULT_RULES_PER_GROUP) -> List[Rule]:
+    # The smallest equivalent rule set: per protocol and port range, the CIDRs are collapsed into the fewest
+    # networks covering them, which drops duplicates and ranges inside wider ones and merges adjacent ones
+    # (10.2.0.0/16 and 10.3.0.0/16 become 10.2.0.0/15). Raises RuleQuotaError when that is still over quota.
+    by_ports: Dict[Tuple[str, int, int], List] = defaultdict(list)
+    for rule in rules:
+        by_ports[(rule.protocol, rule.from_port, rule.to_port)].append(ipaddress.ip_network(rule.cidr, strict=False))
+    compiled = []
+    for (protocol, from_port, to_port), networks in by_ports.items():
+        for version in (4, 6):
+            same_version = [network for network in networks if network.version == version]
+            compiled.extend(Rule(protocol, from_port, to_port, str(network))
+                            for network in ipaddress.collapse_addresses(same_version))
+    compiled.sort()
+    if len(compiled) > quota:
+        raise RuleQuotaError(f'{len(compiled)} rules after merging, over the quota of {quota} per security group')
+    return compiled
@@ -0,0 +1,175 @@
+import argparse
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import List, Sequence, Tuple
+
+from utils.clients import configure_clients
+from utils.describe_cache import enable_describe_cache
+from utils.metrics import enable_metrics
+from utils.ratelimit import enable_rate_limits
+from utils.utils import configure_state, get_project_root
+
+# data files worth pre-serializing: the EC2 model is one of the largest in botocore, endpoints is read by every client
+CACHED_DATA_PREFIXES = ('ec2/', 'endpoints')
+
+_IMPORT_TIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)')
+
+
+def _caching_loader_class():
+    from botocore.loaders import Loader
+
+    class CachingLoader(Loader):
+        # Keeps a pickled copy of selected botocore data files (service models, endpoints), which loads
+        # much faster than parsing the JSON. Keyed by botocore version so upgrades never see stale models.
+        def __init__(self, cache_dir: str, prefixes: Sequence[str] = CACHED_DATA_PREFIXES, **kwargs):
+            super().__init__(**kwargs)
+            self.cache_dir = cache_dir
+            self.prefixes = tuple(prefixes)
+            self.hits = 0
+            self.misses = 0
+
+        def _cache_file(self, name: str) -> str:
+            import botocore
+            return os.path.join(self.cache_dir, f'botocore-{botocore.__version__}', name.replace('/', '__') + '.pickle')
+
+        def load_data_with_path(self, name):
+            if not name.startswith(self.prefixes):
+                return super().load_data_with_path(name)
+            path = self._cache_file(name)
+            try:
+                with open(path, 'rb') as file:
+                    loaded = pickle.load(file)
+                self.hits += 1
+                return loaded
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            loaded = super().load_data_with_path(name)
+            self.misses += 1
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+                with os.fdopen(fd, 'wb') as file:
+                    pickle.dump(loaded, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+            return loaded
+
+    return CachingLoader
+
+
+def install_model_cache(botocore_session, cache_dir: str):
+    data_path = botocore_session.get_config_variable('data_path')
+    extra_paths = None
+    if data_path:
+        extra_paths = [os.path.expanduser(os.path.expandvars(path)) for path in data_path.split(os.pathsep)]
+    loader = _caching_loader_class()(cache_dir, extra_search_paths=extra_paths)
+    botocore_session.register_component('data_loader', loader)
+    return loader
+
+
+def startup_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report where startup time goes (imports, botocore session and model load) and exit')
+    parser.add_argument('--model-cache', metavar='DIR',
+                        help='keep pre-serialized botocore models in DIR (also NSP_MODEL_CACHE_DIR)')
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help='record every AWS API call and write per-operation metrics as JSON to FILE on exit '
+                             'and on SIGUSR1')
+    parser.add_argument('--metrics-prom', metavar='FILE',
+                        help='the same in the Prometheus text format, e.g. for the node exporter textfile collector')
+    parser.add_argument('--api-rate', type=float, default=1.0, metavar='SHARE',
+                        help='share of the default per-region EC2 call budget this run may use, e.g. 0.5 with two '
+                             'runs in one account (default 1.0)')
+    parser.add_argument('--no-rate-limit', action='store_true',
+                        help='send API calls as fast as the threads make them, relying on retries alone')
+    parser.add_argument('--describe-cache-ttl', type=float, default=1.0, metavar='SCALE',
+                        help='scale the per-resource-type TTLs of cached EC2 describe results, e.g. 0.5 when other '
+                             'tools change the same resources (default 1.0)')
+    parser.add_argument('--no-describe-cache', action='store_true',
+                        help='send every describe call to AWS instead of answering repeats from memory')
+    parser.add_argument('--state-db', metavar='FILE',
+                        help='keep resource ids in the SQLite database FILE instead of config/<scenario>.json, so '
+                             'concurrent runs can share it (also NSP_STATE_DB)')
+    return parser
+
+
+def apply_startup_args(args: argparse.Namespace, entry_point: str):
+    # the options every entry point shares; --profile-startup reports on entry_point and exits
+    if args.profile_startup:
+        profile_startup(entry_point, model_cache_dir=args.model_cache)
+        sys.exit(0)
+    if args.model_cache:
+        configure_clients(model_cache_dir=args.model_cache)
+    if args.metrics_json or args.metrics_prom:
+        enable_metrics(args.metrics_json, args.metrics_prom)
+    if not args.no_rate_limit:
+        enable_rate_limits(args.api_rate)
+    # plans are worked out offline and make no describe calls to cache
+    if not args.no_describe_cache and not getattr(args, 'plan', False):
+        enable_describe_cache(args.describe_cache_ttl)
+    if args.state_db:
+        configure_state(args.state_db)
+
+
+def _import_times(entry_point: str) -> List[Tuple[str, int, int]]:
+    # time the entry point's module-level imports in a fresh interpreter, as a CI wrapper would start it
+    code = ('import importlib.util, sys; '
+            f'spec = importlib.util.spec_from_file_location("entry", {entry_point!r}); '
+            'spec.loader.exec_module(importlib.util.module_from_spec(spec))')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(get_project_root()),
+                                                                    os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return rows
+
+
+def profile_startup(entry_point: str, region: str = 'us-east-1', model_cache_dir: str = None, out=sys.stdout):
+    rows = _import_times(entry_point)
+    by_package = defaultdict(int)
+    for module, self_us, _ in rows:
+        by_package[module.split('.')[0]] += self_us
+    total_us = sum(by_package.values())
+
+    print(f'Startup profile for {os.path.relpath(entry_point, get_project_root())}', file=out)
+    print(f'\nModule imports: {total_us / 1000:.1f} ms in {len(rows)} modules', file=out)
+    for package, self_us in sorted(by_package.items(), key=lambda x: -x[1])[:12]:
+        print(f'  {package:<32} {self_us / 1000:8.1f} ms  {100 * self_us / max(total_us, 1):5.1f}%', file=out)
+
+    # the deferred part: what the first API call pays
+    phases = []
+    started = time.perf_counter()
+    import boto3
+    import botocore.session
+    phases.append(('import boto3', time.perf_counter() - started))
+
+    started = time.perf_counter()
+    core = botocore.session.get_session()
+    loader = install_model_cache(core, model_cache_dir) if model_cache_dir else core.get_component('data_loader')
+    session = boto3.session.Session(botocore_session=core)
+    phases.append(('botocore session', time.perf_counter() - started))
+
+    started = time.perf_counter()
+    loader.load_service_model('ec2', 'service-2')
+    phases.append(('load EC2 service model', time.perf_counter() - started))
+
+    started = time.perf_counter()
+    session.client('ec2', region_name=region)
+    phases.append(('create EC2 client', time.perf_counter() - started))
+
+    print('\nFirst API call setup:', file=out)
+    for phase, seconds in phases:
+        print(f'  {phase:<32} {seconds * 1000:8.1f} ms', file=out)
+    if model_cache_dir:
+        print(f'\nModel cache {model_cache_dir}: {loader.hits} hit(s), {loader.misses} miss(es)', file=out)
@@ -0,0 +1,145 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger()
+
+FLUSH_INTERVAL = 0.5
+FLUSH_BATCH_SIZE = 64
+
+# what the ids in state files are, by prefix; transit gateway route tables come and go with their gateway
+ID_PREFIXES: Tuple[Tuple[str, Optional[str]], ...] = (
+    ('tgw-attach-', 'tgw_attachment'), ('tgw-rtb-', None), ('tgw-', 'tgw'), ('vpc-', 'vpc'), ('subnet-', 'subnet'),
+    ('rtb-', 'route_table'), ('igw-', 'igw'), ('sg-', 'security_group'), ('i-', 'instance'))
+
+# the region of the step being run, set by the engines, so backends that index by region know where a value lives
+step_region: contextvars.ContextVar = contextvars.ContextVar('step_region', default=None)
+
+
+def resource_type_of(value) -> Optional[str]:
+    # of an id, or of the ids of an instance fleet
+    if isinstance(value, list) and value:
+        value = value[0]
+    if not isinstance(value, str):
+        return None
+    return next((type_name for prefix, type_name in ID_PREFIXES if value.startswith(prefix)), None)
+
+
+class StateStore:
+    # The JSON backend, and the export format of the SQLite one (utils.state_db). One section file held in
+    # memory: reads never touch disk after the first load, and writes are flushed write-behind, batched by
+    # count and time, through a temp file + rename so a crash mid-write can never leave a truncated or
+    # half-overwritten state file behind.
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, batch_size: int = FLUSH_BATCH_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._data: Optional[dict] = None
+        self._pending = 0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+
+    def _loaded(self) -> dict:
+        if self._data is None:
+            try:
+                with open(self.path, 'r') as file:
+                    self._data = json.load(file)
+            except FileNotFoundError:
+                self._data = {}
+            except json.decoder.JSONDecodeError:
+                logger.warning(f'Ignoring unreadable state file {self.path}')
+                self._data = {}
+        return self._data
+
+    def get(self, key: Optional[str] = None):
+        with self._lock:
+            data = self._loaded()
+            if key:
+                return data[key]
+            return dict(data)
+
+    def set(self, key: str, value):
+        self.update({key: value})
+
+    def update(self, values: dict):
+        with self._lock:
+            self._loaded().update(values)
+            self._mark_dirty(len(values))
+
+    def replace(self, data: dict):
+        with self._lock:
+            self._data = dict(data)
+            self._mark_dirty(max(len(data), 1))
+
+    def delete(self, *keys: str):
+        with self._lock:
+            data = self._loaded()
+            for key in keys:
+                data.pop(key, None)
+            self._mark_dirty(len(keys))
+
+    def _mark_dirty(self, count: int):
+        self._pending += count
+        if self._pending >= self.batch_size:
+            self._cancel_timer()
+            # flush on a separate thread so the writer that filled the batch doesn't pay for the disk write
+            threading.Thread(target=self.flush, daemon=True).start()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._cancel_timer()
+                if not self._pending:
+                    return
+                snapshot = json.dumps(self._data)
+                self._pending = 0
+
+            directory = os.path.dirname(self.path) or '.'
+            fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(self.path), suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(snapshot)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                with self._lock:
+                    self._pending += 1
+                raise
+
+
+_stores: Dict[str, StateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(path: str) -> StateStore:
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
+
+
+def flush_all():
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.flush()
+
+
+atexit.register(flush_all)
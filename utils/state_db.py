@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+from utils.state import StateStore, resource_type_of, step_region
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s: %(levelname)s: %(message)s')
+
+# how long a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT_MS = 30000
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS state (
+        section TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        resource_type TEXT,
+        region TEXT,
+        updated REAL NOT NULL,
+        PRIMARY KEY (section, key)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS state_by_type ON state (resource_type, region)',
+    'CREATE INDEX IF NOT EXISTS state_by_region ON state (region, section)',
+)
+
+
+@dataclass(frozen=True)
+class StateRecord:
+    section: str
+    key: str
+    value: object
+    resource_type: Optional[str]
+    region: Optional[str]
+
+
+class StateDatabase:
+    # Every section (environment) in one SQLite database in WAL mode: readers never block the writer or each
+    # other, and writers in other threads and processes are serialized by SQLite rather than overwriting each
+    # other's files. Each write is one transaction, so multi-key writes land whole or not at all. Values are
+    # stored as JSON, next to the resource type their id says and the region of the step that wrote them.
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self.transaction() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread; isolation is handled here, with explicit transactions
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+            connection.execute('PRAGMA journal_mode = WAL')
+            # in WAL mode a commit survives a process crash without an fsync; only a power loss can undo one
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, so a read-modify-write in the block cannot interleave
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def section(self, section: str) -> 'SqliteStateStore':
+        return SqliteStateStore(self, section)
+
+    def sections(self) -> List[str]:
+        return [row[0] for row in self.connection().execute('SELECT DISTINCT section FROM state ORDER BY section')]
+
+    def find(self, section: Optional[str] = None, resource_type: Optional[str] = None,
+             region: Optional[str] = None) -> List[StateRecord]:
+        # by any combination of environment, resource type and region, through the indexes
+        conditions = [(column, value) for column, value in
+                      (('section', section), ('resource_type', resource_type), ('region', region)) if value]
+        where = ' AND '.join(f'{column} = ?' for column, _ in conditions) or '1'
+        rows = self.connection().execute(
+            f'SELECT section, key, value, resource_type, region FROM state WHERE {where} ORDER BY section, key',
+            [value for _, value in conditions])
+        return [StateRecord(section, key, json.loads(value), resource_type, region)
+                for section, key, value, resource_type, region in rows]
+
+    def export_json(self, section: str, path: str):
+        store = StateStore(path)
+        store.replace(self.section(section).get())
+        store.flush()
+
+    def import_json(self, section: str, path: str):
+        self.section(section).replace(StateStore(path).get())
+
+
+class SqliteStateStore:
+    # One section of a StateDatabase, with the interface of the JSON StateStore. Reads go to the database, so
+    # they see what other processes wrote; there is nothing to flush.
+    def __init__(self, database: StateDatabase, section: str):
+        self.database = database
+        self.section = section
+
+    def get(self, key: Optional[str] = None):
+        connection = self.database.connection()
+        if key:
+            row = connection.execute('SELECT value FROM state WHERE section = ? AND key = ?',
+                                     (self.section, key)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return json.loads(row[0])
+        return {key: json.loads(value) for key, value in
+                connection.execute('SELECT key, value FROM state WHERE section = ?', (self.section,))}
+
+    def set(self, key: str, value):
+        self.update({key: value})
+
+    def _write(self, connection: sqlite3.Connection, values: Dict[str, object]):
+        region, now = step_region.get(), time.time()
+        # a rewrite without a region (an import, a restore) keeps the region recorded before
+        connection.executemany(
+            'INSERT INTO state (section, key, value, resource_type, region, updated) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (section, key) DO UPDATE SET value = excluded.value, '
+            'resource_type = excluded.resource_type, region = COALESCE(excluded.region, state.region), '
+            'updated = excluded.updated',
+            [(self.section, key, json.dumps(value), resource_type_of(value), region, now)
+             for key, value in values.items()])
+
+    def update(self, values: dict):
+        with self.database.transaction() as connection:
+            self._write(connection, values)
+
+    def replace(self, data: dict):
+        with self.database.transaction() as connection:
+            stale = [(self.section, key) for (key,) in
+                     connection.execute('SELECT key FROM state WHERE section = ?', (self.section,))
+                     if key not in data]
+            connection.executemany('DELETE FROM state WHERE section = ? AND key = ?', stale)
+            self._write(connection, data)
+
+    def delete(self, *keys: str):
+        with self.database.transaction() as connection:
+            connection.executemany('DELETE FROM state WHERE section = ? AND key = ?',
+                                   [(self.section, key) for key in keys])
+
+    def flush(self):
+        pass
+
+
+_databases: Dict[str, StateDatabase] = {}
+_databases_lock = threading.Lock()
+
+
+def get_state_database(path: str) -> StateDatabase:
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = StateDatabase(path)
+        return _databases[path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move sections between a state database and JSON state files, '
+                                                 'or look resources up in the database')
+    parser.add_argument('database', help='the SQLite state database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in ('export', 'import'):
+        sub = commands.add_parser(command, help=f'{command} one section as a JSON state file')
+        sub.add_argument('section')
+        sub.add_argument('file', help='e.g. config/inter_region.json')
+    find = commands.add_parser('find', help='list recorded resources')
+    find.add_argument('--section')
+    find.add_argument('--type', dest='resource_type')
+    find.add_argument('--region')
+    args = parser.parse_args()
+
+    database = get_state_database(args.database)
+    if args.command == 'export':
+        database.export_json(args.section, args.file)
+    elif args.command == 'import':
+        database.import_json(args.section, args.file)
+    else:
+        for record in database.find(args.section, args.resource_type, args.region):
+            print(f'{record.section}\t{record.key}\t{record.resource_type or "-"}\t{record.region or "-"}\t'
+                  f'{json.dumps(record.value)}')
@@ -0,0 +1,45 @@
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+ENVIRONMENT_TAG = 'Environment'
+RUN_ID_TAG = 'RunId'
+ENVIRONMENT_ENV = 'NSP_ENVIRONMENT'
+RUN_ID_ENV = 'NSP_RUN_ID'
+
+
+def new_run_id() -> str:
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) + '-' + uuid.uuid4().hex[:8]
+
+
+# one run id per process unless the caller pins it, so everything a single bring-up creates can be found together
+_run = {'environment': os.environ.get(ENVIRONMENT_ENV), 'run_id': os.environ.get(RUN_ID_ENV) or new_run_id()}
+
+
+def configure_run(environment: Optional[str] = None, run_id: Optional[str] = None):
+    if environment is not None:
+        _run['environment'] = environment
+    if run_id is not None:
+        _run['run_id'] = run_id
+
+
+def environment(filename: str) -> str:
+    # without an explicit environment, the section a resource is recorded in is its environment
+    return _run['environment'] or filename
+
+
+def run_id() -> str:
+    return _run['run_id']
+
+
+def resource_tags(name: str, filename: str) -> List[Dict[str, str]]:
+    return [
+        {'Key': 'Name', 'Value': name},
+        {'Key': ENVIRONMENT_TAG, 'Value': environment(filename)},
+        {'Key': RUN_ID_TAG, 'Value': run_id()},
+    ]
+
+
+def tag_specifications(resource_type: str, name: str, filename: str) -> List[dict]:
+    return [{'ResourceType': resource_type, 'Tags': resource_tags(name, filename)}]
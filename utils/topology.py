@@ -0,0 +1,464 @@
+import ipaddress
+import itertools
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from utils.cidr import AllocationError, CidrAllocator, IntervalIndex
+from utils.constants import ConfigError, KNOWN_REGIONS, _AMI, _INSTANCE_TYPE
+from utils.rules import DEFAULT_RULES_PER_GROUP, Rule, RuleQuotaError, compile_rules, port_range, protocol_name
+from utils.state import get_state_store
+
+DEFAULT_INSTANCE_TYPE = 't2.micro'
+# routes a public subnet sends to the internet gateway
+INTERNET = '0.0.0.0/0'
+
+_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+# where a rule lets traffic in from, besides literal CIDRs: the VPC itself, every VPC it can reach over transit
+# gateways and peerings, or anywhere
+RULE_SOURCES = ('vpc', 'reachable', 'internet')
+
+
+@dataclass(frozen=True)
+class RuleSpec:
+    protocol: str
+    ports: Tuple[int, int]
+    sources: Tuple[str, ...]
+
+
+# what instance groups without a role accept: SSH and ping from anywhere
+DEFAULT_ROLE = (RuleSpec('tcp', (22, 22), ('internet',)), RuleSpec('icmp', (-1, -1), ('internet',)))
+
+
+@dataclass(frozen=True)
+class InstanceGroup:
+    name: str
+    count: int = 1
+    instance_type: Optional[str] = None
+    keypair: Optional[str] = None
+    # a key of the topology's security_roles
+    role: Optional[str] = None
+
+    @property
+    def security_group(self) -> str:
+        return f'{self.name}_sg'
+
+
+@dataclass(frozen=True)
+class SubnetSpec:
+    name: str
+    cidr: str
+    az: str
+    public: bool = False
+    instances: Optional[InstanceGroup] = None
+
+    @property
+    def route_table(self) -> str:
+        # private subnets of a VPC with an internet gateway get a route table of their own
+        return f'{self.name}_rt'
+
+
+@dataclass(frozen=True)
+class VpcSpec:
+    name: str
+    region: str
+    cidr: str
+    subnets: Tuple[SubnetSpec, ...]
+    internet_gateway: bool = False
+    transit_gateway: Optional[str] = None
+    attach_subnet: Optional[str] = None
+
+    @property
+    def igw(self) -> str:
+        return f'{self.name}_igw'
+
+    @property
+    def main_route_table(self) -> str:
+        return f'{self.name}_main_rt'
+
+    @property
+    def attachment(self) -> str:
+        return f'{self.name}_{self.transit_gateway}_attachment'
+
+    def route_table_of(self, subnet: SubnetSpec) -> str:
+        if self.internet_gateway and not subnet.public:
+            return subnet.route_table
+        return self.main_route_table
+
+    def transit_route_tables(self) -> List[str]:
+        # the tables that carry routes to other VPCs through the transit gateway: those of private subnets, and of
+        # public subnets with instances, which the other VPCs reach and have to be answered from
+        tables = [self.route_table_of(subnet) for subnet in self.subnets if not subnet.public or subnet.instances]
+        return list(dict.fromkeys(tables))
+
+    def attachment_subnet(self) -> SubnetSpec:
+        if self.attach_subnet:
+            return next(subnet for subnet in self.subnets if subnet.name == self.attach_subnet)
+        private = [subnet for subnet in self.subnets if not subnet.public]
+        return (private or list(self.subnets))[0]
+
+
+@dataclass(frozen=True)
+class TransitGatewaySpec:
+    name: str
+    region: str
+
+    @property
+    def route_table(self) -> str:
+        return f'{self.name}_route_table'
+
+
+@dataclass(frozen=True)
+class PeeringSpec:
+    requester: str
+    accepter: str
+
+    @property
+    def name(self) -> str:
+        return f'{self.requester}_{self.accepter}_peering'
+
+
+@dataclass(frozen=True)
+class Topology:
+    name: str
+    vpcs: Tuple[VpcSpec, ...]
+    transit_gateways: Tuple[TransitGatewaySpec, ...] = ()
+    peerings: Tuple[PeeringSpec, ...] = ()
+    images: Dict[str, str] = field(default_factory=dict, hash=False)
+    instance_type: str = DEFAULT_INSTANCE_TYPE
+    # summary routes sent to the transit gateway instead of one route per reachable VPC
+    transit_routes: Tuple[str, ...] = ()
+    # ranges handed out to VPCs and subnets that asked for a prefix instead of a cidr
+    allocations: Dict[str, str] = field(default_factory=dict, hash=False)
+    # the inbound rules of each role instance groups can take
+    security_roles: Dict[str, Tuple[RuleSpec, ...]] = field(default_factory=dict, hash=False)
+    rules_per_group: int = DEFAULT_RULES_PER_GROUP
+
+    @property
+    def regions(self) -> List[str]:
+        return sorted({vpc.region for vpc in self.vpcs} | {tgw.region for tgw in self.transit_gateways})
+
+    def transit_gateway(self, name: str) -> TransitGatewaySpec:
+        return next(tgw for tgw in self.transit_gateways if tgw.name == name)
+
+    def attached(self, tgw: str) -> List[VpcSpec]:
+        return [vpc for vpc in self.vpcs if vpc.transit_gateway == tgw]
+
+    def peers(self, tgw: str) -> List[Tuple[PeeringSpec, str]]:
+        # TGW peering is not transitive: only directly peered gateways route to each other
+        found = []
+        for peering in self.peerings:
+            if peering.requester == tgw:
+                found.append((peering, peering.accepter))
+            elif peering.accepter == tgw:
+                found.append((peering, peering.requester))
+        return found
+
+    def reachable(self, vpc: VpcSpec) -> List[VpcSpec]:
+        if not vpc.transit_gateway:
+            return []
+        gateways = [vpc.transit_gateway] + [peer for _, peer in self.peers(vpc.transit_gateway)]
+        return [other for tgw in gateways for other in self.attached(tgw) if other.name != vpc.name]
+
+    def transit_destinations(self, vpc: VpcSpec) -> List[str]:
+        if not vpc.transit_gateway:
+            return []
+        return list(self.transit_routes) or [other.cidr for other in self.reachable(vpc)]
+
+    def _source_cidrs(self, vpc: VpcSpec, source: str) -> List[str]:
+        if source == 'vpc':
+            return [vpc.cidr]
+        if source == 'reachable':
+            return [other.cidr for other in self.reachable(vpc)]
+        if source == 'internet':
+            return [INTERNET]
+        return [source]
+
+    def ingress_rules(self, vpc: VpcSpec, group: InstanceGroup) -> List[Rule]:
+        # the role's rules with their sources resolved, merged and checked against the per-group quota
+        specs = self.security_roles[group.role] if group.role else DEFAULT_ROLE
+        return compile_rules((Rule(spec.protocol, spec.ports[0], spec.ports[1], cidr)
+                              for spec in specs for source in spec.sources
+                              for cidr in self._source_cidrs(vpc, source)), self.rules_per_group)
+
+
+def _expand(entries: Sequence[dict]) -> List[dict]:
+    # an entry with `count` stands for that many copies, with {i} in its strings numbered from `start` (default 1)
+    expanded = []
+    for entry in entries or []:
+        if not isinstance(entry, dict) or 'count' not in entry:
+            expanded.append(entry)
+            continue
+        template = {key: value for key, value in entry.items() if key not in ('count', 'start')}
+        start = entry.get('start', 1)
+        expanded.extend(_format(template, i) for i in range(start, start + entry['count']))
+    return expanded
+
+
+def _format(value, i: int):
+    if isinstance(value, str):
+        return value.replace('{i}', str(i))
+    if isinstance(value, dict):
+        return {key: _format(item, i) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_format(item, i) for item in value]
+    return value
+
+
+def _instances(raw, subnet_name: str) -> Optional[InstanceGroup]:
+    if not raw:
+        return None
+    if isinstance(raw, int):
+        raw = {'count': raw}
+    return InstanceGroup(name=raw.get('name', f'{subnet_name}_instances'), count=raw.get('count', 1),
+                         instance_type=raw.get('instance_type'), keypair=raw.get('keypair'), role=raw.get('role'))
+
+
+def _rule_specs(raw: List[dict]) -> Tuple[RuleSpec, ...]:
+    # {protocol: tcp, ports: 22 | '8000-8080', from: vpc | reachable | internet | <cidr> | [...]}
+    specs = []
+    for rule in raw or []:
+        protocol = protocol_name(rule['protocol'])
+        sources = rule.get('from', 'internet')
+        specs.append(RuleSpec(protocol, port_range(protocol, rule.get('ports')),
+                              tuple([sources] if isinstance(sources, str) else sources)))
+    return tuple(specs)
+
+
+def _reserve(pool: CidrAllocator, entries: List[dict], allocations: Dict[str, str]):
+    # explicit ranges first, then what earlier runs handed out, so re-running a spec never moves a range;
+    # clashes are left for validation to report
+    for entry in entries:
+        if 'cidr' in entry:
+            try:
+                pool.reserve(entry['name'], entry['cidr'])
+            except (AllocationError, TypeError, ValueError):
+                pass
+    for entry in entries:
+        previous = allocations.get(entry['name'])
+        if 'cidr' not in entry and previous and ipaddress.ip_network(previous).prefixlen == entry.get('prefix'):
+            try:
+                pool.reserve(entry['name'], previous)
+            except AllocationError:
+                pass
+
+
+def _assign_cidrs(vpcs: List[dict], supernet: Optional[str], allocations: Dict[str, str]) -> Dict[str, str]:
+    # VPCs and subnets can ask for a `prefix` instead of a `cidr`: VPCs are carved out of the topology's
+    # supernet, subnets out of their VPC
+    assigned = {}
+    pool = None
+    if supernet:
+        pool = CidrAllocator(supernet)
+        _reserve(pool, vpcs, allocations)
+    for vpc in vpcs:
+        if 'cidr' not in vpc:
+            if pool is None:
+                raise AllocationError(f'VPC {vpc["name"]}: a prefix needs a supernet to be allocated from')
+            vpc['cidr'] = assigned[vpc['name']] = str(pool.allocate(vpc['name'], vpc['prefix']))
+        subnets = vpc['subnets']
+        if all('cidr' in subnet for subnet in subnets):
+            continue
+        subnet_pool = CidrAllocator(vpc['cidr'])
+        _reserve(subnet_pool, subnets, allocations)
+        for subnet in subnets:
+            if 'cidr' not in subnet:
+                subnet['cidr'] = assigned[subnet['name']] = str(subnet_pool.allocate(subnet['name'],
+                                                                                     subnet['prefix']))
+    return assigned
+
+
+def _peerings(raw, tgws: List[str]) -> List[Tuple[str, str]]:
+    # peerings are pairs of transit gateways, or shorthands for many: `mesh` peers every gateway with every
+    # other, {mesh: [...]} only the ones listed, {hub: x, spokes: [...]} the hub with each spoke (all the
+    # other gateways when spokes is left out)
+    if raw == 'mesh':
+        raw = [{'mesh': tgws}]
+    pairs = []
+    for entry in raw or []:
+        if isinstance(entry, dict) and 'mesh' in entry:
+            pairs.extend(itertools.combinations(entry['mesh'], 2))
+        elif isinstance(entry, dict) and 'hub' in entry:
+            hub = entry['hub']
+            pairs.extend((hub, spoke) for spoke in entry.get('spokes') or [tgw for tgw in tgws if tgw != hub])
+        else:
+            requester, accepter = entry
+            pairs.append((requester, accepter))
+    return pairs
+
+
+def _parse(name: str, raw: dict, allocations: Dict[str, str]) -> Topology:
+    raw_vpcs = [dict(vpc, subnets=_expand(vpc.get('subnets'))) for vpc in _expand(raw.get('vpcs'))]
+    assigned = _assign_cidrs(raw_vpcs, raw.get('supernet'), allocations)
+    vpcs = []
+    for vpc in raw_vpcs:
+        subnets = tuple(SubnetSpec(name=subnet['name'], cidr=subnet['cidr'], az=subnet['az'],
+                                   public=bool(subnet.get('public', False)),
+                                   instances=_instances(subnet.get('instances'), subnet['name']))
+                        for subnet in vpc['subnets'])
+        vpcs.append(VpcSpec(name=vpc['name'], region=vpc['region'], cidr=vpc['cidr'], subnets=subnets,
+                            internet_gateway=bool(vpc.get('internet_gateway', False)),
+                            transit_gateway=vpc.get('transit_gateway'), attach_subnet=vpc.get('attach_subnet')))
+    transit_gateways = tuple(TransitGatewaySpec(name=tgw['name'], region=tgw['region'])
+                             for tgw in _expand(raw.get('transit_gateways')))
+    peerings = _peerings(raw.get('peerings'), [tgw.name for tgw in transit_gateways])
+    return Topology(
+        name=name,
+        vpcs=tuple(vpcs),
+        transit_gateways=transit_gateways,
+        peerings=tuple(PeeringSpec(requester=requester, accepter=accepter) for requester, accepter in peerings),
+        images=dict(raw.get('images') or {}),
+        instance_type=raw.get('instance_type', DEFAULT_INSTANCE_TYPE),
+        transit_routes=tuple(raw.get('transit_routes') or ()),
+        allocations=assigned,
+        security_roles={role: _rule_specs(rules) for role, rules in (raw.get('security_roles') or {}).items()},
+        rules_per_group=raw.get('rules_per_group', DEFAULT_RULES_PER_GROUP),
+    )
+
+
+def _network(problems: List[str], what: str, cidr: str):
+    try:
+        return ipaddress.ip_network(cidr)
+    except (TypeError, ValueError) as e:
+        problems.append(f'{what}: {e}')
+
+
+def _overlaps(problems: List[str], what: str, networks: List[Tuple[str, ipaddress.IPv4Network]]):
+    index = IntervalIndex()
+    for name, network in networks:
+        start, end = int(network.network_address), int(network.broadcast_address)
+        clashes = index.overlapping(start, end)
+        if clashes:
+            problems.append(f'{what}: {name} {network} overlaps {", ".join(clashes)}')
+        else:
+            index.add(start, end, name)
+
+
+def _validate(topology: Topology) -> List[str]:
+    problems = []
+    names: Dict[str, str] = {}
+
+    def unique(kind: str, name: str):
+        if not isinstance(name, str) or not _NAME.match(name):
+            problems.append(f'{kind} name {name!r} is not a valid name')
+        elif name in names:
+            problems.append(f'{kind} {name} and {names[name]} {name} share a name')
+        else:
+            names[name] = kind
+
+    tgws = {}
+    for tgw in topology.transit_gateways:
+        unique('transit gateway', tgw.name)
+        if tgw.region not in KNOWN_REGIONS:
+            problems.append(f'transit gateway {tgw.name}: unknown region {tgw.region}')
+        tgws[tgw.name] = tgw
+    for peering in topology.peerings:
+        for end in (peering.requester, peering.accepter):
+            if end not in tgws:
+                problems.append(f'peering {peering.name}: unknown transit gateway {end}')
+        if peering.requester == peering.accepter:
+            problems.append(f'peering {peering.name}: a transit gateway cannot peer with itself')
+    if len({frozenset((p.requester, p.accepter)) for p in topology.peerings}) != len(topology.peerings):
+        problems.append('peerings: the same pair of transit gateways is peered twice')
+
+    vpc_networks = []
+    for vpc in topology.vpcs:
+        unique('VPC', vpc.name)
+        if vpc.region not in KNOWN_REGIONS:
+            problems.append(f'VPC {vpc.name}: unknown region {vpc.region}')
+        network = _network(problems, f'VPC {vpc.name}', vpc.cidr)
+        if network:
+            vpc_networks.append((vpc.name, network))
+        if not vpc.subnets:
+            problems.append(f'VPC {vpc.name}: has no subnets')
+        if vpc.transit_gateway and vpc.transit_gateway not in tgws:
+            problems.append(f'VPC {vpc.name}: unknown transit gateway {vpc.transit_gateway}')
+        elif vpc.transit_gateway and tgws[vpc.transit_gateway].region != vpc.region:
+            problems.append(f'VPC {vpc.name}: transit gateway {vpc.transit_gateway} is in another region')
+        if vpc.attach_subnet and vpc.attach_subnet not in {subnet.name for subnet in vpc.subnets}:
+            problems.append(f'VPC {vpc.name}: attach_subnet {vpc.attach_subnet} is not one of its subnets')
+
+        subnet_networks = []
+        for subnet in vpc.subnets:
+            unique('subnet', subnet.name)
+            if not re.fullmatch(re.escape(vpc.region) + '[a-z]', str(subnet.az)):
+                problems.append(f'subnet {subnet.name}: {subnet.az} is not an availability zone of {vpc.region}')
+            if subnet.public and not vpc.internet_gateway:
+                problems.append(f'subnet {subnet.name}: public, but VPC {vpc.name} has no internet gateway')
+            subnet_network = _network(problems, f'subnet {subnet.name}', subnet.cidr)
+            if subnet_network and network:
+                if not subnet_network.subnet_of(network):
+                    problems.append(f'subnet {subnet.name}: {subnet_network} is outside VPC {vpc.name} {network}')
+                subnet_networks.append((subnet.name, subnet_network))
+            if subnet.instances:
+                group = subnet.instances
+                unique('instance group', group.name)
+                unique('security group', group.security_group)
+                if not isinstance(group.count, int) or group.count < 1:
+                    problems.append(f'instances {group.name}: expected a positive count, got {group.count!r}')
+                instance_type = group.instance_type or topology.instance_type
+                if not _INSTANCE_TYPE.match(instance_type):
+                    problems.append(f'instances {group.name}: {instance_type} is not an instance type')
+                if not _AMI.match(topology.images.get(vpc.region, '')):
+                    problems.append(f'instances {group.name}: no AMI in images for {vpc.region}')
+                if group.role and group.role not in topology.security_roles:
+                    problems.append(f'instances {group.name}: unknown security role {group.role}')
+        _overlaps(problems, f'VPC {vpc.name}', subnet_networks)
+
+    # transit gateway routing needs every VPC range to be disjoint
+    _overlaps(problems, 'VPCs', vpc_networks)
+    for route in topology.transit_routes:
+        _network(problems, 'transit_routes', route)
+    for role, specs in topology.security_roles.items():
+        for spec in specs:
+            if spec.protocol not in ('tcp', 'udp', 'icmp', '-1'):
+                problems.append(f'security role {role}: unknown protocol {spec.protocol}')
+            elif spec.protocol in ('tcp', 'udp') and not 0 <= spec.ports[0] <= spec.ports[1] <= 65535:
+                problems.append(f'security role {role}: {spec.ports[0]}-{spec.ports[1]} is not a port range')
+            for source in spec.sources:
+                if source not in RULE_SOURCES:
+                    _network(problems, f'security role {role}', source)
+    if not problems:
+        # only now are the sources resolvable; merged rule sets still over the quota fail before anything is created
+        for vpc in topology.vpcs:
+            for subnet in vpc.subnets:
+                if subnet.instances:
+                    try:
+                        topology.ingress_rules(vpc, subnet.instances)
+                    except RuleQuotaError as e:
+                        problems.append(f'security group {subnet.instances.security_group}: {e}')
+    return problems
+
+
+def compile_topology(name: str, raw: dict, allocations: Optional[Dict[str, str]] = None) -> Topology:
+    # allocations are the ranges handed out by earlier runs, by name; they are kept wherever they still fit
+    if not isinstance(raw, dict):
+        raise ConfigError(name, [f'expected a mapping, got {type(raw).__name__}'])
+    try:
+        topology = _parse(name, raw, allocations or {})
+    except AllocationError as e:
+        raise ConfigError(name, [str(e)]) from None
+    except (KeyError, TypeError, IndexError, ValueError) as e:
+        raise ConfigError(name, [f'malformed spec: {e!r}']) from None
+    problems = _validate(topology)
+    if problems:
+        raise ConfigError(name, problems)
+    return topology
+
+
+def load_topology(path: str, name: str, persist: bool = False) -> Topology:
+    # allocated CIDRs are kept in config/<name>.cidrs.json by the runs that create resources with them
+    import yaml
+    with open(path, 'r') as file:
+        raw = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+    if name not in raw:
+        raise ConfigError(name, [f'no topology named {name} in {path}'])
+    store = get_state_store(os.path.join(os.path.dirname(path), f'{name}.cidrs.json'))
+    topology = compile_topology(name, raw[name], store.get())
+    if persist and topology.allocations != store.get():
+        store.replace(topology.allocations)
+        store.flush()
+    return topology
@@ -1,10 +1,13 @@
-import json
 import os
 
-import yaml
-
 from pathlib import Path
 
+from utils.constants import load_constants
+from utils.state import StateStore, get_state_store, flush_all
+
+# the SQLite state database to use instead of JSON files, if any (utils.state_db)
+STATE_DB_ENV = 'NSP_STATE_DB'
+
 
 def get_project_root() -> Path:
     return Path(__file__).parent.parent
@@ -14,34 +17,44 @@ CONFIG_PATH = os.path.join(get_project_root(), 'config', '')
 
 
 def fetch_constants(section: str):
-    with open(CONFIG_PATH + "constants.yaml", "r") as file:
-        constants = yaml.safe_load(file)
-    return constants[section]
+    return load_constants(CONFIG_PATH + "constants.yaml")[section]
+
+
+_state_db = os.environ.get(STATE_DB_ENV) or None
+
+
+def configure_state(db_path: str = None):
+    # every section after this goes to the database at db_path, or back to config/<section>.json without one
+    global _state_db
+    _state_db = db_path or None
+
+
+def state_store(section: str) -> StateStore:
+    # the JSON store, or a utils.state_db section with the same interface
+    if _state_db:
+        from utils.state_db import get_state_database
+        return get_state_database(_state_db).section(section)
+    return get_state_store(CONFIG_PATH + section + '.json')
 
 
 def store_config(value: str, key: str, filename: str):
-    with open(CONFIG_PATH + filename + '.json', 'r+') as file:
-        try:
-            data = json.load(file)
-        except json.decoder.JSONDecodeError:
-            data = {}
-        finally:
-            data.update({key: value})
-            file.seek(0)
-            json.dump(data, file)
-            file.close()
+    state_store(filename).set(key, value)
 
 
 def load_config(filename: str, key: str = None):
-    with open(CONFIG_PATH + filename + '.json', 'r+') as file:
-        data = json.load(file)
-        file.close()
-    if key:
-        return data[key]
-    return data
+    return state_store(filename).get(key)
 
 
 def update_config(data, filename: str):
-    with open(CONFIG_PATH + filename + '.json', 'w+') as file:
-        json.dump(data, file)
-        file.close()
+    state_store(filename).replace(data)
+
+
+def flush_config(filename: str = None):
+    if filename:
+        state_store(filename).flush()
+    else:
+        flush_all()
+
+
+def delete_config(filename: str, *keys: str):
+    state_store(filename).delete(*keys)